@@ -0,0 +1,113 @@
+'''
+Micro-benchmark of the JSON detector in sniff_format, against the
+regex-based is_json it replaced (kept here as legacy_is_json).
+
+It times both on 10KB and 1MB buffers of: pretty-printed JSON, single-line
+JSON, JSON Lines and CSV (i.e. not JSON).
+
+usage: python ckanext/qa/bin/benchmark_json_sniff.py [--repeat N]
+'''
+
+from optparse import OptionParser
+import json
+import logging
+import re
+import timeit
+
+SIZES = (('10KB', 10 * 1024), ('1MB', 1024 * 1024))
+
+
+def legacy_is_json(buf, log):
+    '''The is_json detector before the single-pass tokenizer replaced it.'''
+    string = '"[^"]*"'
+    string_re = re.compile(string)
+    number_re = re.compile('-?\d+(\.\d+)?([eE][+-]?\d+)?')
+    extra_values_re = re.compile('true|false|null')
+    object_start_re = re.compile('{%s:\s?' % string)
+    object_middle_re = re.compile('%s:\s?' % string)
+    object_end_re = re.compile('}')
+    comma_re = re.compile(',\s?')
+    array_start_re = re.compile('\[')
+    array_end_re = re.compile('\]')
+    any_value_regexs = [string_re, number_re, object_start_re, array_start_re, extra_values_re]
+
+    pos = 0
+    state_stack = []
+    number_of_matches = 0
+    while pos < len(buf):
+        part_of_buf = buf[pos:]
+        if pos == 0:
+            potential_matches = (object_start_re, array_start_re, string_re, number_re, extra_values_re)
+        elif not state_stack:
+            return False
+        elif state_stack[-1] == 'object':
+            potential_matches = [comma_re, object_middle_re, object_end_re] + any_value_regexs
+        elif state_stack[-1] == 'array':
+            potential_matches = any_value_regexs + [comma_re, array_end_re]
+        for matcher in potential_matches:
+            if matcher.match(part_of_buf):
+                if matcher in any_value_regexs and state_stack and state_stack[-1] == 'comma':
+                    state_stack.pop()
+                if matcher == object_start_re:
+                    state_stack.append('object')
+                elif matcher == array_start_re:
+                    state_stack.append('array')
+                elif matcher in (object_end_re, array_end_re):
+                    try:
+                        state_stack.pop()
+                    except IndexError:
+                        return False
+                break
+        else:
+            return False
+        match_length = matcher.match(part_of_buf).end()
+        pos += match_length
+        number_of_matches += 1
+        if number_of_matches > 5:
+            return True
+    return True
+
+
+def make_inputs(size):
+    '''Returns a dict of name: buffer of (about) the given size.'''
+    record = {'id': 12345, 'name': 'Abbotts Hill', 'lat': 54.966678,
+              'tags': ['a', 'b', 'c'], 'open': True, 'notes': None}
+    num_records = size // len(json.dumps(record)) + 1
+    records = [record] * num_records
+    return {
+        'pretty JSON': json.dumps(records, indent=2)[:size],
+        'single-line JSON': json.dumps(records)[:size],
+        'JSON Lines': '\n'.join(json.dumps(r) for r in records)[:size],
+        'CSV': ('id,name,lat\n' + '12345,Abbotts Hill,54.966678\n' *
+                num_records)[:size],
+        }
+
+
+def benchmark(repeat):
+    from ckanext.qa.sniff_format import get_json_variant
+    log = logging.getLogger(__name__)
+    log.disabled = True
+    print '%-8s %-18s %12s %12s %8s' % ('size', 'input', 'legacy (ms)',
+                                        'new (ms)', 'speed-up')
+    for size_name, size in SIZES:
+        for input_name, buf in sorted(make_inputs(size).items()):
+            legacy = min(timeit.repeat(lambda: legacy_is_json(buf, log),
+                                       number=10, repeat=repeat)) / 10
+            new = min(timeit.repeat(lambda: get_json_variant(buf, log),
+                                    number=10, repeat=repeat)) / 10
+            print '%-8s %-18s %12.3f %12.3f %7.1fx' % (
+                size_name, input_name, legacy * 1000, new * 1000,
+                legacy / new if new else 0)
+
+if __name__ == '__main__':
+    usage = """Micro-benchmark of the JSON sniffer
+
+    usage: %prog [options]
+    """
+    parser = OptionParser(usage=usage)
+    parser.add_option('-r', '--repeat', dest='repeat', type='int', default=5,
+                      help='Number of timing runs to take the best of')
+    (options, args) = parser.parse_args()
+    if args:
+        parser.error('Wrong number of arguments (%i)' % len(args))
+    benchmark(options.repeat)
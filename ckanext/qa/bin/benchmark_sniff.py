@@ -0,0 +1,401 @@
+'''
+Benchmark of sniff_format over a synthetic corpus of files, to catch
+regressions in its speed (or in the formats it detects).
+
+"generate" writes the corpus: CSV, PSV, TSV, JSON, JSON Lines, XML and its
+variants (RSS, Atom, KML, RDF, without declaration), Turtle, HTML with and
+without RDFa, zips and gzips of CSV, each small and large, plus copies of the
+MS Office and OpenDocument test fixtures. The files it expects each to be
+sniffed as are listed in its manifest.json.
+
+"run" sniffs every file in the corpus (as sniff_file_format does, but without
+the daemon or cache) and reports files/sec, p50/p99 latency for each kind of
+file and overall, the time spent in each detector, and the peak RSS of the
+process. With --save-baseline it saves the results, and with --baseline it
+compares them with those saved, exiting with status 1 if they are slower (by
+more than --tolerance) or any file is sniffed differently.
+
+usage: python ckanext/qa/bin/benchmark_sniff.py generate <corpus_dir>
+       python ckanext/qa/bin/benchmark_sniff.py run <corpus_dir> \
+           [--baseline FILE | --save-baseline FILE]
+'''
+
+from optparse import OptionParser
+from collections import defaultdict
+import gzip
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import sys
+import time
+import zipfile
+
+import common
+
+MANIFEST_FILENAME = 'manifest.json'
+SMALL_SIZE = 16 * 1024
+FIXTURES = (
+    ('ukti-admin-spend-nov-2011.xls', 'XLS'),
+    ('August-2010.xls', 'XLS'),
+    ('decc_local_authority_data_xlsx.xlsx', 'XLSX'),
+    ('bis-quarterly-publications-dg-expenses-jul-sep-2010.doc', 'DOC'),
+    ('directors-org-chart-march-2012.ppt', 'PPT'),
+    ('20101130_narrative_and_payscales.odt', 'ODT'),
+    ('CloudStore - May 2012 cat export (three header rows).ods', 'ODS'),
+    )
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), '..', 'tests', 'data')
+
+WORDS = ('abbey', 'bridge', 'county', 'district', 'estate', 'forest', 'green',
+         'harbour', 'island', 'junction', 'kingdom', 'lane', 'market')
+
+
+def random_row(rng):
+    return [str(rng.randint(1, 100000)), rng.choice(WORDS).title(),
+            '%.6f' % rng.uniform(49, 59), rng.choice(WORDS),
+            '201%d-0%d-1%d' % (rng.randint(0, 9), rng.randint(1, 9),
+                               rng.randint(0, 9))]
+
+
+def repeat_to_size(header, make_item, footer, size):
+    '''Returns header + as many items as make it (about) size + footer.'''
+    parts = [header]
+    length = len(header) + len(footer)
+    while length < size:
+        item = make_item()
+        parts.append(item)
+        length += len(item)
+    parts.append(footer)
+    return ''.join(parts)
+
+
+def delimited(delimiter):
+    def make(rng, size):
+        header = delimiter.join(['id', 'name', 'lat', 'type', 'date']) + '\n'
+        return repeat_to_size(
+            header, lambda: delimiter.join(random_row(rng)) + '\n', '', size)
+    return make
+
+
+def record(rng):
+    row = random_row(rng)
+    return {'id': int(row[0]), 'name': row[1], 'lat': float(row[2]),
+            'tags': [row[3]], 'open': rng.random() > 0.5, 'notes': None}
+
+
+def make_json(rng, size):
+    return repeat_to_size('[\n', lambda: json.dumps(record(rng), indent=2) +
+                          ',\n', '{}\n]\n', size)
+
+
+def make_ndjson(rng, size):
+    return repeat_to_size('', lambda: json.dumps(record(rng)) + '\n', '',
+                          size)
+
+
+def xml_items(header, item_template, footer):
+    def make(rng, size):
+        return repeat_to_size(
+            header, lambda: item_template % tuple(random_row(rng)[:2]),
+            footer, size)
+    return make
+
+make_xml = xml_items(
+    '<?xml version="1.0" encoding="UTF-8"?>\n<records>\n',
+    '  <record><id>%s</id><name>%s</name></record>\n', '</records>\n')
+make_xml_without_declaration = xml_items(
+    '<records>\n', '  <record><id>%s</id><name>%s</name></record>\n',
+    '</records>\n')
+make_rss = xml_items(
+    '<?xml version="1.0" encoding="UTF-8"?>\n<rss version="2.0"><channel>\n'
+    '<title>News</title>\n',
+    '<item><title>%s</title><description>%s</description></item>\n',
+    '</channel></rss>\n')
+make_atom = xml_items(
+    '<?xml version="1.0" encoding="utf-8"?>\n'
+    '<feed xmlns="http://www.w3.org/2005/Atom">\n<title>News</title>\n',
+    '<entry><id>%s</id><title>%s</title></entry>\n', '</feed>\n')
+make_kml = xml_items(
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<kml xmlns="http://www.opengis.net/kml/2.2"><Document>\n',
+    '<Placemark><name>%s %s</name><Point><coordinates>-1.5,52.1,0'
+    '</coordinates></Point></Placemark>\n', '</Document></kml>\n')
+make_rdf = xml_items(
+    '<?xml version="1.0"?>\n<rdf:RDF '
+    'xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#" '
+    'xmlns:foaf="http://xmlns.com/foaf/0.1/">\n',
+    '<foaf:Person rdf:about="http://example.com/%s"><foaf:name>%s'
+    '</foaf:name></foaf:Person>\n', '</rdf:RDF>\n')
+make_ttl = xml_items(
+    '@prefix foaf: <http://xmlns.com/foaf/0.1/> .\n\n',
+    '<http://example.com/%s> a foaf:Person ;\n    foaf:name "%s" .\n', '')
+make_ttl_without_prefixes = xml_items(
+    '', '<http://example.com/%s> <http://xmlns.com/foaf/0.1/name> "%s" .\n',
+    '')
+
+
+def make_html(rng, size, rdfa=False):
+    # any RDFa is well into the page (but within the default
+    # qa.rdfa_max_bytes), so that much has to be looked through
+    make_paragraph = lambda: '<p class="%s">%s</p>\n' % \
+        tuple(random_row(rng)[1:3])
+    header = '<!DOCTYPE html>\n<html>\n<head><title>Page</title></head>\n' \
+        '<body>\n'
+    if rdfa:
+        header = repeat_to_size(
+            header, make_paragraph, '<div about="/about"><span '
+            'property="dc:title">About</span></div>\n',
+            min(size, 768 * 1024) * 3 // 4)
+    return repeat_to_size(header, make_paragraph, '</body>\n</html>\n', size)
+
+
+def make_zip(rng, size):
+    data = delimited(',')(rng, size)
+    return zip_files([('data.csv', data), ('readme.txt', 'About the data')])
+
+
+def make_zip_with_many_files(rng, size):
+    # lots of small files, with a few extensions
+    files = []
+    total = 0
+    while total < size:
+        data = delimited(',')(rng, 256)
+        files.append(('%s/%s.%s' % (rng.choice(WORDS), len(files),
+                                    rng.choice(('csv', 'csv', 'txt', 'pdf'))),
+                      data))
+        total += len(data)
+    return zip_files(files)
+
+
+def zip_files(files):
+    from StringIO import StringIO
+    buf = StringIO()
+    zip_ = zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED)
+    for filename, data in files:
+        zip_.writestr(filename, data)
+    zip_.close()
+    return buf.getvalue()
+
+
+def make_gzip(rng, size):
+    from StringIO import StringIO
+    buf = StringIO()
+    gzip_file = gzip.GzipFile(fileobj=buf, mode='wb')
+    gzip_file.write(delimited(',')(rng, size))
+    gzip_file.close()
+    return buf.getvalue()
+
+# kind: (make function, filename extension, expected format)
+KINDS = {
+    'csv': (delimited(','), 'csv', {'format': 'CSV'}),
+    'psv': (delimited('|'), 'psv', {'format': 'PSV'}),
+    'tsv': (delimited('\t'), 'tsv', {'format': 'TSV'}),
+    'json': (make_json, 'json', {'format': 'JSON'}),
+    'ndjson': (make_ndjson, 'ndjson', {'format': 'NDJSON'}),
+    'xml': (make_xml, 'xml', {'format': 'XML'}),
+    'xml-no-declaration': (make_xml_without_declaration, 'xml',
+                           {'format': 'XML'}),
+    'rss': (make_rss, 'rss', {'format': 'RSS'}),
+    'atom': (make_atom, 'atom', {'format': 'Atom Feed'}),
+    'kml': (make_kml, 'kml', {'format': 'KML'}),
+    'rdf': (make_rdf, 'rdf', {'format': 'RDF'}),
+    'ttl': (make_ttl, 'ttl', {'format': 'TTL'}),
+    'ttl-no-prefixes': (make_ttl_without_prefixes, 'ttl', {'format': 'TTL'}),
+    'html': (make_html, 'html', {'format': 'HTML'}),
+    'html-rdfa': (lambda rng, size: make_html(rng, size, rdfa=True), 'html',
+                  {'format': 'RDFa'}),
+    'zip': (make_zip, 'zip', {'format': 'CSV', 'container': 'ZIP'}),
+    'zip-many-files': (make_zip_with_many_files, 'zip',
+                       {'format': 'CSV', 'container': 'ZIP'}),
+    'gz': (make_gzip, 'csv.gz', {'format': 'CSV', 'container': 'GZ'}),
+    }
+
+
+def generate(corpus_dir, copies, large_size, seed):
+    '''Writes the corpus files and its manifest to corpus_dir.'''
+    rng = random.Random(seed)
+    if not os.path.exists(corpus_dir):
+        os.makedirs(corpus_dir)
+    manifest = {}
+    for kind, (make, extension, expected_format) in sorted(KINDS.items()):
+        sizes = [('small%s' % i, SMALL_SIZE) for i in range(copies)] + \
+            [('large', large_size)]
+        for size_name, size in sizes:
+            filename = '%s-%s.%s' % (kind, size_name, extension)
+            with open(os.path.join(corpus_dir, filename), 'wb') as f:
+                f.write(make(rng, size))
+            manifest[filename] = {'kind': kind, 'format': expected_format}
+    for filename, format_ in FIXTURES:
+        shutil.copy(os.path.join(FIXTURES_DIR, filename), corpus_dir)
+        manifest[filename] = {'kind': format_.lower(),
+                              'format': {'format': format_}}
+    with open(os.path.join(corpus_dir, MANIFEST_FILENAME), 'wb') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    print 'Wrote %s files to %s' % (len(manifest), corpus_dir)
+
+
+def percentile(values, percent):
+    '''Returns the percentile of the values, by the nearest-rank method.'''
+    if not values:
+        return 0
+    values = sorted(values)
+    rank = max(int(round(percent / 100.0 * len(values))), 1)
+    return values[rank - 1]
+
+
+def peak_rss_kb():
+    # ru_maxrss is in KB on Linux, and bytes on OS X
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def run(corpus_dir, repeat):
+    '''Sniffs the corpus, repeat times, and returns the results.'''
+    from ckanext.qa.sniff_format import sniff_file_format_locally
+    log = logging.getLogger(__name__)
+    log.disabled = True
+    logging.getLogger('ckanext.qa.sniff_format').disabled = True
+    with open(os.path.join(corpus_dir, MANIFEST_FILENAME), 'rb') as f:
+        manifest = json.load(f)
+    detector_times = defaultdict(list)
+    kind_times = defaultdict(list)
+    all_times = []
+    formats = {}
+    start = time.time()
+    for i in range(repeat):
+        for filename, details in sorted(manifest.items()):
+            filepath = os.path.join(corpus_dir, filename)
+            trace = []
+            file_start = time.time()
+            formats[filename] = sniff_file_format_locally(filepath, log,
+                                                          trace=trace)
+            elapsed = time.time() - file_start
+            for detector in trace:
+                # (a detector that runs others includes their time)
+                detector_times[detector['detector']].append(
+                    detector['seconds'])
+            kind_times[details['kind']].append(elapsed)
+            all_times.append(elapsed)
+    total_time = time.time() - start
+
+    def summary(times):
+        return {'files': len(times),
+                'files_per_sec': len(times) / sum(times) if sum(times) else 0,
+                'p50_ms': percentile(times, 50) * 1000,
+                'p99_ms': percentile(times, 99) * 1000}
+    results = summary(all_times)
+    results['files_per_sec'] = len(all_times) / total_time
+    results['peak_rss_kb'] = peak_rss_kb()
+    results['kinds'] = dict((kind, summary(times))
+                            for kind, times in kind_times.items())
+    results['detectors'] = dict(
+        (name, dict(summary(times), total_sec=sum(times)))
+        for name, times in detector_times.items())
+    results['formats'] = formats
+    results['wrong_formats'] = dict(
+        (filename, format_) for filename, format_ in formats.items()
+        if format_ != manifest[filename]['format'])
+    return results
+
+
+def print_results(results):
+    print '%-22s %6s %10s %10s %10s' % ('kind', 'files', 'files/sec',
+                                        'p50 (ms)', 'p99 (ms)')
+    for kind, summary in sorted(results['kinds'].items()) + \
+            [('ALL', results)]:
+        print '%-22s %6d %10.1f %10.2f %10.2f' % (
+            kind, summary['files'], summary['files_per_sec'],
+            summary['p50_ms'], summary['p99_ms'])
+    print
+    print '%-32s %6s %10s %10s %10s' % ('detector', 'calls', 'total (s)',
+                                        'p50 (ms)', 'p99 (ms)')
+    for name, summary in sorted(results['detectors'].items(),
+                                key=lambda x: -x[1]['total_sec']):
+        print '%-32s %6d %10.3f %10.2f %10.2f' % (
+            name, summary['files'], summary['total_sec'],
+            summary['p50_ms'], summary['p99_ms'])
+    print
+    print 'Peak RSS: %.1f MB' % (results['peak_rss_kb'] / 1024.0)
+    for filename, format_ in sorted(results['wrong_formats'].items()):
+        print 'Not sniffed as expected: %s -> %s' % (filename, format_)
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    '''Returns a list of the ways the results are worse than the baseline.'''
+    regressions = []
+    if results['files_per_sec'] < baseline['files_per_sec'] * (1 - tolerance):
+        regressions.append('files/sec %.1f, was %.1f' % (
+            results['files_per_sec'], baseline['files_per_sec']))
+    for key, name in (('p50_ms', 'p50 latency (ms)'),
+                      ('p99_ms', 'p99 latency (ms)'),
+                      ('peak_rss_kb', 'peak RSS (KB)')):
+        if results[key] > baseline[key] * (1 + tolerance):
+            regressions.append('%s %.1f, was %.1f' % (name, results[key],
+                                                      baseline[key]))
+    for kind, summary in sorted(results['kinds'].items()):
+        baseline_summary = baseline['kinds'].get(kind)
+        if baseline_summary and summary['p99_ms'] > \
+                baseline_summary['p99_ms'] * (1 + tolerance):
+            regressions.append('%s p99 latency (ms) %.2f, was %.2f' % (
+                kind, summary['p99_ms'], baseline_summary['p99_ms']))
+    for filename, format_ in sorted(results['formats'].items()):
+        if filename in baseline['formats'] and \
+                format_ != baseline['formats'][filename]:
+            regressions.append('%s sniffed as %s, was %s' % (
+                filename, format_, baseline['formats'][filename]))
+    return regressions
+
+if __name__ == '__main__':
+    usage = """Benchmark of sniffing file formats
+
+    usage: %prog [options] generate <corpus_dir>
+           %prog [options] run <corpus_dir>
+    """
+    parser = OptionParser(usage=usage)
+    parser.add_option('--copies', dest='copies', type='int', default=5,
+                      help='Number of small files of each kind to generate')
+    parser.add_option('--large-mb', dest='large_mb', type='float', default=8,
+                      help='Size of the large file of each kind to generate')
+    parser.add_option('--seed', dest='seed', type='int', default=1,
+                      help='Random seed for generating the corpus')
+    parser.add_option('-r', '--repeat', dest='repeat', type='int', default=3,
+                      help='Number of times to sniff the corpus')
+    parser.add_option('-c', '--config', dest='config',
+                      help='CKAN config file, for the sniff options')
+    parser.add_option('--baseline', dest='baseline',
+                      help='Results file to compare with')
+    parser.add_option('--save-baseline', dest='save_baseline',
+                      help='File to save the results to')
+    parser.add_option('--tolerance', dest='tolerance', type='float',
+                      default=0.25,
+                      help='How much worse (as a fraction) than the baseline '
+                      'is a regression')
+    (options, args) = parser.parse_args()
+    if len(args) != 2 or args[0] not in ('generate', 'run'):
+        parser.error('Wrong arguments')
+    command, corpus_dir = args
+    if command == 'generate':
+        generate(corpus_dir, options.copies,
+                 int(options.large_mb * 1024 * 1024), options.seed)
+        sys.exit(0)
+    if options.config:
+        common.load_config(options.config)
+    results = run(corpus_dir, options.repeat)
+    print_results(results)
+    if options.save_baseline:
+        with open(options.save_baseline, 'wb') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print 'Saved baseline: %s' % options.save_baseline
+    if options.baseline:
+        with open(options.baseline, 'rb') as f:
+            baseline = json.load(f)
+        regressions = compare_with_baseline(results, baseline,
+                                            options.tolerance)
+        if regressions:
+            print 'REGRESSIONS compared with %s:' % options.baseline
+            for regression in regressions:
+                print '  ' + regression
+            sys.exit(1)
+        print 'No regressions compared with %s' % options.baseline
@@ -1,5 +1,10 @@
 import logging
 import sys
+import os
+import glob
+import json
+import time
+import functools
 
 from sqlalchemy import or_
 
@@ -10,10 +15,87 @@ from ckan import model
 REQUESTS_HEADER = {'content-type': 'application/json',
                    'User-Agent': 'ckanext-qa commands'}
 
+# Seconds between checks of the search index queue, by search-index watch
+SEARCH_INDEX_POLL_INTERVAL = 5
+
 
 class CkanApiError(Exception):
     pass
 
+def iter_filepaths(args):
+    '''Yields the filepaths given on the command-line, expanding any globs
+    and (recursively) any directories.'''
+    for arg in args:
+        paths = glob.glob(arg) if glob.has_magic(arg) else [arg]
+        for path in sorted(paths):
+            if os.path.isdir(path):
+                for dirpath, dirnames, filenames in os.walk(path):
+                    dirnames.sort()
+                    for filename in sorted(filenames):
+                        yield os.path.join(dirpath, filename)
+            else:
+                yield path
+
+
+def sniff_for_command(filepath, trace=False):
+    '''Sniffs a file for "paster qa sniff", returning the result as a dict.
+    (A module-level function, so that it can be run in a process pool.)'''
+    from ckanext.qa.sniff_format import sniff_file_format
+    start = time.time()
+    error = None
+    detectors = [] if trace else None
+    try:
+        format_ = sniff_file_format(
+            filepath, logging.getLogger('ckanext.qa.sniffer'),
+            trace=detectors)
+    except Exception, e:
+        format_ = None
+        error = '%s: %s' % (e.__class__.__name__, e)
+    result = {
+        'path': filepath,
+        'format': format_['format'] if format_ else None,
+        'container': format_.get('container') if format_ else None,
+        'elapsed_ms': round((time.time() - start) * 1000, 1),
+        }
+    if format_ and format_.get('sniff_truncated'):
+        result['sniff_truncated'] = True
+    if error:
+        result['error'] = error
+    if trace:
+        result['trace'] = [
+            {'detector': detector['detector'], 'depth': detector['depth'],
+             'elapsed_ms': round(detector['seconds'] * 1000, 1),
+             'bytes_read': detector['bytes_read']}
+            for detector in detectors]
+    return result
+
+
+def rescore_for_command(line, sniff=False):
+    '''Scores a resource for "paster qa rescore-offline", given its line of
+    JSON, returning the result as a dict. (A module-level function, so that it
+    can be run in a process pool.)'''
+    from ckanext.qa import scoring
+    log = logging.getLogger('ckanext.qa.rescore')
+    result = {'resource_id': None, 'package_id': None}
+    try:
+        resource = json.loads(line)
+        result.update(resource_id=resource.get('id'),
+                      package_id=resource.get('package_id'))
+        archival = scoring.archival_from_json(resource.get('archival'))
+        sniff_ = None
+        if sniff and archival and archival.get('cache_filepath') and \
+                os.path.exists(archival['cache_filepath']):
+            from ckanext.qa.sniff_format import sniff_file_format
+            sniff_ = lambda score_reasons: scoring.score_sniffed_format(
+                sniff_file_format(archival['cache_filepath'], log),
+                score_reasons)
+        result.update(scoring.score_resource(resource, archival, log,
+                                             sniff=sniff_, sniffing=sniff))
+    except Exception, e:
+        result['error'] = '%s: %s' % (e.__class__.__name__, e)
+    return result
+
+
 # @TODO: use ORM + sqlalchemy to work with the db
 class QACommand(p.toolkit.CkanCommand):
     """
@@ -25,12 +107,60 @@ class QACommand(p.toolkit.CkanCommand):
            - Creates the database tables that QA expects for storing
            results
 
-        paster qa [options] update [dataset/group name/id]
+        paster qa [options] [--force] update [dataset/group name/id]
            - QA analysis on all resources in a given dataset, or on all
-           datasets if no dataset given
-
-        paster qa sniff {filepath}
-           - Opens the file and determines its type by the contents
+           datasets if no dataset given. Resources whose archival, URL,
+           format and licence (and the scores table) have not changed since
+           they were last scored are skipped, unless --force is given.
+
+        paster qa [--workers N] [--trace] sniff {filepath/directory/glob}
+           - Opens the files and determines their type by the contents.
+             Directories are searched recursively. Writes a JSON line per
+             file: {"path", "format", "container", "elapsed_ms"} (plus
+             "sniff_truncated" if it ran out of budget, and with --trace,
+             "trace": the detectors run, their elapsed_ms and bytes_read)
+             and finishes with a throughput summary (on stderr).
+
+        paster qa [--workers N] sniffd [socket path]
+           - Runs the sniff daemon, which sniffs files for other processes
+             (those with the same qa.sniffd_socket config), so that they
+             don't have to load the detectors. The socket path defaults to
+             qa.sniffd_socket.
+
+        paster qa [--workers N] [--sniff] rescore-offline {resources.jsonl}
+           - Scores resources given in a file (or - for stdin) rather than in
+             the database, writing a JSON line of results per resource:
+             {"resource_id", "package_id", "openness_score",
+             "openness_score_reason", "format", "archival_timestamp",
+             "inputs_hash", "scores_hash"} (or "error"), ready to load into
+             the qa table.
+             Each input line is a resource: {"id", "package_id", "url",
+             "format", "license_id", "qa_format", "archival"}, where
+             "archival" is null or has the archival's "updated",
+             "last_success", "first_failure" (isoformat), "is_broken",
+             "status", "reason", "failure_count" and "cache_filepath".
+             With --sniff, archived files that exist locally are sniffed.
+
+        paster qa rescore-formats {old scores json}
+           - After changing the resource format openness scores, updates the
+             scores of the resources in the formats whose score changed,
+             without scoring them all again, given the JSON file of the
+             scores as they were (in the same form as
+             qa.resource_format_openness_scores_json). The datasets affected
+             are reindexed. Resources in formats that have been added to or
+             removed from the scores, or scored 0, are queued for QA.
+
+        paster qa sniff-cache [stats|prune|clear]
+           - Show how much the sniff cache is being used (default), evict
+             old entries from it, or empty it
+
+        paster qa search-index [stats|flush|watch]
+           - When qa.search_index.defer is set, datasets QA'd on the bulk
+             queue are queued to be search indexed in batches. Show the
+             queue (default), index everything queued, or keep indexing
+             what is queued whenever there is a batch of it
+             (qa.search_index.batch_size) or it has been queued for
+             qa.search_index.flush_interval seconds
 
         paster qa view [dataset name/id]
            - See package score information
@@ -61,6 +191,28 @@ class QACommand(p.toolkit.CkanCommand):
                                action='store',
                                dest='queue',
                                help='Send to a particular queue')
+        self.parser.add_option('-w', '--workers',
+                               action='store',
+                               dest='workers',
+                               type='int',
+                               default=1,
+                               help='Number of processes to sniff with')
+        self.parser.add_option('--trace',
+                               action='store_true',
+                               dest='trace',
+                               default=False,
+                               help='Show the time taken by each detector')
+        self.parser.add_option('--sniff',
+                               action='store_true',
+                               dest='sniff',
+                               default=False,
+                               help='Sniff the archived files when rescoring')
+        self.parser.add_option('--force',
+                               action='store_true',
+                               dest='force',
+                               default=False,
+                               help='QA resources even if they have not '
+                               'changed since they were last scored')
 
     def command(self):
         """
@@ -81,6 +233,16 @@ class QACommand(p.toolkit.CkanCommand):
             self.update()
         elif cmd == 'sniff':
             self.sniff()
+        elif cmd == 'sniffd':
+            self.sniffd()
+        elif cmd == 'rescore-offline':
+            self.rescore_offline()
+        elif cmd == 'rescore-formats':
+            self.rescore_formats()
+        elif cmd == 'sniff-cache':
+            self.sniff_cache()
+        elif cmd == 'search-index':
+            self.search_index()
         elif cmd == 'view':
             if len(self.args) == 2:
                 self.view(self.args[1])
@@ -164,7 +326,8 @@ class QACommand(p.toolkit.CkanCommand):
 
         self.log.info('Queue: %s', self.options.queue)
         for package in packages:
-            lib.create_qa_update_package_task(package, self.options.queue)
+            lib.create_qa_update_package_task(package, self.options.queue,
+                                              force=self.options.force)
             self.log.info('Queuing dataset %s (%s resources)',
                           package.name, len(package.resources))
 
@@ -176,19 +339,197 @@ class QACommand(p.toolkit.CkanCommand):
         self.log.info('Completed queueing')
 
     def sniff(self):
-        from ckanext.qa.sniff_format import sniff_file_format
-
         if len(self.args) < 2:
             print 'Not enough arguments', self.args
             sys.exit(1)
-        for filepath in self.args[1:]:
-            format_ = sniff_file_format(
-                filepath, logging.getLogger('ckanext.qa.sniffer'))
-            if format_:
-                print 'Detected as: %s - %s' % (format_['display_name'],
-                                                filepath)
-            else:
-                print 'ERROR: Could not recognise format of: %s' % filepath
+        filepaths = iter_filepaths(self.args[1:])
+        workers = self.options.workers
+        sniff = functools.partial(sniff_for_command, trace=self.options.trace)
+        start = time.time()
+        num_files = num_detected = num_errors = 0
+        if workers > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(workers)
+            results = pool.imap_unordered(sniff, filepaths, chunksize=16)
+        else:
+            pool = None
+            results = (sniff(filepath) for filepath in filepaths)
+        try:
+            for result in results:
+                print json.dumps(result)
+                sys.stdout.flush()
+                num_files += 1
+                if result['format']:
+                    num_detected += 1
+                if result.get('error'):
+                    num_errors += 1
+        except KeyboardInterrupt:
+            if pool:
+                pool.terminate()
+            raise
+        if pool:
+            pool.close()
+            pool.join()
+        elapsed = time.time() - start
+        print >> sys.stderr, \
+            'Sniffed %i files in %.1fs (%.1f files/s) with %i worker(s): ' \
+            '%i detected, %i not recognized, %i errors' % \
+            (num_files, elapsed, num_files / elapsed if elapsed else 0,
+             workers, num_detected, num_files - num_detected - num_errors,
+             num_errors)
+
+    def rescore_offline(self):
+        if len(self.args) < 2:
+            print 'Not enough arguments', self.args
+            sys.exit(1)
+        input_file = sys.stdin if self.args[1] == '-' \
+            else open(self.args[1], 'rb')
+        lines = (line for line in input_file if line.strip())
+        workers = self.options.workers
+        rescore = functools.partial(rescore_for_command,
+                                    sniff=self.options.sniff)
+        start = time.time()
+        num_resources = num_errors = 0
+        if workers > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(workers)
+            results = pool.imap(rescore, lines, chunksize=256)
+        else:
+            pool = None
+            results = (rescore(line) for line in lines)
+        try:
+            for result in results:
+                print json.dumps(result)
+                num_resources += 1
+                if result.get('error'):
+                    num_errors += 1
+        except KeyboardInterrupt:
+            if pool:
+                pool.terminate()
+            raise
+        if pool:
+            pool.close()
+            pool.join()
+        sys.stdout.flush()
+        elapsed = time.time() - start
+        print >> sys.stderr, \
+            'Scored %i resources in %.1fs (%.1f resources/s) with %i ' \
+            'worker(s): %i errors' % \
+            (num_resources, elapsed,
+             num_resources / elapsed if elapsed else 0, workers, num_errors)
+
+    def rescore_formats(self):
+        from ckanext.qa import lib
+        from ckanext.qa.model import QA, SearchIndexQueue
+        from ckanext.qa.tasks import rescore_formats, flush_search_index_queue
+        if len(self.args) < 2:
+            print 'Not enough arguments', self.args
+            sys.exit(1)
+        old_scores = lib.load_resource_format_scores(self.args[1])
+        new_scores = lib.resource_format_scores()
+        if old_scores == new_scores:
+            print 'The scores have not changed'
+            return
+
+        package_ids, formats_to_requalify = rescore_formats(
+            old_scores, new_scores, self.log)
+        for package_id in package_ids:
+            SearchIndexQueue.add(package_id)
+        model.Session.commit()
+        print 'Rescored resources in %i datasets' % len(package_ids)
+        num_indexed = flush_search_index_queue(self.log)
+        print 'Search indexed %i datasets' % num_indexed
+
+        if formats_to_requalify:
+            package_ids = [row[0] for row in
+                           model.Session.query(QA.package_id)
+                           .filter(QA.format.in_(formats_to_requalify))
+                           .distinct()]
+            for package_id in package_ids:
+                package = model.Package.get(package_id)
+                if package:
+                    lib.create_qa_update_package_task(package, 'bulk',
+                                                      force=True)
+            print 'Formats added or removed: %s - queued QA of %i ' \
+                'datasets' % (', '.join(formats_to_requalify),
+                              len(package_ids))
+
+    def sniffd(self):
+        from pylons import config
+        from ckanext.qa.sniff_daemon import serve, SniffDaemonError
+
+        if len(self.args) == 2:
+            socket_path = self.args[1]
+        elif len(self.args) == 1:
+            socket_path = config.get('qa.sniffd_socket')
+            if not socket_path:
+                print 'No socket path given and qa.sniffd_socket not set'
+                sys.exit(1)
+        else:
+            print 'Wrong number of arguments (%i)' % len(self.args)
+            sys.exit(1)
+        try:
+            serve(socket_path, max(self.options.workers, 1))
+        except SniffDaemonError, e:
+            print e
+            sys.exit(1)
+
+    def sniff_cache(self):
+        from pylons import config
+        from ckan import model
+        from ckanext.qa.model import SniffCache
+        from ckanext.qa.sniff_format import DETECTOR_VERSION
+
+        subcmd = self.args[1] if len(self.args) > 1 else 'stats'
+        if subcmd == 'stats':
+            stats = SniffCache.stats()
+            print 'Sniff cache entries: %i (detector version now %s)' % \
+                (stats['entries'], DETECTOR_VERSION)
+            print 'Sniffs saved by the cache: %i' % stats['hits']
+        elif subcmd == 'prune':
+            max_age_days = config.get('qa.sniff_cache.max_age_days', 90)
+            max_entries = config.get('qa.sniff_cache.max_entries', 100000)
+            num_deleted = SniffCache.prune(
+                max_age_days=int(max_age_days) if max_age_days else None,
+                max_entries=int(max_entries) if max_entries else None)
+            model.Session.commit()
+            print 'Evicted %i entries from the sniff cache' % num_deleted
+        elif subcmd == 'clear':
+            num_deleted = model.Session.query(SniffCache).delete()
+            model.Session.commit()
+            print 'Deleted all %i entries from the sniff cache' % num_deleted
+        else:
+            print 'sniff-cache command not recognized: %s' % subcmd
+            sys.exit(1)
+
+    def search_index(self):
+        from pylons import config
+        from ckanext.qa.model import SearchIndexQueue
+        from ckanext.qa.tasks import (flush_search_index_queue,
+                                      get_search_index_batch_size,
+                                      is_search_index_flush_due)
+
+        subcmd = self.args[1] if len(self.args) > 1 else 'stats'
+        if subcmd == 'stats':
+            stats = SearchIndexQueue.stats()
+            print 'Datasets queued for search indexing: %i' % \
+                stats['datasets']
+            if stats['oldest']:
+                print 'Queued longest: since %s' % stats['oldest']
+        elif subcmd == 'flush':
+            num_indexed = flush_search_index_queue(self.log)
+            print 'Search indexed %i datasets' % num_indexed
+        elif subcmd == 'watch':
+            interval = int(config.get('qa.search_index.flush_interval', 60))
+            batch_size = get_search_index_batch_size()
+            while True:
+                if is_search_index_flush_due(batch_size, interval):
+                    flush_search_index_queue(self.log)
+                model.Session.commit()
+                time.sleep(min(interval, SEARCH_INDEX_POLL_INTERVAL))
+        else:
+            print 'search-index command not recognized: %s' % subcmd
+            sys.exit(1)
 
     def view(self, package_ref=None):
         from ckan import model
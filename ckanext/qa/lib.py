@@ -1,18 +1,106 @@
 import os
 import json
+import hashlib
 import re
+import time
 import logging
 
 from pylons import config
 
 from ckan import plugins as p
+import ckan.lib.helpers as ckan_helpers
 from ckan.lib.celery_app import celery
 from ckan.model.types import make_uuid
 
 
 log = logging.getLogger(__name__)
 
-_RESOURCE_FORMAT_SCORES = None
+# The current FormatIndex. It is replaced (rather than changed) when the scores
+# file changes, so a reference to it is always consistent.
+_FORMAT_INDEX = None
+
+# How often to check whether the scores file has changed (seconds)
+FORMAT_INDEX_CHECK_INTERVAL = 1.0
+
+
+class FormatIndex(object):
+    '''Looks up a resource format, by any of the extensions, mimetypes and
+    titles that CKAN knows it by (as in ckan's resource_formats.json), to get
+    its canonical short name and its openness score, with a single dict
+    lookup.'''
+    # Most keys that are looked up but not known to memoise
+    MAX_MEMOISED = 10000
+
+    def __init__(self, resource_formats, scores, source=None):
+        '''
+        resource_formats - dict as returned by ckan's resource_formats()
+        scores - dict of format short name: score
+        source - identifies the version of the scores, e.g. (filepath, mtime)
+        '''
+        self.scores = scores
+        self.scores_hash = resource_format_scores_hash(scores)
+        self.source = source
+        self.checked = time.time()
+        self._index = {}
+        for key, format_tuple in resource_formats.items():
+            format_ = format_tuple[1]
+            self._index[key.lower()] = (format_, scores.get(format_))
+        self._memo = {}
+        self._munged_memo = {}
+
+    def get(self, key, munge=False):
+        '''Returns (format, score) for the given extension, mimetype or title
+        (in any case), or None if it is not known. score is None if the format
+        has no score.
+
+        With munge, it is also tried munged to be canonical (see
+        munge_format_to_be_canonical), as a fall-back.'''
+        memo = self._munged_memo if munge else self._memo
+        try:
+            return memo[key]
+        except KeyError:
+            pass
+        entry = self._index.get(key.lower())
+        if entry is None and munge:
+            entry = self._index.get(munge_format_to_be_canonical(key))
+        if len(memo) < self.MAX_MEMOISED:
+            memo[key] = entry
+        return entry
+
+
+def resource_format_scores_filepath():
+    '''Returns the path of the JSON file of resource format scores.'''
+    json_filepath = config.get('qa.resource_format_openness_scores_json')
+    if not json_filepath:
+        import ckanext.qa.plugin
+        json_filepath = os.path.join(
+            os.path.dirname(os.path.realpath(ckanext.qa.plugin.__file__)),
+            'resource_format_openness_scores.json'
+        )
+    return json_filepath
+
+
+def format_index():
+    '''Returns the FormatIndex for the resource format scores. It is rebuilt
+    when the scores file changes (checking at most once a second).'''
+    global _FORMAT_INDEX
+    index = _FORMAT_INDEX
+    if index is not None and \
+            time.time() - index.checked < FORMAT_INDEX_CHECK_INTERVAL:
+        return index
+    json_filepath = resource_format_scores_filepath()
+    source = (json_filepath, os.path.getmtime(json_filepath))
+    if index is not None and index.source == source:
+        index.checked = time.time()
+        return index
+    if index is not None:
+        log.info('Resource format scores have changed - reloading them: %s',
+                 json_filepath)
+    index = FormatIndex(ckan_helpers.resource_formats(),
+                        load_resource_format_scores(json_filepath),
+                        source=source)
+    _FORMAT_INDEX = index
+    return index
 
 
 def resource_format_scores():
@@ -27,39 +115,46 @@ def resource_format_scores():
 
     Fuller description of the fields are described in
     `ckan/config/resource_formats.json`.
+
+    The scores are reloaded if the file is changed.
     '''
-    global _RESOURCE_FORMAT_SCORES
-    if not _RESOURCE_FORMAT_SCORES:
-        _RESOURCE_FORMAT_SCORES = {}
-        json_filepath = config.get('qa.resource_format_openness_scores_json')
-        import ckanext.qa.plugin
-        if not json_filepath:
-            json_filepath = os.path.join(
-                os.path.dirname(os.path.realpath(ckanext.qa.plugin.__file__)),
-                'resource_format_openness_scores.json'
-            )
-        with open(json_filepath) as format_file:
-            try:
-                file_resource_formats = json.loads(format_file.read())
-            except ValueError, e:
-                # includes simplejson.decoder.JSONDecodeError
-                raise ValueError('Invalid JSON syntax in %s: %s' %
-                                 (json_filepath, e))
-
-            for format_line in file_resource_formats:
-                if format_line[0] == '_comment':
-                    continue
-                format_, score = format_line
-                if not isinstance(score, int):
-                    raise ValueError('Score must be integer in %s: %s: %r'
-                                     % json_filepath, format_, score)
-                if format_ in _RESOURCE_FORMAT_SCORES:
-                    raise ValueError('Duplicate resource format '
-                                     'identifier in %s: %s' %
-                                     (json_filepath, format_))
-                _RESOURCE_FORMAT_SCORES[format_] = score
-
-    return _RESOURCE_FORMAT_SCORES
+    return format_index().scores
+
+
+def load_resource_format_scores(json_filepath):
+    '''Returns the resource format scores in the given JSON file, as a dict
+    keyed by format shortname.'''
+    scores = {}
+    with open(json_filepath) as format_file:
+        try:
+            file_resource_formats = json.loads(format_file.read())
+        except ValueError, e:
+            # includes simplejson.decoder.JSONDecodeError
+            raise ValueError('Invalid JSON syntax in %s: %s' %
+                             (json_filepath, e))
+
+        for format_line in file_resource_formats:
+            if format_line[0] == '_comment':
+                continue
+            format_, score = format_line
+            if not isinstance(score, int):
+                raise ValueError('Score must be integer in %s: %s: %r'
+                                 % json_filepath, format_, score)
+            if format_ in scores:
+                raise ValueError('Duplicate resource format '
+                                 'identifier in %s: %s' %
+                                 (json_filepath, format_))
+            scores[format_] = score
+    return scores
+
+
+def resource_format_scores_hash(scores=None):
+    '''Returns a hash of the resource format scores (by default, the ones
+    configured), which changes when the scores are changed.'''
+    if scores is None:
+        return format_index().scores_hash
+    return unicode(hashlib.sha1(json.dumps(sorted(scores.items())))
+                   .hexdigest())
 
 
 def munge_format_to_be_canonical(format_name):
@@ -72,12 +167,28 @@ def munge_format_to_be_canonical(format_name):
     return re.sub('[^a-z/+]', '', format_name)
 
 
-def create_qa_update_package_task(package, queue):
+def is_search_index_deferred(queue):
+    '''Returns whether QA done on the given celery queue should leave the
+    dataset to be indexed later, in a batch (qa.search_index.defer = true).
+    The priority queue is always indexed straight away.'''
+    from pylons import config
+    return queue != 'priority' and \
+        p.toolkit.asbool(config.get('qa.search_index.defer', False))
+
+
+def create_qa_update_package_task(package, queue, force=False):
+    '''Puts a QA of the package on the queue. Resources whose inputs have not
+    changed since they were last scored are skipped, unless force is set.'''
     from pylons import config
     task_id = '%s-%s' % (package.name, make_uuid()[:4])
     ckan_ini_filepath = os.path.abspath(config.__file__)
+    kwargs = {}
+    if force:
+        kwargs['force'] = True
+    if is_search_index_deferred(queue):
+        kwargs['defer_index'] = True
     celery.send_task('qa.update_package', args=[ckan_ini_filepath, package.id],
-                     task_id=task_id, queue=queue)
+                     kwargs=kwargs, task_id=task_id, queue=queue)
     log.debug('QA of package put into celery queue %s: %s',
               queue, package.name)
 
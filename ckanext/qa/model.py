@@ -27,13 +27,19 @@ class QA(Base):
 
     id = Column(types.UnicodeText, primary_key=True, default=make_uuid)
     package_id = Column(types.UnicodeText, nullable=False, index=True)
-    resource_id = Column(types.UnicodeText, nullable=False, index=True)
+    resource_id = Column(types.UnicodeText, nullable=False, index=True,
+                         unique=True)
     resource_timestamp = Column(types.DateTime)  # key to resource_revision
     archival_timestamp = Column(types.DateTime)
 
     openness_score = Column(types.Integer)
     openness_score_reason = Column(types.UnicodeText)
     format = Column(types.UnicodeText)
+    # hash of the things the score was based on, so that scoring can be
+    # skipped when they have not changed
+    inputs_hash = Column(types.UnicodeText)
+    # hash of the table of format scores it was based on
+    scores_hash = Column(types.UnicodeText, index=True)
 
     created = Column(types.DateTime, default=datetime.datetime.now)
     updated = Column(types.DateTime, default=datetime.datetime.now)
@@ -69,9 +75,47 @@ class QA(Base):
             .all()
 
     @classmethod
-    def create(cls, resource_id):
+    def upsert(cls, rows):
+        '''Saves QA rows, given as dicts of column values including
+        resource_id. Where there is already a row for the resource it is
+        updated, otherwise one is inserted. Does not commit.'''
+        if not rows:
+            return
+        if supports_upsert(model.Session.get_bind()):
+            # one statement, and safe from other workers inserting a row for
+            # the same resource at the same time
+            columns = ['id', 'created'] + sorted(rows[0].keys())
+            sql = 'INSERT INTO qa (%s) VALUES (%s) ' \
+                'ON CONFLICT (resource_id) DO UPDATE SET %s' % (
+                    ', '.join(columns),
+                    ', '.join(':%s' % column for column in columns),
+                    ', '.join('%s = excluded.%s' % (column, column)
+                              for column in columns
+                              if column not in ('id', 'created',
+                                                'resource_id')))
+            now = datetime.datetime.now()
+            params = [dict(row, id=make_uuid(), created=now) for row in rows]
+            model.Session.execute(sql, params)
+            return
+        existing = dict(
+            (qa.resource_id, qa) for qa in model.Session.query(cls)
+            .filter(cls.resource_id.in_([row['resource_id'] for row in rows])))
+        for row in rows:
+            qa = existing.get(row['resource_id'])
+            if not qa:
+                qa = cls.create(row['resource_id'],
+                                package_id=row.get('package_id'))
+                model.Session.add(qa)
+            for key, value in row.items():
+                setattr(qa, key, value)
+
+    @classmethod
+    def create(cls, resource_id, package_id=None):
         c = cls()
         c.resource_id = resource_id
+        if package_id:
+            c.package_id = package_id
+            return c
 
         # Find the package_id for the resource.
         q = model.Session.query(model.Package.id)
@@ -86,6 +130,201 @@ class QA(Base):
         return c
 
 
+class SniffCache(Base):
+    """
+    Caches the result of sniffing a file's format, keyed by the hash of the
+    file's contents (as recorded by the archiver) and the version of the
+    detectors that did the sniffing. Archived files are often identical
+    across resources and between archival runs, so this saves sniffing them
+    again.
+    """
+    __tablename__ = 'qa_sniff_cache'
+
+    content_hash = Column(types.UnicodeText, primary_key=True)
+    detector_version = Column(types.UnicodeText, primary_key=True)
+
+    format = Column(types.UnicodeText)  # None if it was not recognized
+    container = Column(types.UnicodeText)
+
+    hit_count = Column(types.Integer, default=0, nullable=False)
+    created = Column(types.DateTime, default=datetime.datetime.now)
+    last_used = Column(types.DateTime, default=datetime.datetime.now,
+                       index=True)
+
+    def __repr__(self):
+        return '<SniffCache %s v%s format=%s container=%s hits=%s>' % \
+            (self.content_hash, self.detector_version, self.format,
+             self.container, self.hit_count)
+
+    def as_format_dict(self):
+        '''Returns the cached result in the form that sniff_file_format
+        returns it.'''
+        if not self.format:
+            return None
+        format_ = {'format': self.format}
+        if self.container:
+            format_['container'] = self.container
+        return format_
+
+    def record_hit(self):
+        self.hit_count = (self.hit_count or 0) + 1
+        self.last_used = datetime.datetime.now()
+
+    @classmethod
+    def get(cls, content_hash, detector_version):
+        return model.Session.query(cls) \
+            .filter(cls.content_hash == content_hash) \
+            .filter(cls.detector_version == unicode(detector_version)) \
+            .first()
+
+    @classmethod
+    def create(cls, content_hash, detector_version, format_):
+        '''Returns a new cache entry for the given sniff_file_format result
+        (which may be None). It needs adding to the Session.'''
+        c = cls()
+        c.content_hash = content_hash
+        c.detector_version = unicode(detector_version)
+        c.format = format_['format'] if format_ else None
+        c.container = format_.get('container') if format_ else None
+        c.hit_count = 0
+        return c
+
+    @classmethod
+    def prune(cls, max_age_days=None, max_entries=None):
+        '''Evicts entries which have not been used for max_age_days, and
+        then the least recently used entries beyond max_entries. Returns the
+        number of entries deleted. Does not commit.'''
+        from sqlalchemy import and_, or_
+        num_deleted = 0
+        if max_age_days is not None:
+            cutoff = datetime.datetime.now() - \
+                datetime.timedelta(days=max_age_days)
+            num_deleted += model.Session.query(cls) \
+                .filter(cls.last_used < cutoff) \
+                .delete(synchronize_session=False)
+        if max_entries is not None:
+            # entries used at the same time are ordered by their key, so
+            # that exactly max_entries are kept
+            newest_evicted = model.Session.query(
+                cls.last_used, cls.content_hash, cls.detector_version) \
+                .filter(cls.last_used != None) \
+                .order_by(cls.last_used.desc(), cls.content_hash.desc(),
+                          cls.detector_version.desc()) \
+                .offset(max_entries) \
+                .first()
+            if newest_evicted:
+                last_used, content_hash, detector_version = newest_evicted
+                num_deleted += model.Session.query(cls) \
+                    .filter(or_(
+                        cls.last_used < last_used,
+                        and_(cls.last_used == last_used,
+                             cls.content_hash < content_hash),
+                        and_(cls.last_used == last_used,
+                             cls.content_hash == content_hash,
+                             cls.detector_version <= detector_version))) \
+                    .delete(synchronize_session=False)
+        return num_deleted
+
+    @classmethod
+    def stats(cls):
+        '''Returns a dict summarizing the cache's usage.'''
+        from sqlalchemy import func
+        entries, hits = model.Session.query(
+            func.count(cls.content_hash), func.sum(cls.hit_count)).one()
+        return {'entries': entries or 0, 'hits': int(hits or 0)}
+
+
+class SearchIndexQueue(Base):
+    """
+    Datasets whose QA has changed and which are waiting to be updated in the
+    search index, when the indexing is deferred. A dataset may be queued more
+    than once before it is indexed, but is only indexed once.
+
+    Whatever indexes a batch of them claims its rows first, so that two
+    doing so at the same time don't index the same datasets.
+    """
+    __tablename__ = 'qa_search_index_queue'
+
+    id = Column(types.Integer, primary_key=True)
+    package_id = Column(types.UnicodeText, nullable=False, index=True)
+    queued = Column(types.DateTime, default=datetime.datetime.now,
+                    nullable=False)
+    claimed_by = Column(types.UnicodeText, index=True)
+    claimed_at = Column(types.DateTime)
+
+    def __repr__(self):
+        return '<SearchIndexQueue %s queued=%s>' % (self.package_id,
+                                                    self.queued)
+
+    @classmethod
+    def add(cls, package_id):
+        '''Queues the dataset for indexing. It needs committing.'''
+        c = cls()
+        c.package_id = package_id
+        c.queued = datetime.datetime.now()
+        model.Session.add(c)
+        return c
+
+    @classmethod
+    def next_batch(cls, batch_size):
+        '''Returns the ids of the datasets queued longest, up to batch_size
+        of them.'''
+        from sqlalchemy import func
+        q = model.Session.query(cls.package_id) \
+            .group_by(cls.package_id) \
+            .order_by(func.min(cls.queued)) \
+            .limit(batch_size)
+        return [row[0] for row in q]
+
+    @classmethod
+    def claim_batch(cls, batch_size, claimant, stale_before):
+        '''Claims the rows of the datasets queued longest, up to batch_size
+        of them, that are not claimed already (or were claimed before
+        stale_before, by something that must have died). Returns the ids of
+        the datasets claimed. It commits, so that the claim is seen by
+        others.'''
+        from sqlalchemy import func, or_
+        unclaimed = or_(cls.claimed_by == None,
+                        cls.claimed_at < stale_before)
+        package_ids = [row[0] for row in model.Session.query(cls.package_id)
+                       .filter(unclaimed)
+                       .group_by(cls.package_id)
+                       .order_by(func.min(cls.queued))
+                       .limit(batch_size)]
+        if not package_ids:
+            return []
+        # Another claiming them at the same time waits for this to commit,
+        # and then doesn't find them unclaimed
+        model.Session.query(cls) \
+            .filter(cls.package_id.in_(package_ids)) \
+            .filter(unclaimed) \
+            .update({cls.claimed_by: claimant,
+                     cls.claimed_at: datetime.datetime.now()},
+                    synchronize_session=False)
+        model.Session.commit()
+        return [row[0] for row in model.Session.query(cls.package_id)
+                .filter(cls.claimed_by == claimant)
+                .distinct()]
+
+    @classmethod
+    def remove(cls, claimant):
+        '''Takes the rows claimed by the claimant off the queue. (Datasets
+        queued again since they were claimed stay queued.) Does not commit.
+        '''
+        return model.Session.query(cls) \
+            .filter(cls.claimed_by == claimant) \
+            .delete(synchronize_session=False)
+
+    @classmethod
+    def stats(cls):
+        '''Returns a dict summarizing the queue.'''
+        from sqlalchemy import func
+        datasets, oldest = model.Session.query(
+            func.count(func.distinct(cls.package_id)),
+            func.min(cls.queued)).one()
+        return {'datasets': datasets or 0, 'oldest': oldest}
+
+
 def aggregate_qa_for_a_dataset(qa_objs):
     '''Returns aggregated archival info for a dataset, given the archivals for
     its resources (returned by get_for_package).
@@ -115,6 +354,70 @@ def aggregate_qa_for_a_dataset(qa_objs):
     return qa_dict
 
 
+def supports_upsert(engine):
+    '''Returns whether the database can do INSERT ... ON CONFLICT DO
+    UPDATE.'''
+    dialect = engine.dialect
+    if dialect.name == 'postgresql':
+        return (dialect.server_version_info or ()) >= (9, 5)
+    if dialect.name == 'sqlite':
+        return dialect.dbapi.sqlite_version_info >= (3, 24)
+    return False
+
+
 def init_tables(engine):
     Base.metadata.create_all(engine)
+    add_missing_columns(engine)
+    make_resource_id_unique(engine)
     log.info('QA database tables are set-up')
+
+
+def add_missing_columns(engine):
+    '''Adds columns that have been added to the qa tables since they were
+    created.'''
+    from sqlalchemy.engine.reflection import Inspector
+    columns = [column['name'] for column in
+               Inspector.from_engine(engine).get_columns('qa')]
+    if 'inputs_hash' not in columns:
+        engine.execute('ALTER TABLE qa ADD COLUMN inputs_hash TEXT')
+        log.info('Added column qa.inputs_hash')
+    if 'scores_hash' not in columns:
+        engine.execute('ALTER TABLE qa ADD COLUMN scores_hash TEXT')
+        engine.execute('CREATE INDEX ix_qa_scores_hash ON qa (scores_hash)')
+        log.info('Added column qa.scores_hash')
+    columns = [column['name'] for column in Inspector.from_engine(engine)
+               .get_columns('qa_search_index_queue')]
+    if 'claimed_by' not in columns:
+        engine.execute('ALTER TABLE qa_search_index_queue '
+                       'ADD COLUMN claimed_by TEXT')
+        engine.execute('ALTER TABLE qa_search_index_queue '
+                       'ADD COLUMN claimed_at TIMESTAMP')
+        engine.execute('CREATE INDEX ix_qa_search_index_queue_claimed_by '
+                       'ON qa_search_index_queue (claimed_by)')
+        log.info('Added columns qa_search_index_queue.claimed_by/claimed_at')
+
+
+def make_resource_id_unique(engine):
+    '''Makes the index on qa.resource_id unique, if it was created before it
+    was, removing any duplicate rows for a resource (keeping the newest).'''
+    from sqlalchemy.engine.reflection import Inspector
+    indexes = Inspector.from_engine(engine).get_indexes('qa')
+    if [index for index in indexes
+            if index['column_names'] == ['resource_id'] and index['unique']]:
+        return
+    num_deleted = engine.execute(
+        'DELETE FROM qa WHERE id IN ('
+        'SELECT older.id FROM qa older JOIN qa newer '
+        'ON older.resource_id = newer.resource_id '
+        'AND (older.updated < newer.updated OR '
+        '(older.updated IS NULL AND newer.updated IS NOT NULL) OR '
+        '((older.updated = newer.updated OR '
+        '(older.updated IS NULL AND newer.updated IS NULL)) '
+        'AND older.id < newer.id)))').rowcount
+    if num_deleted:
+        log.info('Deleted %i duplicate QA rows', num_deleted)
+    for index in indexes:
+        if index['column_names'] == ['resource_id']:
+            engine.execute('DROP INDEX %s' % index['name'])
+    engine.execute('CREATE UNIQUE INDEX ix_qa_resource_id ON qa (resource_id)')
+    log.info('Made qa.resource_id unique')
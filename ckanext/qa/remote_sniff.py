@@ -0,0 +1,189 @@
+'''
+Sniffing the format of a remote file, without downloading all of it.
+
+The start of the file is fetched with an HTTP Range request and given to the
+usual detectors. Any other parts of the file they read (e.g. the central
+directory at the end of a zip, or the directory of an Excel file) are fetched
+with further Range requests, as they are read.
+'''
+import os
+import re
+
+import requests
+
+from ckanext.qa.sniff_format import (SniffContext, SniffBudget,
+                                     sniff_context_format_within_budget)
+
+CONTENT_RANGE_RE = re.compile(r'bytes (\d+)-(\d+)/(\d+)')
+# Ranges are of the bytes of the file as it is, not compressed for sending
+HEADERS = {'Accept-Encoding': 'identity'}
+
+
+class RemoteSniffError(Exception):
+    pass
+
+
+def get_remote_sniff_config():
+    '''Returns the remote sniff options, from the config:
+
+    qa.remote_sniff.head_bytes - how much to fetch to start with (64KB)
+    qa.remote_sniff.max_bytes - most to fetch in total, per file (1MB)
+    qa.remote_sniff.timeout - for each HTTP request, in seconds (10)
+    qa.remote_sniff.pool_size - HTTP connections kept per host (4)
+    '''
+    from pylons import config
+    return {
+        'head_bytes': int(config.get('qa.remote_sniff.head_bytes',
+                                     64 * 1024)),
+        'max_bytes': int(config.get('qa.remote_sniff.max_bytes',
+                                    1024 * 1024)),
+        'timeout': float(config.get('qa.remote_sniff.timeout', 10)),
+        'pool_size': int(config.get('qa.remote_sniff.pool_size', 4)),
+        }
+
+_session = None
+
+
+def get_session(pool_size):
+    '''Returns this process\'s requests session, so that connections to the
+    same host are kept open and reused between sniffs.'''
+    global _session
+    if _session is None or _session.pid != os.getpid():
+        # (after a fork, the parent's connections are not ours)
+        _session = requests.Session()
+        _session.pid = os.getpid()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                                pool_maxsize=pool_size)
+        _session.mount('http://', adapter)
+        _session.mount('https://', adapter)
+    return _session
+
+
+def fetch_head(session, url, num_bytes, timeout):
+    '''Fetches the first num_bytes of the file at the url. Returns (data,
+    size), where size is the size of the whole file, or None if the server
+    does not do Range requests (in which case only the first num_bytes of the
+    response are read).'''
+    headers = dict(HEADERS, Range='bytes=0-%d' % (num_bytes - 1))
+    response = session.get(url, headers=headers, stream=True,
+                           timeout=timeout)
+    try:
+        if response.status_code == 206:
+            match = CONTENT_RANGE_RE.match(
+                response.headers.get('Content-Range', ''))
+            if not match:
+                raise RemoteSniffError('Bad Content-Range: %r' %
+                                       response.headers.get('Content-Range'))
+            return response.raw.read(num_bytes), int(match.group(3))
+        if response.status_code == 416:
+            # Range not satisfiable i.e. the file is empty
+            return '', 0
+        response.raise_for_status()
+        data = response.raw.read(num_bytes)
+        return data, None
+    finally:
+        response.close()
+
+
+class RangeRequestFile(object):
+    '''A read-only, seekable file-like object for a remote file, that fetches
+    the parts of it that are read with HTTP Range requests. Blocks that have
+    been fetched are kept, so reading the same part again doesn't fetch it
+    again.'''
+    block_size = 64 * 1024
+
+    def __init__(self, session, url, size, head, timeout):
+        self.session = session
+        self.url = url
+        self.size = size
+        self.timeout = timeout
+        self.pos = 0
+        self.bytes_fetched = 0
+        self._blocks = {}
+        for i in range(len(head) // self.block_size):
+            self._blocks[i] = head[i * self.block_size:
+                                   (i + 1) * self.block_size]
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += self.size
+        self.pos = max(offset, 0)
+
+    def tell(self):
+        return self.pos
+
+    def read(self, size=-1):
+        end = self.size if size is None or size < 0 else \
+            min(self.pos + size, self.size)
+        if end <= self.pos:
+            return ''
+        first_block = self.pos // self.block_size
+        last_block = (end - 1) // self.block_size
+        missing = [i for i in range(first_block, last_block + 1)
+                   if i not in self._blocks]
+        if missing:
+            self._fetch_blocks(missing[0], missing[-1])
+        data = ''.join(self._blocks[i]
+                       for i in range(first_block, last_block + 1))
+        start = self.pos - first_block * self.block_size
+        data = data[start:start + end - self.pos]
+        self.pos = end
+        return data
+
+    def _fetch_blocks(self, first_block, last_block):
+        '''Fetches the blocks in one request.'''
+        start = first_block * self.block_size
+        end = min((last_block + 1) * self.block_size, self.size) - 1
+        headers = dict(HEADERS, Range='bytes=%d-%d' % (start, end))
+        response = self.session.get(self.url, headers=headers,
+                                    timeout=self.timeout)
+        if response.status_code != 206:
+            raise RemoteSniffError('Range request for bytes %s-%s got status '
+                                   '%s' % (start, end, response.status_code))
+        data = response.content
+        if len(data) != end - start + 1:
+            raise RemoteSniffError('Range request for bytes %s-%s got %s '
+                                   'bytes' % (start, end, len(data)))
+        self.bytes_fetched += len(data)
+        for i in range(first_block, last_block + 1):
+            offset = (i - first_block) * self.block_size
+            self._blocks[i] = data[offset:offset + self.block_size]
+
+    def close(self):
+        self._blocks = {}
+
+
+def sniff_url_format(url, log):
+    '''Works out the file format of a remote file, fetching only the parts of
+    it the detectors need, with HTTP Range requests.
+
+    Returns a format dict like sniff_file_format, or None if it can't tell or
+    couldn't fetch it.
+    '''
+    log.info('Sniffing file format of URL: %s', url)
+    options = get_remote_sniff_config()
+    session = get_session(options['pool_size'])
+    budget = SniffBudget.from_config()
+    # the head is fetched anyway, so this is what more can be fetched
+    budget.max_bytes = max(options['max_bytes'] - options['head_bytes'], 0)
+    try:
+        head, size = fetch_head(session, url, options['head_bytes'],
+                                options['timeout'])
+        if size is None:
+            log.info('Server does not do Range requests, so sniffing just '
+                     'the first %s bytes', len(head))
+        if size is None or size <= len(head):
+            remote_file = None
+        else:
+            remote_file = RangeRequestFile(session, url, size, head,
+                                           options['timeout'])
+        with SniffContext(url, data=head, fileobj=remote_file, size=size,
+                          budget=budget, log=log) as ctx:
+            return sniff_context_format_within_budget(ctx, log)
+    except (requests.exceptions.RequestException, RemoteSniffError,
+            EnvironmentError), e:
+        log.warning('Could not sniff remote file %s: %s %s', url,
+                    e.__class__.__name__, e)
+        return None
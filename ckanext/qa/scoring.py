@@ -0,0 +1,307 @@
+'''
+Scores a resource on Sir Tim Berners-Lee\'s five stars of openness, given
+plain dicts of the resource and its archival, rather than database objects.
+This lets resources be scored outside of a CKAN worker, such as by
+"paster qa rescore-offline". tasks.resource_score uses it for the resources in
+CKAN.
+
+The resource dict has keys:
+
+    id, url, format - of the resource
+    license_id - of its dataset (None if there is none)
+    qa_format - the format recorded by its last QA, if any
+
+and the archival dict (None if it has not been archived):
+
+    updated, last_success, first_failure - datetimes or None
+    is_broken - True/False, or None if it is not known
+    status, reason - of the last archival attempt (strings)
+    failure_count - consecutive failures
+    cache_filepath - where the archiver kept the file, if it did
+'''
+import datetime
+import hashlib
+import json
+import traceback
+
+from ckanext.qa import lib
+from ckanext.qa.sniff_format import DETECTOR_VERSION
+
+# Reasons are stored untranslated
+_ = lambda value: value
+
+ARCHIVAL_FIELDS = ('updated', 'last_success', 'first_failure', 'is_broken',
+                   'status', 'reason', 'failure_count', 'cache_filepath')
+ARCHIVAL_TIMESTAMP_FIELDS = ('updated', 'last_success', 'first_failure')
+# How the reasons for scores looked up in the table of format scores end.
+# tasks.rescore_formats rewrites these endings when a score is changed.
+OPENNESS_SCORE_ENDING = ' receives openness score: %s.'
+SCORE_ENDING = ' receives score: %s.'
+SCORE_ENDINGS = (OPENNESS_SCORE_ENDING, SCORE_ENDING)
+
+
+def score_resource(resource, archival, log, sniff=None, sniffing=False):
+    '''
+    Scores a resource, given as dicts (see the module docstring).
+
+    sniff - a function(score_reasons) which looks at the file\'s contents and
+            returns (score, format_), or None not to look at them
+    sniffing - the setting for sniffing that the result is hashed with (the
+               same for all resources, whether or not this one is sniffed)
+
+    Returns a dict with keys:
+
+        'openness_score': score (int)
+        'openness_score_reason': the reason for the score (string)
+        'format': format of the data (string)
+        'archival_timestamp': time of the archival that this result is based on (iso string)
+        'inputs_hash': hash of the things that this result is based on,
+                       other than the table of scores (string)
+        'scores_hash': hash of the table of scores it is based on (string)
+    '''
+    score = 0
+    score_reason = ''
+    format_ = None
+
+    try:
+        score_reasons = []  # a list of strings detailing how we scored it
+
+        score, format_ = score_if_link_broken(archival, resource, score_reasons, log)
+        if score == None:
+            # we don't want to take the publisher's word for it, in case the link
+            # is only to a landing page, so highest priority is the sniffed type
+            if sniff:
+                score, format_ = sniff(score_reasons)
+            if score == None:
+                # Fall-backs are user-given data
+                score, format_ = score_by_url_extension(resource, score_reasons, log)
+                if score == None:
+                    score, format_ = score_by_format_field(resource, score_reasons, log)
+                    if score == None:
+                        log.warning('Could not score resource: "%s" with url: "%s"',
+                                    resource['id'], resource['url'])
+                        score_reasons.append(_('Could not understand the file format, therefore score is 1.'))
+                        score = 1
+                        if format_ == None:
+                            # use any previously stored format value for this resource
+                            format_ = resource.get('qa_format')
+        score_reason = ' '.join(score_reasons)
+        format_ = format_ or None
+    except Exception, e:
+        log.error('Unexpected error while calculating openness score %s: %s\nException: %s', e.__class__.__name__,  unicode(e), traceback.format_exc())
+        score_reason = _("Unknown error: %s") % str(e)
+        raise
+
+    # Even if we can get the link, we should still treat the resource
+    # as having a score of 0 if the license isn't open.
+    #
+    # It is important we do this check after the link check, otherwise
+    # the link checker won't get the chance to see if the resource
+    # is broken.
+    if score > 0 and not resource.get('license_id'):
+        score_reason = _('License not open')
+        score = 0
+
+    log.info('Score: %s Reason: %s', score, score_reason)
+
+    archival_updated = archival['updated'].isoformat() \
+        if archival and archival.get('updated') else None
+    result = {
+        'openness_score': score,
+        'openness_score_reason': score_reason,
+        'format': format_,
+        'archival_timestamp': archival_updated,
+        'inputs_hash': inputs_hash(resource, archival, sniffing),
+        'scores_hash': lib.resource_format_scores_hash(),
+    }
+    return result
+
+
+def inputs_hash(resource, archival, sniffing):
+    '''Returns a hash of the things that the resource's score is based on,
+    apart from the table of scores (which has its own hash, so that
+    rescore_formats can update it without looking at the rest): its
+    archival, URL and format field, the dataset's licence, whether the
+    contents are sniffed and the version of the sniffing.'''
+    inputs = [
+        archival['updated'].isoformat() if archival and archival.get('updated')
+        else None,
+        resource['url'],
+        resource['format'],
+        resource.get('license_id'),
+        DETECTOR_VERSION,
+        sniffing,
+        ]
+    return unicode(hashlib.sha1(json.dumps(inputs)).hexdigest())
+
+
+def parse_timestamp(timestamp):
+    '''Returns the datetime for an isoformat timestamp (or datetime or
+    None).'''
+    if not timestamp or isinstance(timestamp, datetime.datetime):
+        return timestamp
+    if '.' in timestamp:
+        return datetime.datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S.%f')
+    return datetime.datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S')
+
+
+def archival_from_json(archival):
+    '''Returns the archival dict for one read from JSON, with its timestamps
+    (isoformat strings) as datetimes.'''
+    if not archival:
+        return None
+    archival = dict(archival)
+    for key in ARCHIVAL_TIMESTAMP_FIELDS:
+        archival[key] = parse_timestamp(archival.get(key))
+    return archival
+
+
+def format_get(key):
+    '''Returns a resource format, as defined in ckan.
+
+    :param key: format extension / mimetype / title e.g. 'CSV',
+                'application/msword', 'Word document'
+    :param key: string
+    :returns: format string
+    '''
+    entry = lib.format_index().get(key)
+    if not entry:
+        return
+    return entry[0]  # short name
+
+
+def broken_link_error_message(archival):
+    '''Given an archival for a broken link, it returns a helpful
+    error message (string) describing the attempts.'''
+    def format_date(date):
+        if date:
+            return date.strftime('%d/%m/%Y')
+        else:
+            return ''
+    messages = [_('File could not be downloaded.'),
+                _('Reason') + ':', unicode(archival['status']) + '.',
+                _('Error details: %s.') % archival['reason'],
+                _('Attempted on %s.') % format_date(archival['updated'])]
+    last_success = format_date(archival['last_success'])
+    if archival['failure_count'] == 1:
+        if last_success:
+            messages.append(_('This URL last worked on: %s.') % last_success)
+        else:
+            messages.append(_('This was the first attempt.'))
+    else:
+        messages.append(_('Tried %s times since %s.') % \
+                        (archival['failure_count'],
+                         format_date(archival['first_failure'])))
+        if last_success:
+            messages.append(_('This URL last worked on: %s.') % last_success)
+        else:
+            messages.append(_('This URL has not worked in the history of this tool.'))
+    return ' '.join(messages)
+
+
+def score_if_link_broken(archival, resource, score_reasons, log):
+    '''
+    Looks to see if the archiver said it was broken, and if so, writes to
+    the score_reasons and returns a score.
+
+    Return values:
+      * Returns a tuple: (score, format_)
+      * score is an integer or None if it cannot be determined
+      * format_ is a string or None
+      * is_broken is a boolean
+    '''
+    if archival and archival.get('is_broken'):
+        # Score 0 since we are sure the link is currently broken
+        score_reasons.append(broken_link_error_message(archival))
+        format_ = resource.get('qa_format')
+        log.info('Archiver says link is broken. Previous format: %r' % format_)
+        return (0, format_)
+    return (None, None)
+
+
+def score_sniffed_format(sniffed_format, score_reasons):
+    '''Returns (score, format_string) for a sniff_file_format result,
+    adding to score_reasons how it came to the conclusion.'''
+    score = lib.resource_format_scores().get(sniffed_format['format']) \
+        if sniffed_format else None
+    if sniffed_format:
+        score_reasons.append((_('Content of file appeared to be format "%s" which') + OPENNESS_SCORE_ENDING) % (sniffed_format['format'], score))
+        return score, sniffed_format['format']
+    else:
+        score_reasons.append(_('The format of the file was not recognized from its contents.'))
+        return (None, None)
+
+
+def score_by_url_extension(resource, score_reasons, log):
+    '''
+    Looks at the URL for a resource to determine its format and score.
+
+    It adds strings to score_reasons list about how it came to the conclusion.
+
+    Return values:
+      * It returns a tuple: (score, format_string)
+      * If it cannot work out the format then format is None
+      * If it cannot score it, then score is None
+    '''
+    extension_variants_ = extension_variants((resource['url'] or '').strip())
+    if not extension_variants_:
+        score_reasons.append(_('Could not determine a file extension in the URL.'))
+        return (None, None)
+    index = lib.format_index()
+    for extension in extension_variants_:
+        entry = index.get(extension)
+        if entry:
+            format_, score = entry
+            if score:
+                score_reasons.append((_('URL extension "%s" relates to format "%s" and') + SCORE_ENDING) % (extension, format_, score))
+                return score, format_
+            else:
+                score = 1
+                score_reasons.append(_('URL extension "%s" relates to format "%s" but a score for that format is not configured, so giving it default score %s.') % (extension, format_, score))
+                return score, format_
+        score_reasons.append(_('URL extension "%s" is an unknown format.') % extension)
+    return (None, None)
+
+def extension_variants(url):
+    '''
+    Returns a list of extensions, in order of which would more
+    significant.
+
+    >>> extension_variants('http://dept.gov.uk/coins.data.1996.csv.zip')
+    ['csv.zip', 'zip']
+    >>> extension_variants('http://dept.gov.uk/data.csv?callback=1')
+    ['csv']
+    '''
+    url = url.split('?')[0] # get rid of params
+    url = url.split('/')[-1] # get rid of path - leaves filename
+    split_url = url.split('.')
+    results = []
+    for number_of_sections in [2, 1]:
+        if len(split_url) > number_of_sections:
+            results.append('.'.join(split_url[-number_of_sections:]))
+    return results
+
+
+def score_by_format_field(resource, score_reasons, log):
+    '''
+    Looks at the format field of a resource to determine its format and score.
+
+    It adds strings to score_reasons list about how it came to the conclusion.
+
+    Return values:
+      * It returns a tuple: (score, format_string)
+      * If it cannot work out the format then format_string is None
+      * If it cannot score it, then score is None
+    '''
+    format_field = resource['format'] or ''
+    if not format_field:
+        score_reasons.append(_('Format field is blank.'))
+        return (None, None)
+    entry = lib.format_index().get(format_field, munge=True)
+    if not entry:
+        score_reasons.append(_('Format field "%s" does not correspond to a known format.') % format_field)
+        return (None, None)
+    format_, score = entry
+    score_reasons.append((_('Format field "%s"') + SCORE_ENDING) %
+                         (format_field, score))
+    return (score, format_)
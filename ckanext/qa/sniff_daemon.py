@@ -0,0 +1,196 @@
+'''
+A daemon that sniffs file formats for other processes, over a Unix socket.
+
+Otherwise each process that sniffs files has to load libmagic's database,
+xlrd etc and start its own "file" processes. Instead,
+"paster qa sniffd" starts worker processes that are kept ready to sniff, and
+sniff_file_format sends them the filepaths to sniff, when config option
+qa.sniffd_socket is set.
+
+The protocol is a line of JSON for each request and each response:
+
+    request:  {"paths": ["/path/to/file1.csv", "/path/to/file2", ...]}
+    response: {"results": [{"format": {"format": "CSV"}},
+                           {"format": null, "error": "IOError: ..."}, ...]}
+'''
+import errno
+import json
+import logging
+import os
+import signal
+import socket
+import SocketServer
+
+log = logging.getLogger(__name__)
+
+
+class SniffDaemonError(Exception):
+    pass
+
+
+def sniff_one(filepath):
+    '''Sniffs a file for a request, returning its result dict.'''
+    from ckanext.qa.sniff_format import sniff_file_format_locally
+    try:
+        return {'format': sniff_file_format_locally(filepath, log)}
+    except Exception, e:
+        log.exception('Error sniffing %s', filepath)
+        return {'format': None, 'error': '%s: %s' % (e.__class__.__name__, e)}
+
+
+# How often (in files sniffed) a worker logs the time its detectors take
+LOG_TIMINGS_EVERY = 1000
+_files_sniffed = 0
+
+
+def log_timings_every(num_files):
+    '''Logs the detector timings of this worker each LOG_TIMINGS_EVERY files
+    it sniffs.'''
+    global _files_sniffed
+    from ckanext.qa.sniff_format import log_detector_timings
+    before = _files_sniffed
+    _files_sniffed += num_files
+    if before // LOG_TIMINGS_EVERY != _files_sniffed // LOG_TIMINGS_EVERY:
+        log_detector_timings(log)
+
+
+class SniffRequestHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            try:
+                paths = json.loads(line)['paths']
+                if not isinstance(paths, list):
+                    raise TypeError('paths is not a list')
+            except (ValueError, KeyError, TypeError), e:
+                response = {'error': 'Bad request: %s' % e}
+            else:
+                response = {'results': [sniff_one(path) for path in paths]}
+                log_timings_every(len(paths))
+            self.wfile.write(json.dumps(response) + '\n')
+            self.wfile.flush()
+
+
+class SniffServer(SocketServer.UnixStreamServer):
+    '''Listens on the Unix socket. Several worker processes can serve it at
+    once, each accepting connections on the same socket.'''
+    def __init__(self, socket_path):
+        remove_stale_socket(socket_path)
+        SocketServer.UnixStreamServer.__init__(self, socket_path,
+                                               SniffRequestHandler)
+        # the users of the socket (e.g. celery workers) may be in the group
+        os.chmod(socket_path, 0660)
+
+
+def remove_stale_socket(socket_path):
+    '''Removes the socket file left by a daemon that is no longer running.
+    Raises SniffDaemonError if a daemon is running on it.'''
+    if not os.path.exists(socket_path):
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except socket.error:
+        os.remove(socket_path)
+    else:
+        raise SniffDaemonError('A sniff daemon is already running on %s'
+                               % socket_path)
+    finally:
+        sock.close()
+
+
+def warm_up():
+    '''Loads what the detectors need, before the workers are forked, so that
+    they share it and are ready to go.'''
+    import magic
+    from ckanext.qa import sniff_format
+    magic.from_buffer('a,b,c\n1,2,3\n', mime=True)
+
+
+def serve(socket_path, num_workers):
+    '''Runs the daemon, until it gets SIGTERM or SIGINT. A worker process that
+    dies is replaced.'''
+    server = SniffServer(socket_path)
+    warm_up()
+    log.info('Sniff daemon listening on %s with %s worker(s)', socket_path,
+             num_workers)
+    workers = set()
+    stopping = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    try:
+        while not stopping:
+            while len(workers) < num_workers:
+                pid = os.fork()
+                if pid == 0:
+                    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                    signal.signal(signal.SIGINT, signal.SIG_DFL)
+                    try:
+                        server.serve_forever()
+                    finally:
+                        os._exit(0)
+                workers.add(pid)
+            try:
+                pid, status = os.wait()
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            workers.discard(pid)
+            if not stopping:
+                log.warning('Sniff daemon worker %s ended (status %s) - '
+                            'starting another', pid, status)
+        for pid in list(workers):
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        log.info('Sniff daemon stopped')
+
+
+def sniff_via_daemon(filepaths, socket_path, timeout=None):
+    '''Asks the daemon to sniff the files. Returns a list of format dicts
+    (or None), one for each filepath.
+
+    Raises SniffDaemonError if the daemon can't be reached or it could not
+    sniff one of the files.'''
+    request = {'paths': [os.path.abspath(filepath) for filepath in filepaths]}
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        try:
+            sock.connect(socket_path)
+            sock.sendall(json.dumps(request) + '\n')
+            response_file = sock.makefile('rb')
+            line = response_file.readline()
+            response_file.close()
+        except socket.error, e:
+            raise SniffDaemonError('Could not talk to sniff daemon on %s: %s'
+                                   % (socket_path, e))
+    finally:
+        sock.close()
+    try:
+        response = json.loads(line)
+    except ValueError:
+        raise SniffDaemonError('Bad response from sniff daemon: %r'
+                               % line[:200])
+    if 'error' in response:
+        raise SniffDaemonError(response['error'])
+    formats = []
+    for filepath, result in zip(filepaths, response['results']):
+        if result.get('error'):
+            raise SniffDaemonError('Sniff daemon error for %s: %s'
+                                   % (filepath, result['error']))
+        formats.append(result['format'])
+    return formats
@@ -1,19 +1,467 @@
 import re
-import zipfile
 import os
-from collections import defaultdict
+import mmap
+from collections import defaultdict, Counter
 import subprocess
 import StringIO
+import struct
+import zlib
+import bisect
+import bz2
+import codecs
+import threading
+import Queue
+import atexit
+import time
+import signal
+import logging
+from contextlib import contextmanager
 
 import xlrd
+try:
+    import lzma
+except ImportError:
+    try:
+        # Python 2 needs the backports.lzma package for XZ
+        from backports import lzma
+    except ImportError:
+        lzma = None
 import magic
-import messytables
 
 from ckanext.qa import lib
+from ckanext.qa import sniff_registry
+from ckanext.qa.sniff_registry import (
+    register_detector, NO_MIMETYPE, COST_HEAD_START, COST_HEAD,
+    COST_DIRECTORY, COST_PARSE, COST_PROCESS)
 from ckan.lib import helpers as ckan_helpers
 
 
-def sniff_file_format(filepath, log):
+# Increase this whenever a change to the detectors may change the format
+# detected for a file, so that results cached by a previous version of the
+# detectors (see ckanext.qa.model.SniffCache) are no longer used.
+DETECTOR_VERSION = 12
+
+# The first part of a file is read just once and shared by all the detectors.
+# 1MB is also the amount that libmagic reads when given a filepath.
+SNIFF_HEAD_SIZE = 1024 * 1024
+
+# Number of times (in this process) that a detector has been stopped, or
+# skipped, because the sniff ran out of time or bytes, by detector name.
+budget_overruns = defaultdict(int)
+
+
+class DetectorTimings(object):
+    '''A histogram of the time taken by a detector, and the bytes it read.'''
+    # the upper bounds of the buckets, in milliseconds
+    BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000,
+                  30000, 60000)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS_MS) + 1)
+        self.calls = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.bytes_read = 0
+
+    def add(self, seconds, bytes_read):
+        self.counts[bisect.bisect_left(self.BUCKETS_MS, seconds * 1000)] += 1
+        self.calls += 1
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.bytes_read += bytes_read
+
+    def percentile_ms(self, percent):
+        '''Returns the upper bound (in milliseconds) of the bucket that the
+        percentile falls in (or the longest time, for the last bucket).'''
+        rank = max(percent / 100.0 * self.calls, 1)
+        count = 0
+        for i, bucket_count in enumerate(self.counts):
+            count += bucket_count
+            if count >= rank:
+                if i < len(self.BUCKETS_MS):
+                    return self.BUCKETS_MS[i]
+                break
+        return self.max_seconds * 1000
+
+    def __str__(self):
+        return '%s calls, %.2fs total, p50 <%gms, p99 <%gms, max %.0fms, ' \
+            '%s bytes read' % (self.calls, self.total_seconds,
+                               self.percentile_ms(50), self.percentile_ms(99),
+                               self.max_seconds * 1000, self.bytes_read)
+
+# Histograms of the time taken by each detector (in this process), by name
+detector_timings = defaultdict(DetectorTimings)
+
+# Functions called after each sniff as hook(filepath, trace), where trace is
+# the list of detectors run - see SniffBudget.trace
+sniff_trace_hooks = []
+
+
+class SniffBudgetExceeded(Exception):
+    '''Raised in a detector when the sniff has run out of time, or it has
+    read more of the file than is allowed.'''
+    pass
+
+
+class SniffTimeout(SniffBudgetExceeded):
+    pass
+
+
+class SniffBudget(object):
+    '''Limits on the time taken by a sniff and the number of bytes that
+    detectors read from the file (on top of the head, which is read anyway),
+    both for the whole sniff and for each detector. None means no limit.
+
+    A detector that runs out of time is stopped with SIGALRM, if the sniff is
+    running in the main thread. Otherwise (e.g. in a thread) it can't be
+    stopped, but further detectors are skipped once the time is up.
+    '''
+    def __init__(self, seconds=None, detector_seconds=None, max_bytes=None,
+                 detector_max_bytes=None):
+        self.seconds = seconds
+        self.detector_seconds = detector_seconds
+        self.max_bytes = max_bytes
+        self.detector_max_bytes = detector_max_bytes
+        self.start_time = time.time()
+        self.bytes_read = 0
+        # whether any detector was stopped or skipped
+        self.truncated = False
+        self._detector_bytes_read = 0
+        self._running_detector = None
+        self._depth = 0
+        # the detectors run, in the order they finished, as dicts with:
+        # detector (name), seconds, bytes_read and depth (0 unless run by
+        # another detector)
+        self.trace = []
+
+    @classmethod
+    def from_config(cls):
+        '''Returns a budget with the limits from the config (0 for no
+        limit):
+
+        qa.sniff_timeout (seconds, default 60)
+        qa.sniff_detector_timeout (seconds, default 20)
+        qa.sniff_max_bytes (default 256MB)
+        qa.sniff_detector_max_bytes (default 128MB)
+        '''
+        from pylons import config
+
+        def get(key, default, type_):
+            return type_(config.get(key, default)) or None
+        return cls(
+            seconds=get('qa.sniff_timeout', 60, float),
+            detector_seconds=get('qa.sniff_detector_timeout', 20, float),
+            max_bytes=get('qa.sniff_max_bytes', 256 * 1024 * 1024, int),
+            detector_max_bytes=get('qa.sniff_detector_max_bytes',
+                                   128 * 1024 * 1024, int),
+            )
+
+    def time_left(self):
+        if self.seconds is None:
+            return None
+        return self.start_time + self.seconds - time.time()
+
+    def count_bytes(self, num_bytes):
+        '''Records that the running detector is reading num_bytes of the
+        file. Raises SniffBudgetExceeded if that is more than it is allowed.
+        '''
+        self.bytes_read += num_bytes
+        self._detector_bytes_read += num_bytes
+        if self.max_bytes is not None and self.bytes_read > self.max_bytes:
+            raise SniffBudgetExceeded('Sniff read more than %s bytes'
+                                      % self.max_bytes)
+        if self.detector_max_bytes is not None and \
+                self._detector_bytes_read > self.detector_max_bytes:
+            raise SniffBudgetExceeded('Detector read more than %s bytes'
+                                      % self.detector_max_bytes)
+
+    def run(self, log, detector, *args):
+        '''Runs detector(*args) within the budget and returns its result, or
+        None if it ran out of time or bytes, or there was no time left to run
+        it.'''
+        name = detector.__name__
+        if self._running_detector:
+            # a detector running other detectors (e.g. on the decompressed
+            # data), which is all part of the first detector's budget
+            start = time.time()
+            bytes_read = self.bytes_read
+            self._depth += 1
+            try:
+                return detector(*args)
+            finally:
+                self._depth -= 1
+                self.record(name, time.time() - start,
+                            self.bytes_read - bytes_read)
+        timeout = self.detector_seconds
+        time_left = self.time_left()
+        if time_left is not None:
+            if time_left <= 0:
+                self.overrun(name, 'no time left for it', log)
+                return None
+            timeout = min(timeout, time_left) if timeout else time_left
+        self._running_detector = name
+        self._detector_bytes_read = 0
+        start = time.time()
+        stopped = False
+        try:
+            with _alarm(timeout):
+                return detector(*args)
+        except SniffBudgetExceeded, e:
+            stopped = True
+            self.overrun(name, e, log)
+            return None
+        finally:
+            self._running_detector = None
+            elapsed = time.time() - start
+            self.record(name, elapsed, self._detector_bytes_read)
+            if timeout is not None and elapsed > timeout and not stopped:
+                # it couldn't be stopped (or it caught the SniffTimeout), but
+                # count it
+                self.overrun(name, 'took %.1fs' % elapsed, log)
+
+    def record(self, name, seconds, bytes_read):
+        '''Records that a detector ran, in the trace and detector_timings.'''
+        depth = self._depth + (1 if self._running_detector else 0)
+        self.trace.append({'detector': name, 'seconds': seconds,
+                           'bytes_read': bytes_read, 'depth': depth})
+        detector_timings[name].add(seconds, bytes_read)
+
+    def overrun(self, name, reason, log):
+        self.truncated = True
+        budget_overruns[name] += 1
+        log.warning('Sniff budget exceeded by detector %s: %s', name, reason)
+
+
+def _raise_sniff_timeout(signum, frame):
+    raise SniffTimeout('Ran out of time')
+
+
+@contextmanager
+def _alarm(seconds):
+    '''Raises SniffTimeout in the code in this context, if it runs for longer
+    than the given seconds. It does nothing unless the alarm signal can be
+    used i.e. in the main thread on a Unix-like OS.'''
+    if not seconds or not hasattr(signal, 'setitimer') or \
+            not isinstance(threading.current_thread(), threading._MainThread):
+        yield
+        return
+    previous_handler = signal.signal(signal.SIGALRM, _raise_sniff_timeout)
+    previous_timer = signal.setitimer(signal.ITIMER_REAL, seconds)
+    start = time.time()
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)
+        if previous_timer[0]:
+            # restore someone else's alarm
+            signal.setitimer(signal.ITIMER_REAL, max(
+                previous_timer[0] - (time.time() - start), 0.001))
+
+
+class SniffContext(object):
+    '''The contents of a file being sniffed, read once and shared between all
+    the detectors, rather than each detector opening and reading the file
+    itself.
+
+    Files no bigger than SNIFF_HEAD_SIZE are read into memory in a single read.
+    Bigger files are memory-mapped, so that xlrd only pages in the parts of
+    the file it actually looks at, and the same open file is used by the
+    detectors which need to seek around the file (e.g. zip).
+
+    Use it as a context manager, so that the file is closed afterwards::
+
+        with SniffContext(filepath) as ctx:
+            buf = ctx.head(5000)
+
+    If data is given then that is sniffed instead of the file, e.g. the start
+    of the file once decompressed, and the filepath is just for reference.
+    If a fileobj (and its size) is given too, then data is just the start of
+    the file, and the rest of it is read from the fileobj when needed (e.g. a
+    remote file, fetched as it is read).
+
+    Detectors are run with run(), within the time and bytes of the budget
+    (a SniffBudget), if one is given.
+    '''
+    def __init__(self, filepath, data=None, budget=None, log=None,
+                 fileobj=None, size=None):
+        self.filepath = filepath
+        self.budget = budget or SniffBudget()
+        self.log = log or logging.getLogger(__name__)
+        self._file = None
+        self._mmap = None
+        self._text = {}
+        # for detectors to store things worked out about the file, that other
+        # detectors might need too
+        self.cache = {}
+        self.is_file_data = data is None
+        if data is not None:
+            self._head = data
+            self.size = len(data)
+            if fileobj is not None:
+                self._file = fileobj
+                self.size = size
+            return
+        self._file = open(filepath, 'rb')
+        self.size = os.fstat(self._file.fileno()).st_size
+        if self.size > SNIFF_HEAD_SIZE:
+            try:
+                self._mmap = mmap.mmap(self._file.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
+            except (mmap.error, EnvironmentError, ValueError):
+                self._mmap = None
+        if self._mmap is not None:
+            self._head = self._mmap[:SNIFF_HEAD_SIZE]
+        else:
+            self._head = self._file.read(SNIFF_HEAD_SIZE)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    @property
+    def is_whole_file_in_memory(self):
+        return len(self._head) >= self.size
+
+    def head(self, num_bytes=None):
+        '''Returns (up to) the first num_bytes of the file, as a string.'''
+        if num_bytes is None or num_bytes >= len(self._head):
+            return self._head
+        return self._head[:num_bytes]
+
+    def text(self, num_bytes):
+        '''Returns the first num_bytes of the file with the line endings
+        normalized to \\n, as you would get from reading it with mode 'rU'.
+        '''
+        if num_bytes not in self._text:
+            self._text[num_bytes] = self.head(num_bytes) \
+                .replace('\r\n', '\n').replace('\r', '\n')
+        return self._text[num_bytes]
+
+    def run(self, detector, *args):
+        '''Runs the detector function with the given args, within the budget.
+        Returns its result, or None if it ran out of budget.'''
+        return self.budget.run(self.log, detector, *args)
+
+    def count_rest_of_file(self):
+        '''For a detector that is about to read the whole file (in a way that
+        isn't counted already), count it against the budget, raising
+        SniffBudgetExceeded if it is too big.'''
+        if not self.is_whole_file_in_memory:
+            self.budget.count_bytes(self.size - len(self._head))
+
+    def read_at(self, offset, num_bytes):
+        '''Returns num_bytes of the file from the given offset (or fewer at
+        the end of the file).'''
+        if offset + num_bytes <= len(self._head) or \
+                self.is_whole_file_in_memory:
+            return self._head[offset:offset + num_bytes]
+        self.budget.count_bytes(num_bytes)
+        if self._mmap is not None:
+            return self._mmap[offset:offset + num_bytes]
+        self._file.seek(offset)
+        return self._file.read(num_bytes)
+
+    def fileobj(self):
+        '''Returns a seekable file-like object for the whole file, positioned
+        at the start, for detectors that need more than the head of it.'''
+        if self.is_whole_file_in_memory:
+            return StringIO.StringIO(self._head)
+        self._file.seek(0)
+        return BudgetedFile(self._file, self.budget)
+
+    def contents(self):
+        '''Returns the whole file, for libraries that accept the file
+        contents: as a string, or if it is not all in memory, a
+        BudgetedBuffer of the mmap, so that only what they read of it is
+        counted. Returns None if neither is available.'''
+        if self.is_whole_file_in_memory:
+            return self._head
+        if self._mmap is not None:
+            return BudgetedBuffer(self._mmap, len(self._head), self.budget)
+
+    def mimetype(self):
+        '''Returns the mimetype that libmagic gives for the file.'''
+        if 'mimetype' not in self.cache:
+            self.cache['mimetype'] = self._mimetype()
+        return self.cache['mimetype']
+
+    def _mimetype(self):
+        mime_type = magic.from_buffer(self._head, mime=True)
+        if not self.is_whole_file_in_memory and \
+                mime_type in MAGIC_NEEDS_WHOLE_FILE:
+            # e.g. libmagic follows the directory of an MS Office (CDF) file
+            # to wherever it is in the file, so give it the whole file
+            if self.is_file_data:
+                mime_type = self.run(self._mimetype_of_whole_file) or \
+                    mime_type
+        return mime_type
+
+    def _mimetype_of_whole_file(self):
+        # libmagic only reads the parts it needs (e.g. a compound document's
+        # directory), within its own limits, so this isn't counted as
+        # reading the whole file
+        filepath_utf8 = self.filepath.encode('utf8') \
+            if isinstance(self.filepath, unicode) else self.filepath
+        return magic.from_file(filepath_utf8, mime=True)
+
+class BudgetedFile(object):
+    '''Wraps a file object, counting the bytes read from it against a
+    SniffBudget.'''
+    def __init__(self, file_, budget):
+        self._file = file_
+        self._budget = budget
+
+    def read(self, size=-1):
+        data = self._file.read(size)
+        self._budget.count_bytes(len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
+class BudgetedBuffer(object):
+    '''Wraps the contents of a file (e.g. an mmap), counting the bytes
+    sliced from it beyond the head (which is read anyway) against a
+    SniffBudget.'''
+    def __init__(self, contents, head_size, budget):
+        self._contents = contents
+        self._head_size = head_size
+        self._budget = budget
+
+    def __len__(self):
+        return len(self._contents)
+
+    def __getitem__(self, key):
+        data = self._contents[key]
+        if isinstance(key, slice):
+            start = key.indices(len(self._contents))[0]
+            self._budget.count_bytes(
+                len(data) - max(min(self._head_size - start, len(data)), 0))
+        elif key >= self._head_size:
+            self._budget.count_bytes(1)
+        return data
+
+# Mimetypes that libmagic may give for just the head of a large file, when it
+# would give something more specific were it able to read the whole file.
+MAGIC_NEEDS_WHOLE_FILE = set(('application/octet-stream',
+                              'application/CDFV2',
+                              'application/CDFV2-corrupt',
+                              ))
+
+
+def sniff_file_format(filepath, log, trace=None):
     '''For a given filepath, work out what file format it is.
 
     Returns a dict with format as a string, which is the format's canonical
@@ -25,226 +473,480 @@ def sniff_file_format(filepath, log):
           }
     or None if it can\'t tell what it is.
 
+    If the sniff runs out of time or bytes (see SniffBudget) then it returns
+    what the detectors found in the budget, with 'sniff_truncated': True.
+
     Note, log is a logger, either a Celery one or a standard Python logging
     one.
+
+    If config option qa.sniffd_socket is set, then the file is sniffed by the
+    sniff daemon (see ckanext.qa.sniff_daemon), or if that fails, here.
+
+    If a list is given as trace, then the detectors run are added to it (see
+    SniffBudget.trace), and the file is always sniffed here.
     '''
-    format_ = None
+    from pylons import config
+    socket_path = config.get('qa.sniffd_socket')
+    if socket_path and trace is None:
+        from ckanext.qa.sniff_daemon import sniff_via_daemon, SniffDaemonError
+        timeout = float(config.get('qa.sniffd_timeout', 120))
+        try:
+            format_ = sniff_via_daemon([filepath], socket_path, timeout)[0]
+        except SniffDaemonError, e:
+            log.warning('Sniffing here instead, since: %s', e)
+        else:
+            log.info('Sniff daemon detected format of %s: %r', filepath,
+                     format_)
+            return format_
+    return sniff_file_format_locally(filepath, log, trace)
+
+
+def sniff_file_format_locally(filepath, log, trace=None):
+    '''Works out the file format in this process - see sniff_file_format.'''
     log.info('Sniffing file format of: %s', filepath)
-    filepath_utf8 = filepath.encode('utf8') if isinstance(filepath, unicode) \
-        else filepath
-    mime_type = magic.from_file(filepath_utf8, mime=True)
-    log.info('Magic detects file as: %s', mime_type)
-    if mime_type:
-        if mime_type == 'application/xml':
-            with open(filepath) as f:
-                buf = f.read(5000)
-            format_ = get_xml_variant_including_xml_declaration(buf, log)
-        elif mime_type == 'application/zip':
-            format_ = get_zipped_format(filepath, log)
-        elif mime_type in ('application/msword', 'application/vnd.ms-office'):
-            # In the past Magic gives the msword mime-type for Word and other
-            # MS Office files too, so use BSD File to be sure which it is.
-            format_ = run_bsd_file(filepath, log)
-            if not format_ and is_excel(filepath, log):
-                format_ = {'format': 'XLS'}
-        elif mime_type == 'application/octet-stream':
-            # Excel files sometimes come up as this
-            if is_excel(filepath, log):
-                format_ = {'format': 'XLS'}
-            else:
-                # e.g. Shapefile
-                format_ = run_bsd_file(filepath, log)
-            if not format_:
-                with open(filepath) as f:
-                    buf = f.read(500)
-                format_ = is_html(buf, log)
-        elif mime_type == 'text/html':
-            # Magic can mistake IATI for HTML
-            with open(filepath) as f:
-                buf = f.read(100)
-            if is_iati(buf, log):
-                format_ = {'format': 'IATI'}
+    with SniffContext(filepath, budget=SniffBudget.from_config(),
+                      log=log) as ctx:
+        try:
+            return sniff_context_format_within_budget(ctx, log)
+        finally:
+            if trace is not None:
+                trace.extend(ctx.budget.trace)
+
 
+def sniff_context_format_within_budget(ctx, log):
+    '''Works out the file format of the data in a SniffContext, like
+    sniff_context_format, but if it ran out of budget then the format dict
+    has 'sniff_truncated': True.
+
+    Afterwards, the sniff_trace_hooks are called.'''
+    try:
+        format_ = sniff_context_format(ctx, log)
+    finally:
+        call_sniff_trace_hooks(ctx, log)
+    if ctx.budget.truncated:
+        log.warning('Sniff of %s was cut short, so detected format %r may '
+                    'be less specific', ctx.filepath, format_)
         if format_:
-            return format_
+            format_ = dict(format_, sniff_truncated=True)
+    if not format_:
+        log.warning('Could not detect format of file: %s', ctx.filepath)
+    return format_
 
-        format_tuple = ckan_helpers.resource_formats().get(mime_type)
-        if format_tuple:
-            format_ = {'format': format_tuple[1]}
 
-        if not format_:
-            if mime_type.startswith('text/'):
-                # is it JSON?
-                with open(filepath, 'rU') as f:
-                    buf = f.read(10000)
-                if is_json(buf, log):
-                    format_ = {'format': 'JSON'}
-                # is it CSV?
-                elif is_csv(buf, log):
-                    format_ = {'format': 'CSV'}
-                elif is_psv(buf, log):
-                    format_ = {'format': 'PSV'}
+def call_sniff_trace_hooks(ctx, log):
+    for hook in sniff_trace_hooks:
+        try:
+            hook(ctx.filepath, ctx.budget.trace)
+        except Exception:
+            log.exception('Sniff trace hook %r failed', hook)
 
-        if not format_:
-            log.warning('Mimetype not recognised by CKAN as a data format: %s',
-                        mime_type)
 
-        if format_:
-            log.info('Mimetype translates to filetype: %s',
-                     format_['format'])
-
-            if format_['format'] == 'TXT':
-                # is it JSON?
-                with open(filepath, 'rU') as f:
-                    buf = f.read(10000)
-                if is_json(buf, log):
-                    format_ = {'format': 'JSON'}
-                # is it CSV?
-                elif is_csv(buf, log):
-                    format_ = {'format': 'CSV'}
-                elif is_psv(buf, log):
-                    format_ = {'format': 'PSV'}
-                # XML files without the "<?xml ... ?>" tag end up here
-                elif is_xml_but_without_declaration(buf, log):
-                    format_ = get_xml_variant_without_xml_declaration(buf, log)
-                elif is_ttl(buf, log):
-                    format_ = {'format': 'TTL'}
-
-            elif format_['format'] == 'HTML':
-                # maybe it has RDFa in it
-                with open(filepath) as f:
-                    buf = f.read(100000)
-                if has_rdfa(buf, log):
-                    format_ = {'format': 'RDFa'}
+def log_detector_timings(log, max_detectors=5):
+    '''Logs the detectors that have taken the most time in this process.'''
+    if not detector_timings:
+        return
+    timings = sorted(detector_timings.items(),
+                     key=lambda item: -item[1].total_seconds)
+    log.info('Sniff detector timings (this process so far): %s',
+             '; '.join('%s: %s' % item for item in timings[:max_detectors]))
 
-    else:
-        # Excel files sometimes not picked up by magic, so try alternative
-        if is_excel(filepath, log):
-            format_ = {'format': 'XLS'}
-        # BSD file picks up some files that Magic misses
-        # e.g. some MS Word files
-        if not format_:
-            format_ = run_bsd_file(filepath, log)
 
+def sniff_context_format(ctx, log):
+    '''Work out the file format of the data in a SniffContext. Returns a
+    format dict or None - see sniff_file_format.
+
+    The detectors that apply to the file's mimetype are run in turn (see
+    ckanext.qa.sniff_registry), and failing that the format is the one CKAN
+    has for the mimetype.'''
+    start = time.time()
+    bytes_read = ctx.budget.bytes_read
+    mime_type = ctx.mimetype() or None
+    ctx.budget.record('magic', time.time() - start,
+                      ctx.budget.bytes_read - bytes_read)
+    log.info('Magic detects file as: %s', mime_type)
+    mimetype_format = None
+    if mime_type:
+        entry = lib.format_index().get(mime_type)
+        if entry:
+            mimetype_format = entry[0]
+            log.info('Mimetype translates to filetype: %s', mimetype_format)
+    format_ = sniff_registry.registry.detect(ctx, mime_type, mimetype_format,
+                                             log)
+    if format_:
+        return format_
+    if mimetype_format:
+        return {'format': mimetype_format}
+    if mime_type:
+        log.warning('Mimetype not recognised by CKAN as a data format: %s',
+                    mime_type)
+    return None
+
+# The mimetypes libmagic gives compressed files, and the container that
+# sniff_file_format reports for them
+COMPRESSED_MIMETYPES = {
+    'application/gzip': 'GZ',
+    'application/x-gzip': 'GZ',
+    'application/x-bzip2': 'BZ2',
+    'application/x-xz': 'XZ',
+    }
+# How much of a compressed file is decompressed to sniff its contents
+COMPRESSED_SNIFF_SIZE = 256 * 1024
+# How much compressed data is read at a time
+COMPRESSED_CHUNK_SIZE = 4 * 1024
+# bz2 (and lzma before Python 3.5) can't be told to stop part way through
+# the data it is given, and a few KB of it can decompress to gigabytes, so it
+# is given this much at a time. (A bz2 block of repeated bytes is about 40
+# bytes and decompresses to 46MB, so that is about as far as it overshoots.)
+COMPRESSED_PIECE_SIZE = 16
+
+
+def get_compressed_format(ctx, mime_type, log):
+    '''For a gzip, bz2 or xz compressed file, decompresses the start of it
+    and sniffs that. Returns a format dict with the container e.g.
+    {'format': 'CSV', 'container': 'GZ'}, or None if the contents are not
+    recognised.'''
+    container = COMPRESSED_MIMETYPES[mime_type]
+    try:
+        data = decompress_head(ctx, container, COMPRESSED_SNIFF_SIZE)
+    except SniffBudgetExceeded:
+        raise
+    except Exception, e:
+        log.info('Could not decompress %s file: %s %s', container, e, e.args)
+        return None
+    if data is None:
+        log.info('No decompressor available for %s', container)
+        return None
+    log.info('Sniffing first %s bytes of %s compressed file',
+             len(data), container)
+    with SniffContext(ctx.filepath, data=data, budget=ctx.budget,
+                      log=log) as inner_ctx:
+        format_ = sniff_context_format(inner_ctx, log)
     if not format_:
-        log.warning('Could not detect format of file: %s', filepath)
+        return None
+    format_ = dict(format_)
+    format_.setdefault('container', container)
+    log.info('Compressed file format: %s', format_)
     return format_
 
+
+def decompress_head(ctx, container, max_bytes):
+    '''Decompresses up to max_bytes from the start of a GZ, BZ2 or XZ file,
+    reading only as much of the file as is needed. Returns the data, or None
+    if there is no decompressor for the container.'''
+    decompress = get_decompressor(container)
+    if decompress is None:
+        return None
+    f = ctx.fileobj()
+    return decompress_chunks(lambda: f.read(COMPRESSED_CHUNK_SIZE),
+                             decompress, max_bytes, ctx.budget)
+
+
+def get_decompressor(container):
+    '''Returns a function decompress(chunk, max_length) for a stream of data
+    compressed as the container says (GZ, BZ2 or XZ, or DEFLATE for a zip
+    member), or None if there is no decompressor for it.'''
+    if container in ('GZ', 'DEFLATE'):
+        # zlib can stop at max_bytes itself. The wbits value is for the gzip
+        # header, or none.
+        decompressor = zlib.decompressobj(
+            16 + zlib.MAX_WBITS if container == 'GZ' else -zlib.MAX_WBITS)
+        return lambda chunk, max_length: \
+            decompressor.decompress(chunk, max_length)
+    if container == 'BZ2':
+        decompressor = bz2.BZ2Decompressor()
+    elif container == 'XZ' and lzma is not None:
+        decompressor = lzma.LZMADecompressor()
+        if hasattr(decompressor, 'needs_input'):
+            # Python 3.5+ lzma can stop at max_length itself
+            return lambda chunk, max_length: \
+                decompressor.decompress(chunk, max_length)
+    else:
+        return None
+
+    def decompress(chunk, max_length):
+        data = []
+        num_bytes = 0
+        for start in xrange(0, len(chunk), COMPRESSED_PIECE_SIZE):
+            if num_bytes >= max_length:
+                break
+            piece = decompressor.decompress(
+                chunk[start:start + COMPRESSED_PIECE_SIZE])
+            data.append(piece)
+            num_bytes += len(piece)
+        return ''.join(data)
+    return decompress
+
+
+def decompress_chunks(read_chunk, decompress, max_bytes, budget):
+    '''Decompresses the chunks that read_chunk() returns (until it returns
+    '') until there are max_bytes of data. Returns the data. The data
+    decompressed is counted against the budget (a SniffBudget).'''
+    data = []
+    num_bytes = 0
+    while num_bytes < max_bytes:
+        chunk = read_chunk()
+        if not chunk:
+            break
+        try:
+            decompressed = decompress(chunk, max_bytes - num_bytes)
+        except EOFError:
+            # end of the compressed stream
+            break
+        budget.count_bytes(len(decompressed))
+        data.append(decompressed)
+        num_bytes += len(decompressed)
+    return ''.join(data)[:max_bytes]
+
+
+# Tokens of JSON, for matching at a position in the buffer (so nothing is
+# copied). The string pattern is 'unrolled' so that it cannot backtrack.
+JSON_WHITESPACE_RE = re.compile(r'[ \t\r\n]*')
+JSON_STRING_RE = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"')
+JSON_NUMBER_RE = re.compile(r'-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?')
+JSON_LITERAL_RE = re.compile(r'true|false|null')
+# After this many tokens in a row are valid JSON, we are happy it is JSON
+JSON_TOKENS_REQUIRED = 10
+# A line of JSON Lines longer than this is unlikely, so call it plain JSON
+NDJSON_MAX_LINE_LENGTH = 100000
+# Expected next token
+_VALUE, _VALUE_OR_END, _KEY, _KEY_OR_END, _COLON, _COMMA_OR_END, \
+    _NEXT_LINE = range(7)
+
+
+def get_json_variant(buf, log):
+    '''If this text buffer (potentially truncated) is JSON, returns
+    {'format': 'JSON'}, or if it is newline-delimited JSON (JSON Lines - one
+    object or array per line) it returns {'format': 'NDJSON'}. Otherwise
+    returns None.
+
+    It tokenizes the buffer in a single pass, keeping a stack of the
+    objects/arrays it is in, and stops as soon as it has seen enough valid
+    JSON to be sure.'''
+    json_format = _scan_json(buf)
+    if json_format:
+        log.info('%s detected', json_format)
+        return {'format': json_format}
+    log.info('Not JSON')
+
+
 def is_json(buf, log):
     '''Returns whether this text buffer (potentially truncated) is in
-    JSON format.'''
-    string = '"[^"]*"'
-    string_re = re.compile(string)
-    number_re = re.compile('-?\d+(\.\d+)?([eE][+-]?\d+)?')
-    extra_values_re = re.compile('true|false|null')
-    object_start_re = re.compile('{%s:\s?' % string)
-    object_middle_re = re.compile('%s:\s?' % string)
-    object_end_re = re.compile('}')
-    comma_re = re.compile(',\s?')
-    array_start_re = re.compile('\[')
-    array_end_re = re.compile('\]')
-    any_value_regexs = [string_re, number_re, object_start_re, array_start_re, extra_values_re]
-
-    # simplified state machine - just looks at stack of object/array and
-    # ignores contents of them, beyond just being simple JSON bits
-    pos = 0
-    state_stack = [] # stack of 'object', 'array'
-    number_of_matches = 0
-    while pos < len(buf):
-        part_of_buf = buf[pos:]
-        if pos == 0:
-            potential_matches = (object_start_re, array_start_re, string_re, number_re, extra_values_re)
-        elif not state_stack:
-            # cannot have content beyond the first byte that is not nested
-            return False
-        elif state_stack[-1] == 'object':
-            # any value
-            potential_matches = [comma_re, object_middle_re, object_end_re] + any_value_regexs
-        elif state_stack[-1] == 'array':
-            # any value or end it
-            potential_matches = any_value_regexs + [comma_re, array_end_re]
-        for matcher in potential_matches:
-            if matcher.match(part_of_buf):
-                if matcher in any_value_regexs and state_stack and state_stack[-1] == 'comma':
-                    state_stack.pop()
-                if matcher == object_start_re:
-                    state_stack.append('object')
-                elif matcher == array_start_re:
-                    state_stack.append('array')
-                elif matcher in (object_end_re, array_end_re):
-                    try:
-                        state = state_stack.pop()
-                    except IndexError:
-                        # nothing to pop
-                        log.info('Not JSON - %i matches', number_of_matches)
-                        return False
-                break
+    JSON format, including newline-delimited JSON (JSON Lines). Use
+    get_json_variant to tell the two apart.'''
+    return bool(get_json_variant(buf, log))
+
+
+def _scan_json(buf):
+    '''Returns 'JSON', 'NDJSON' or None for the buffer. See get_json_variant.
+    '''
+    length = len(buf)
+    pos = 3 if buf.startswith('\xef\xbb\xbf') else 0  # skip a UTF8 BOM
+    stack = []  # of '{' and '['
+    expect = _VALUE
+    num_tokens = 0
+    num_lines = 0  # number of top-level values, when NDJSON
+    first_value_is_multiline = False
+    # if there is no newline, it cannot be JSON Lines
+    first_newline = buf.find('\n', 0, NDJSON_MAX_LINE_LENGTH)
+    while True:
+        whitespace_end = JSON_WHITESPACE_RE.match(buf, pos).end()
+        newline = buf.find('\n', pos, whitespace_end) != -1
+        pos = whitespace_end
+        if pos >= length:
+            break
+        if newline and stack:
+            if num_lines:
+                # a JSON Lines value cannot span lines
+                return None
+            first_value_is_multiline = True
+        char = buf[pos]
+
+        if expect == _NEXT_LINE:
+            # the first value is complete, so this must be JSON Lines
+            if not newline or char not in '{[':
+                return None
+            num_lines += 1
+            if num_lines > 2:
+                # three lines of it is enough evidence
+                return 'NDJSON'
+            expect = _VALUE
+
+        if expect in (_VALUE, _VALUE_OR_END):
+            if char == '{':
+                stack.append(char)
+                expect = _KEY_OR_END
+                pos += 1
+            elif char == '[':
+                stack.append(char)
+                expect = _VALUE_OR_END
+                pos += 1
+            elif char == ']' and expect == _VALUE_OR_END:
+                stack.pop()
+                pos += 1
+                expect = None
+            elif char == '"':
+                match = JSON_STRING_RE.match(buf, pos)
+                if not match:
+                    # unterminated - fine if the buffer is just truncated
+                    break
+                pos = match.end()
+                expect = None
+            else:
+                match = JSON_NUMBER_RE.match(buf, pos) or \
+                    JSON_LITERAL_RE.match(buf, pos)
+                if not match:
+                    return None
+                pos = match.end()
+                expect = None
+        elif expect in (_KEY, _KEY_OR_END):
+            if char == '}' and expect == _KEY_OR_END:
+                stack.pop()
+                pos += 1
+                expect = None
+            elif char == '"':
+                match = JSON_STRING_RE.match(buf, pos)
+                if not match:
+                    break
+                pos = match.end()
+                expect = _COLON
+            else:
+                return None
+        elif expect == _COLON:
+            if char != ':':
+                return None
+            pos += 1
+            expect = _VALUE
+        elif expect == _COMMA_OR_END:
+            if char == ',':
+                expect = _VALUE if stack[-1] == '[' else _KEY
+            elif (char == ']' and stack[-1] == '[') or \
+                    (char == '}' and stack[-1] == '{'):
+                stack.pop()
+                expect = None
+            else:
+                return None
+            pos += 1
+        num_tokens += 1
+
+        if expect is None:
+            # completed a value
+            if stack:
+                expect = _COMMA_OR_END
+            else:
+                expect = _NEXT_LINE
+                if num_lines == 0:
+                    if first_value_is_multiline or \
+                            buf[pos - 1] not in '}]':
+                        # it can only be a single JSON value, so the rest of
+                        # the buffer must be just whitespace
+                        if JSON_WHITESPACE_RE.match(buf, pos).end() < length:
+                            return None
+                        return 'JSON'
+                    num_lines = 1
+        if not num_lines and num_tokens >= JSON_TOKENS_REQUIRED and \
+                (first_value_is_multiline or first_newline == -1 or
+                 pos > NDJSON_MAX_LINE_LENGTH):
+            return 'JSON'
+
+    # got to the end of the buffer (or it was truncated in a string)
+    if not num_tokens:
+        return None
+    if num_lines > 1:
+        return 'NDJSON'
+    return 'JSON'
+
+# The delimiters of the delimiter-separated values formats, in the order they
+# are preferred if the numbers of cells they give are just as consistent
+DELIMITED_FORMATS = [(',', 'CSV'), ('|', 'PSV'), ('\t', 'TSV'), (';', 'SSV')]
+# A quoted value (which may go over several lines), some other text or the end
+# of a line
+DELIMITED_TOKEN_RE = re.compile(r'"[^"]*"?|[^"\n]+|\n')
+
+
+def count_delimiters(buf):
+    '''Counts each of the DELIMITED_FORMATS delimiters in each row of the
+    buffer, in one pass, ignoring any in quoted values. Returns a list with
+    the counts for each row, as a tuple in the order of DELIMITED_FORMATS.
+
+    A row is usually a line, but quoted values can contain line breaks. UTF-16
+    text is decoded first. Indentation is ignored, blank lines are skipped,
+    and so is the last line if it is incomplete (as the buffer is usually
+    just the start of the file).'''
+    if buf.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        buf = buf.decode('utf16', 'replace')
+    delimiters = [delimiter for delimiter, format_ in DELIMITED_FORMATS]
+    rows = []
+    row = [0] * len(delimiters)
+    row_has_text = False
+    for match in DELIMITED_TOKEN_RE.finditer(buf):
+        token = match.group()
+        if token == '\n':
+            if row_has_text:
+                rows.append(tuple(row))
+                row = [0] * len(delimiters)
+                row_has_text = False
+        elif token[0] == '"':
+            row_has_text = True
         else:
-            # no match
-            log.info('Not JSON - %i matches', number_of_matches)
-            return False
-        match_length = matcher.match(part_of_buf).end()
-        #print "MATCHED %r %r %s" % (matcher.match(part_of_buf).string[:match_length], matcher.pattern, state_stack)
-        pos += match_length
-        number_of_matches += 1
-        if number_of_matches > 5:
-            log.info('JSON detected: %i matches', number_of_matches)
-            return True
-
-    log.info('JSON detected: %i matches', number_of_matches)
-    return True
+            if not row_has_text:
+                # ignore indentation
+                token = token.lstrip()
+            for i, delimiter in enumerate(delimiters):
+                row[i] += token.count(delimiter)
+            row_has_text = row_has_text or bool(token)
+    if row_has_text and len(rows) < 2:
+        # a short file, so it's probably complete
+        rows.append(tuple(row))
+    return rows
+
+
+def get_delimited_format(buf, log):
+    '''If the buffer is delimiter-separated values (CSV, PSV, TSV or SSV)
+    then returns the format dict for it e.g. {'format': 'TSV'}, else None.
+
+    As for a spreadsheet, there must be more than 1.5 cells per row on
+    average, and most often at least 2. If more than one delimiter qualifies,
+    the one that gives the most rows the same number of cells wins.'''
+    if '\x00' in buf and \
+            not buf.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        log.info('Not delimiter-separated values - binary')
+        return None
+    rows = count_delimiters(buf)
+    num_rows = len(rows)
+    best = None
+    for i, (delimiter, format_) in enumerate(DELIMITED_FORMATS):
+        if not num_rows:
+            break
+        counts = [row[i] for row in rows]
+        num_cells = sum(counts) + num_rows
+        cells_per_row = float(num_cells) / num_rows
+        if not (num_cells > 3 or num_rows > 1) or cells_per_row <= 1.5:
+            continue
+        usual_count, num_usual = Counter(counts).most_common(1)[0]
+        if not usual_count:
+            continue
+        consistency = float(num_usual) / num_rows
+        log.debug('%s: %.1f cells per row, %i%% of rows with %i cells',
+                  format_, cells_per_row, consistency * 100, usual_count + 1)
+        if best is None or consistency > best[0]:
+            best = (consistency, format_, cells_per_row)
+    if best:
+        consistency, format_, cells_per_row = best
+        log.info('Is %s because %.1f cells per row (%i rows, %i%% with the '
+                 'same number of cells)', format_, cells_per_row, num_rows,
+                 consistency * 100)
+        return {'format': format_}
+    log.info('Not delimiter-separated values - not enough cells per row '
+             '(%i rows)', num_rows)
+    return None
 
 def is_csv(buf, log):
     '''If the buffer is a CSV file then return True.'''
-    buf_rows = StringIO.StringIO(buf)
-    table_set = messytables.CSVTableSet(buf_rows)
-    return _is_spreadsheet(table_set, 'CSV', log)
+    return get_delimited_format(buf, log) == {'format': 'CSV'}
 
 def is_psv(buf, log):
     '''If the buffer is a PSV file then return True.'''
-    buf_rows = StringIO.StringIO(buf)
-    table_set = messytables.CSVTableSet(buf_rows, delimiter='|')
-    return _is_spreadsheet(table_set, 'PSV', log)
-
-def _is_spreadsheet(table_set, format, log):
-    def get_cells_per_row(num_cells, num_rows):
-        if not num_rows:
-            return 0
-        return float(num_cells) / float(num_rows)
-    num_cells = num_rows = 0
-    try:
-        table = table_set.tables[0]
-        # Iterate through the table.sample (sample because otherwise
-        # it will barf if there is an unclosed string at the end)
-        for row in table.sample:
-            if row:
-                # Must have enough cells
-                num_cells += len(row)
-                num_rows += 1
-                if num_cells > 20 or num_rows > 10:
-                    cells_per_row = get_cells_per_row(num_cells, num_rows)
-                    # over the long term, 2 columns is the minimum
-                    if cells_per_row > 1.9:
-                        log.info('Is %s because %.1f cells per row (%i cells, %i rows)', \
-                                 format,
-                                 get_cells_per_row(num_cells, num_rows),
-                                 num_cells, num_rows)
-                        return True
-    finally:
-        pass
-    # if file is short then be more lenient
-    if num_cells > 3 or num_rows > 1:
-        cells_per_row = get_cells_per_row(num_cells, num_rows)
-        if cells_per_row > 1.5:
-            log.info('Is %s because %.1f cells per row (%i cells, %i rows)', \
-                     format,
-                     get_cells_per_row(num_cells, num_rows),
-                     num_cells, num_rows)
-            return True
-    log.info('Not %s - not enough valid cells per row '
-             '(%i cells, %i rows, %.1f cells per row)', \
-             format, num_cells, num_rows, get_cells_per_row(num_cells, num_rows))
-    return False
+    return get_delimited_format(buf, log) == {'format': 'PSV'}
 
 def is_html(buf, log):
     '''If this buffer is HTML, return that format type, else None.'''
@@ -306,9 +1008,12 @@ def get_xml_variant_without_xml_declaration(buf, log):
         p.Parse(buf)
     except GotFirstTag, e:
         top_level_tag_name = str(e).lower()
-    except xml.sax.SAXException, e:
-        log.info('Sax parse error: %s %s', e, buf)
-        return {'format': 'XML'}
+    except xml.parsers.expat.ExpatError, e:
+        log.info('Not XML - parse error: %s', e)
+        return None
+    else:
+        log.info('Not XML - no top level tag found')
+        return None
 
     log.info('Top level tag detected as: %s', top_level_tag_name)
     top_level_tag_name = top_level_tag_name.replace('rdf:rdf', 'rdf')
@@ -331,49 +1036,301 @@ def get_xml_variant_without_xml_declaration(buf, log):
     log.warning('Did not recognise XML format: %s', top_level_tag_name)
     return {'format': 'XML'}
 
-def has_rdfa(buf, log):
-    '''If the buffer HTML contains RDFa then this returns True'''
-    # quick check for the key words
-    if 'about=' not in buf or 'property=' not in buf:
-        log.debug('Not RDFA')
-        return False
+# RDFa attributes, inside a tag
+RDFA_ABOUT_RE = re.compile(r'''<[^<>]*\sabout=("[^"]+"|'[^']+')''')
+RDFA_PROPERTY_RE = re.compile(r'''<[^<>]*\sproperty=("[^"]+"|'[^']+')''')
+RDFA_CHUNK_SIZE = 64 * 1024
+# A tag longer than this, split between chunks, may be missed
+RDFA_MAX_TAG_LENGTH = 64 * 1024
 
-    # more rigorous check for them as tag attributes
-    about_re = '<[^>]+\sabout="[^"]+"[^>]*>'
-    property_re = '<[^>]+\sproperty="[^"]+"[^>]*>'
-    # remove CR to catch tags spanning more than one line
-    #buf = re.sub('\r\n', ' ', buf)
-    if not re.search(about_re, buf):
-        log.debug('Not RDFA')
-        return False
-    if not re.search(property_re, buf):
-        log.debug('Not RDFA')
+
+def get_rdfa_max_bytes():
+    '''Returns how much of an HTML file to look through for RDFa, from config
+    option qa.rdfa_max_bytes (default 1MB).'''
+    from pylons import config
+    return int(config.get('qa.rdfa_max_bytes', 1024 * 1024))
+
+
+def has_rdfa(ctx, log, max_bytes=None):
+    '''If the HTML file contains RDFa then this returns True.
+
+    The file is read in chunks, up to max_bytes (defaults to the config),
+    stopping as soon as tags with both "about" and "property" attributes have
+    been seen.'''
+    if max_bytes is None:
+        max_bytes = get_rdfa_max_bytes()
+    regexes = [RDFA_ABOUT_RE, RDFA_PROPERTY_RE]
+    f = ctx.fileobj()
+    # the start of a tag that the previous chunk finished part way through
+    tag_start = ''
+    bytes_read = 0
+    while regexes and bytes_read < max_bytes:
+        chunk = f.read(min(RDFA_CHUNK_SIZE, max_bytes - bytes_read))
+        if not chunk:
+            break
+        bytes_read += len(chunk)
+        buf = tag_start + chunk
+        regexes = [regex for regex in regexes if not regex.search(buf)]
+        last_tag_start = buf.rfind('<')
+        if last_tag_start > buf.rfind('>') and \
+                len(buf) - last_tag_start <= RDFA_MAX_TAG_LENGTH:
+            tag_start = buf[last_tag_start:]
+        else:
+            tag_start = ''
+    if regexes:
+        log.debug('Not RDFA (%s bytes searched)', bytes_read)
         return False
     log.info('RDFA tags found in HTML')
     return True
 
 
-def get_zipped_format(filepath, log):
-    '''For a given zip file, return the format of file inside.
-    For multiple files, choose by the most open, and then by the most
-    popular extension.'''
-    # just check filename extension of each file inside
+# The structures of a zip file (see PKWARE's APPNOTE.TXT)
+ZIP_END_RECORD = struct.Struct('<4s4H2LH')
+ZIP_END_RECORD_SIGNATURE = 'PK\x05\x06'
+ZIP_MAX_COMMENT_SIZE = 0xffff
+ZIP64_END_LOCATOR = struct.Struct('<4sLQL')
+ZIP64_END_LOCATOR_SIGNATURE = 'PK\x06\x07'
+ZIP64_END_RECORD = struct.Struct('<4sQ2H2L4Q')
+ZIP64_END_RECORD_SIGNATURE = 'PK\x06\x06'
+ZIP64_EXTRA_ID = 1
+ZIP_DIRECTORY_ENTRY = struct.Struct('<4s4B4HL2L5H2L')
+ZIP_DIRECTORY_ENTRY_SIGNATURE = 'PK\x01\x02'
+ZIP_LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+ZIP_LOCAL_HEADER_SIGNATURE = 'PK\x03\x04'
+ZIP_UTF8_FLAG = 0x800
+# Compression methods of zip members that can be decompressed to sniff them
+ZIP_METHOD_CONTAINERS = {0: None, 8: 'DEFLATE', 12: 'BZ2'}
+# How much of the central directory is read at a time
+ZIP_DIRECTORY_CHUNK_SIZE = 64 * 1024
+# How many zips inside zips have their files sniffed
+ZIP_MAX_DEPTH = 2
+
+
+class ZipMember(object):
+    '''A file in a zip, as listed in its central directory.'''
+    def __init__(self, filename, compress_type, compress_size, file_size,
+                 header_offset):
+        self.filename = filename
+        self.compress_type = compress_type
+        self.compress_size = compress_size
+        self.file_size = file_size
+        self.header_offset = header_offset
+
+    def __repr__(self):
+        return '<ZipMember %r %s bytes>' % (self.filename, self.file_size)
+
+
+def get_zip_options():
+    '''Returns the options for looking inside zip files, from the config:
+
+    qa.zip_max_members - the most files in a zip that are looked at (10000)
+    qa.zip_sniff_members - how many of the largest files in a zip, that are
+                           not recognised by their extension (or are zips
+                           themselves), to sniff the contents of (0)
+    qa.zip_sniff_max_bytes - the most data decompressed for that, for each
+                             zip (1MB)
+    '''
+    from pylons import config
+    return {
+        'max_members': int(config.get('qa.zip_max_members', 10000)),
+        'sniff_members': int(config.get('qa.zip_sniff_members', 0)),
+        'sniff_max_bytes': int(config.get('qa.zip_sniff_max_bytes',
+                                          1024 * 1024)),
+        }
+
+
+def get_zip_members(ctx, log, max_members=None):
+    '''Returns the files in a zip file (as ZipMembers), read from its central
+    directory, or None if it cannot be read. Only the first max_members
+    (defaults to the config) are returned.
+
+    Just the end of the file and the central directory are read, and only as
+    much of the directory as is needed for max_members.'''
+    if 'zip_members' in ctx.cache:
+        return ctx.cache['zip_members']
+    if max_members is None:
+        max_members = get_zip_options()['max_members']
     try:
-        # note: Cannot use "with" with a zipfile before python 2.7
-        #       so we have to close it manually.
-        zip = zipfile.ZipFile(filepath, 'r')
-        try:
-            filepaths = zip.namelist()
-        finally:
-            zip.close()
-    except zipfile.BadZipfile, e:
-        log.info('Zip file open raised error %s: %s',
-                 e, e.args)
-        return
+        members = read_zip_directory(ctx, max_members, log)
+    except SniffBudgetExceeded:
+        raise
+    except (struct.error, UnicodeDecodeError, ValueError), e:
+        log.info('Zip directory could not be read: %s %s', e, e.args)
+        members = None
+    ctx.cache['zip_members'] = members
+    return members
+
+
+def read_zip_directory(ctx, max_members, log):
+    # The end of central directory record is at the end of the file, before
+    # a comment of unknown length
+    tail_size = min(ctx.size, ZIP_END_RECORD.size + ZIP_MAX_COMMENT_SIZE)
+    tail_offset = ctx.size - tail_size
+    tail = ctx.read_at(tail_offset, tail_size)
+    pos = tail.rfind(ZIP_END_RECORD_SIGNATURE)
+    if pos == -1 or pos + ZIP_END_RECORD.size > len(tail):
+        log.info('Zip end of central directory not found')
+        return None
+    end_record_offset = tail_offset + pos
+    (_, _, _, _, num_entries, directory_size, directory_offset, _) = \
+        ZIP_END_RECORD.unpack_from(tail, pos)
+    directory_end = end_record_offset
+    locator_offset = end_record_offset - ZIP64_END_LOCATOR.size
+    if locator_offset >= 0:
+        locator = ctx.read_at(locator_offset, ZIP64_END_LOCATOR.size)
+        if locator.startswith(ZIP64_END_LOCATOR_SIGNATURE):
+            directory_end = locator_offset - ZIP64_END_RECORD.size
+            record = ctx.read_at(directory_end, ZIP64_END_RECORD.size)
+            if not record.startswith(ZIP64_END_RECORD_SIGNATURE):
+                raise ValueError('Zip64 end of central directory not found')
+            (_, _, _, _, _, _, _, num_entries, directory_size,
+             directory_offset) = ZIP64_END_RECORD.unpack(record)
+    # any data prepended to the zip (e.g. a self-extractor) moves it along
+    directory_start = directory_end - directory_size
+    if directory_start < 0:
+        raise ValueError('Bad zip central directory size')
+    prepended_size = directory_start - directory_offset
+
+    members = []
+    buf = ''
+    pos = 0
+    read_offset = directory_start
+    while len(members) < min(num_entries, max_members):
+        # make sure the buffer has the whole of the next entry
+        entry_size = ZIP_DIRECTORY_ENTRY.size
+        if len(buf) - pos >= entry_size:
+            fields = ZIP_DIRECTORY_ENTRY.unpack_from(buf, pos)
+            entry_size += sum(fields[12:15])
+        if len(buf) - pos < entry_size:
+            if read_offset >= directory_end:
+                raise ValueError('Zip central directory is cut short')
+            chunk_size = min(max(ZIP_DIRECTORY_CHUNK_SIZE, entry_size),
+                             directory_end - read_offset)
+            buf = buf[pos:] + ctx.read_at(read_offset, chunk_size)
+            read_offset += chunk_size
+            pos = 0
+            continue
+        (signature, _, _, _, _, flags, compress_type, _, _, _, compress_size,
+         file_size, filename_size, extra_size, _, _, _, _, header_offset) = \
+            fields
+        if signature != ZIP_DIRECTORY_ENTRY_SIGNATURE:
+            raise ValueError('Bad zip central directory entry')
+        start = pos + ZIP_DIRECTORY_ENTRY.size
+        filename = buf[start:start + filename_size]
+        if flags & ZIP_UTF8_FLAG:
+            filename = filename.decode('utf8')
+        if 0xffffffff in (compress_size, file_size, header_offset):
+            extra = buf[start + filename_size:
+                        start + filename_size + extra_size]
+            file_size, compress_size, header_offset = \
+                read_zip64_extra(extra, file_size, compress_size,
+                                 header_offset)
+        members.append(ZipMember(filename, compress_type, compress_size,
+                                 file_size, header_offset + prepended_size))
+        pos += entry_size
+    if num_entries > max_members:
+        log.info('Zip has %s files - looking at just the first %s',
+                 num_entries, max_members)
+    return members
+
+
+def read_zip64_extra(extra, *values):
+    '''Returns the values (file size, compressed size, header offset) of a zip
+    directory entry, with those too big for it (0xffffffff) replaced by the
+    ones in its Zip64 extra field.'''
+    pos = 0
+    while pos + 4 <= len(extra):
+        field_id, field_size = struct.unpack_from('<2H', extra, pos)
+        if field_id == ZIP64_EXTRA_ID:
+            big_values = list(struct.unpack_from(
+                '<%dQ' % (field_size // 8), extra, pos + 4))
+            return tuple(big_values.pop(0)
+                         if value == 0xffffffff and big_values else value
+                         for value in values)
+        pos += 4 + field_size
+    return values
+
+
+def get_zip_namelist(ctx, log):
+    '''Returns the filepaths in a zip file, read from its central directory,
+    or None if it cannot be read.'''
+    members = get_zip_members(ctx, log)
+    if members is None:
+        return None
+    return [member.filename for member in members]
+
+
+def read_zip_member_head(ctx, member, max_bytes):
+    '''Returns up to max_bytes of the start of a file in the zip,
+    decompressed, or None if it is compressed in a way that can't be
+    decompressed here.'''
+    header = ctx.read_at(member.header_offset, ZIP_LOCAL_HEADER.size)
+    if len(header) < ZIP_LOCAL_HEADER.size or \
+            not header.startswith(ZIP_LOCAL_HEADER_SIGNATURE):
+        raise ValueError('Bad zip local header')
+    filename_size, extra_size = ZIP_LOCAL_HEADER.unpack(header)[-2:]
+    offset = member.header_offset + ZIP_LOCAL_HEADER.size + filename_size + \
+        extra_size
+    end = offset + member.compress_size
+    if member.compress_type not in ZIP_METHOD_CONTAINERS:
+        return None
+    container = ZIP_METHOD_CONTAINERS[member.compress_type]
+    if container is None:
+        # stored uncompressed
+        return ctx.read_at(offset, min(max_bytes, member.compress_size))
+    decompress = get_decompressor(container)
+
+    def read_chunk():
+        chunk = ctx.read_at(read_chunk.offset,
+                            min(COMPRESSED_CHUNK_SIZE,
+                                end - read_chunk.offset))
+        read_chunk.offset += len(chunk)
+        return chunk
+    read_chunk.offset = offset
+    return decompress_chunks(read_chunk, decompress, max_bytes, ctx.budget)
+
+
+def get_zip_member_format(ctx, member, max_bytes, log):
+    '''Sniffs (up to max_bytes of) the start of a file in the zip. If all of
+    it fits, and it is a zip too, then that is looked inside as well, with
+    what is left of max_bytes. Returns the format dict, or None.'''
+    try:
+        data = read_zip_member_head(ctx, member,
+                                    min(member.file_size, max_bytes))
+    except SniffBudgetExceeded:
+        raise
     except Exception, e:
-        log.warning('Zip file open raised exception %s: %s',
-                    e, e.args)
+        log.info('Could not read zipped file %r: %s %s', member.filename, e,
+                 e.args)
+        return None
+    if data is None:
+        log.info('Zipped file %r is compressed with an unknown method: %s',
+                 member.filename, member.compress_type)
+        return None
+    log.info('Sniffing first %s bytes of zipped file %r', len(data),
+             member.filename)
+    with SniffContext(member.filename, data=data, budget=ctx.budget,
+                      log=log) as inner_ctx:
+        inner_ctx.cache['zip_depth'] = ctx.cache.get('zip_depth', 0) + 1
+        inner_ctx.cache['zip_sniff_max_bytes'] = max_bytes - len(data)
+        format_ = sniff_context_format(inner_ctx, log)
+    log.info('Zipped file %r format: %s', member.filename, format_)
+    return format_
+
+
+def get_zipped_format(ctx, log):
+    '''For a given zip file (SniffContext), return the format of file inside.
+    For multiple files, choose by the most open, and then by the most
+    popular format.
+
+    The formats are worked out from the filename extensions, and optionally
+    (see get_zip_options) by sniffing the contents of the largest few files
+    whose extensions don't say, including zips inside the zip.'''
+    options = get_zip_options()
+    members = get_zip_members(ctx, log, options['max_members'])
+    if members is None:
         return
+    filepaths = [member.filename for member in members]
 
     # Shapefile check - a Shapefile is a zip containing specific files:
     # .shp, .dbf and .shx amongst others
@@ -389,40 +1346,228 @@ def get_zipped_format(filepath, log):
         log.info('GTFS detected')
         return {'format': 'GTFS'}
 
+    # look up each extension just once
+    format_index = lib.format_index()
+    member_extensions = [os.path.splitext(member.filename)[-1][1:].lower()
+                         for member in members]
+    extension_formats = {}
+    for extension in set(member_extensions):
+        entry = format_index.get(extension)
+        extension_formats[extension] = entry[0] if entry else None
+        if not entry:
+            log.info('Zipped file of unknown extension: "%s"', extension)
+    member_formats = [extension_formats[extension]
+                      for extension in member_extensions]
+
+    sniff_max_bytes = ctx.cache.get('zip_sniff_max_bytes',
+                                    options['sniff_max_bytes'])
+    if options['sniff_members'] and sniff_max_bytes > 0 and \
+            ctx.cache.get('zip_depth', 0) < ZIP_MAX_DEPTH:
+        to_sniff = sorted(
+            (i for i, member in enumerate(members)
+             if member_formats[i] in (None, 'ZIP') and member.file_size and
+             not member.filename.endswith('/')),
+            key=lambda i: -members[i].file_size)[:options['sniff_members']]
+        for i in to_sniff:
+            if sniff_max_bytes <= 0:
+                break
+            format_ = get_zip_member_format(ctx, members[i], sniff_max_bytes,
+                                            log)
+            sniff_max_bytes -= min(members[i].file_size, sniff_max_bytes)
+            if format_:
+                member_formats[i] = format_['format']
+
     top_score = 0
-    top_scoring_extension_counts = defaultdict(int)  # extension: number_of_files
-    for filepath in filepaths:
-        extension = os.path.splitext(filepath)[-1][1:].lower()
-        format_tuple = ckan_helpers.resource_formats().get(extension)
-        if format_tuple:
-            score = lib.resource_format_scores().get(format_tuple[1])
-            if score is not None and score > top_score:
-                top_score = score
-                top_scoring_extension_counts = defaultdict(int)
-            if score == top_score:
-                top_scoring_extension_counts[extension] += 1
-        else:
-            log.info('Zipped file of unknown extension: "%s" (%s)',
-                     extension, filepath)
-    if not top_scoring_extension_counts:
-        log.info('Zip has no known extensions: %s', filepath)
+    top_scoring_format_counts = defaultdict(int)  # format: number_of_files
+    for format_ in member_formats:
+        if not format_:
+            continue
+        score = format_index.scores.get(format_)
+        if score is not None and score > top_score:
+            top_score = score
+            top_scoring_format_counts = defaultdict(int)
+        if score == top_score:
+            top_scoring_format_counts[format_] += 1
+    if not top_scoring_format_counts:
+        log.info('Zip has no known extensions: %s', ctx.filepath)
         return {'format': 'ZIP'}
 
-    top_scoring_extension_counts = sorted(top_scoring_extension_counts.items(),
-                                          key=lambda x: x[1])
-    top_extension = top_scoring_extension_counts[-1][0]
-    log.info('Zip file\'s most popular extension is "%s" (All extensions: %r)',
-             top_extension, top_scoring_extension_counts)
-    format_tuple = ckan_helpers.resource_formats()[top_extension]
-    format_ = {'format': format_tuple[1],
+    top_scoring_format_counts = sorted(top_scoring_format_counts.items(),
+                                       key=lambda x: x[1])
+    top_format = top_scoring_format_counts[-1][0]
+    log.info('Zip file\'s most popular format is "%s" (All formats: %r)',
+             top_format, top_scoring_format_counts)
+    format_ = {'format': top_format,
                'container': 'ZIP'}
-    log.info('Zipped file format detected: %s', format_tuple[2])
+    log.info('Zipped file format detected: %s', top_format)
     return format_
 
 
-def is_excel(filepath, log):
+OLE2_SIGNATURE = '\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'
+OLE2_END_OF_CHAIN = 0xfffffffe
+# Don't follow a (possibly corrupt) directory any further than this
+OLE2_MAX_DIRECTORY_SECTORS = 64
+# Streams in the directory of an MS Office compound document, that identify it
+OLE2_STREAM_FORMATS = (
+    ('Workbook', 'XLS'),  # Excel 97+ (BIFF8)
+    ('Book', 'XLS'),  # Excel 5/95 (BIFF5)
+    ('WordDocument', 'DOC'),
+    ('PowerPoint Document', 'PPT'),
+    )
+# Parts of an Office Open XML zip, that identify it
+OOXML_PART_FORMATS = (
+    ('xl/workbook.xml', 'XLSX'),
+    ('word/document.xml', 'DOCX'),
+    ('ppt/presentation.xml', 'PPTX'),
+    )
+# The mimetype stored at the start of an OpenDocument zip
+ODF_MIMETYPE_FORMATS = {
+    'application/vnd.oasis.opendocument.spreadsheet': 'ODS',
+    'application/vnd.oasis.opendocument.text': 'ODT',
+    'application/vnd.oasis.opendocument.presentation': 'ODP',
+    }
+# The BOF record that starts an Excel 2-4 file, which is not a compound
+# document
+BIFF_BOF_SIGNATURES = ('\x09\x00', '\x09\x02', '\x09\x04')
+
+
+def get_office_format(ctx, log):
+    '''If the file is an MS Office or OpenDocument file, returns the format
+    dict (XLS, DOC, PPT, XLSX, DOCX, PPTX, ODS, ODT or ODP), judging just by the
+    names in its directory (rather than loading the whole document).
+    Otherwise returns None.
+
+    Only if that is inconclusive does it try loading it with xlrd.'''
+    head = ctx.head(512)
+    if head.startswith(OLE2_SIGNATURE):
+        stream_names = get_ole2_stream_names(ctx, log)
+        if stream_names is not None:
+            for stream_name, format_ in OLE2_STREAM_FORMATS:
+                if stream_name in stream_names:
+                    log.info('Office document detected from its "%s" '
+                             'stream: %s', stream_name, format_)
+                    return {'format': format_}
+            log.info('Compound document with no Office streams: %r',
+                     stream_names)
+            return None
+    elif head.startswith('PK\x03\x04'):
+        return get_zipped_office_format(ctx, log)
+    elif not head[:2] in BIFF_BOF_SIGNATURES:
+        log.info('Not an Office document - no signature')
+        return None
+    # ambiguous, so get xlrd to try and open it
+    if is_excel(ctx, log):
+        return {'format': 'XLS'}
+
+
+def get_ole2_stream_names(ctx, log):
+    '''Returns the names of the storages and streams in the directory of a
+    compound document (OLE2) file, or None if the directory can't be read.
+
+    Only the header, the FAT sectors needed and the directory sectors are
+    read.'''
+    header = ctx.read_at(0, 512)
+    if len(header) < 512:
+        return None
+    sector_shift, = struct.unpack('<H', header[0x1e:0x20])
+    if sector_shift not in (9, 12):
+        log.info('Compound document has invalid sector size: %s',
+                 sector_shift)
+        return None
+    sector_size = 1 << sector_shift
+    first_directory_sector, = struct.unpack('<I', header[0x30:0x34])
+    num_fat_sectors, = struct.unpack('<I', header[0x2c:0x30])
+    # the header lists the first 109 FAT sectors, which is enough to follow
+    # the directory chain of all but huge files
+    fat_sectors = struct.unpack('<109I', header[0x4c:0x200])[:num_fat_sectors]
+    ids_per_fat_sector = sector_size // 4
+
+    def read_sector(sector_id):
+        return ctx.read_at((sector_id + 1) * sector_size, sector_size)
+
+    def next_sector(sector_id):
+        fat_index, offset = divmod(sector_id, ids_per_fat_sector)
+        if fat_index >= len(fat_sectors):
+            return OLE2_END_OF_CHAIN
+        fat_sector = read_sector(fat_sectors[fat_index])
+        if len(fat_sector) < (offset + 1) * 4:
+            return OLE2_END_OF_CHAIN
+        return struct.unpack('<I', fat_sector[offset * 4:offset * 4 + 4])[0]
+
+    names = []
+    sector_id = first_directory_sector
+    for unused_ in range(OLE2_MAX_DIRECTORY_SECTORS):
+        if sector_id >= OLE2_END_OF_CHAIN:
+            break
+        sector = read_sector(sector_id)
+        if len(sector) < sector_size:
+            log.info('Compound document directory is truncated')
+            return names or None
+        for entry_offset in range(0, sector_size, 128):
+            entry = sector[entry_offset:entry_offset + 128]
+            name_length, = struct.unpack('<H', entry[0x40:0x42])
+            if not 2 <= name_length <= 64:
+                continue
+            try:
+                name = entry[:name_length - 2].decode('utf-16-le')
+            except UnicodeDecodeError:
+                continue
+            names.append(name)
+            if name in dict(OLE2_STREAM_FORMATS):
+                # that's all we need to know
+                return names
+        sector_id = next_sector(sector_id)
+    return names
+
+
+def get_zipped_office_format(ctx, log):
+    '''If the zip file is an OpenDocument or Office Open XML file, returns
+    the format dict, else None.'''
+    # OpenDocument stores its mimetype uncompressed as the first file
+    head = ctx.head(1024)
+    if len(head) >= ZIP_LOCAL_HEADER.size and \
+            head.startswith(ZIP_LOCAL_HEADER_SIGNATURE):
+        header = ZIP_LOCAL_HEADER.unpack(head[:ZIP_LOCAL_HEADER.size])
+        compress_type, compress_size = header[4], header[8]
+        filename_size, extra_size = header[-2:]
+        filename_end = ZIP_LOCAL_HEADER.size + filename_size
+        if compress_type == 0 and \
+                head[ZIP_LOCAL_HEADER.size:filename_end] == 'mimetype':
+            data = head[filename_end + extra_size:]
+            # the size may be given after the data instead
+            mimetype = data[:compress_size] if compress_size \
+                else data.split('PK', 1)[0]
+            if mimetype in ODF_MIMETYPE_FORMATS:
+                log.info('OpenDocument detected: %s', mimetype)
+                return {'format': ODF_MIMETYPE_FORMATS[mimetype]}
+    filepaths = get_zip_namelist(ctx, log)
+    if filepaths and '[Content_Types].xml' in filepaths:
+        filepaths = set(filepaths)
+        for part, format_ in OOXML_PART_FORMATS:
+            if part in filepaths:
+                log.info('Office Open XML detected from its "%s" part: %s',
+                         part, format_)
+                return {'format': format_}
+
+
+def is_excel(ctx, log):
+    '''Returns whether xlrd can open the file, only loading the bits it
+    needs to get started (on_demand mode).'''
     try:
-        xlrd.open_workbook(filepath)
+        contents = ctx.contents()
+        if contents is not None:
+            # only the parts that xlrd reads are counted
+            book = xlrd.open_workbook(file_contents=contents, on_demand=True)
+        elif ctx.is_file_data:
+            # xlrd reads the whole file
+            ctx.count_rest_of_file()
+            book = xlrd.open_workbook(ctx.filepath, on_demand=True)
+        else:
+            log.info('Not Excel - cannot load it, not being a local file')
+            return False
+        book.release_resources()
+    except SniffBudgetExceeded:
+        raise
     except Exception, e:
         log.info('Not Excel - failed to load: %s %s', e, e.args)
         return False
@@ -445,10 +1590,139 @@ def check_output(*popenargs, **kwargs):
         raise Exception('Non-zero exit status %s: %s' % (retcode, output))
     return output
 
+class BsdFileCoprocess(object):
+    '''A long-running BSD "file" process, which is fed filepaths on its stdin
+    and writes the description of each one to its stdout, to save a fork and
+    exec of "file" for every file sniffed.'''
+    command = ['file', '--no-buffer', '--brief', '--files-from', '-']
+
+    def __init__(self):
+        self.process = None
+
+    def start(self):
+        self.stop()
+        with open(os.devnull, 'w') as devnull:
+            self.process = subprocess.Popen(
+                self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=devnull, close_fds=True)
+
+    def stop(self):
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+            if self.process.poll() is None:
+                self.process.kill()
+            self.process.wait()
+        except EnvironmentError:
+            pass
+        self.process = None
+
+    def describe(self, filepath):
+        '''Returns the description "file" gives of the file. Raises IOError
+        if the process has died.'''
+        if self.process is None or self.process.poll() is not None:
+            self.start()
+        self.process.stdin.write(filepath + '\n')
+        self.process.stdin.flush()
+        line = self.process.stdout.readline()
+        if not line:
+            raise IOError('"file" process ended unexpectedly (exit code %s)'
+                          % self.process.poll())
+        return line.rstrip('\n')
+
+
+class BsdFilePool(object):
+    '''A pool of BsdFileCoprocess, so that each thread sniffing at the same
+    time has its own "file" process. Processes are started when first
+    needed, up to the pool size.'''
+    def __init__(self, size):
+        self.size = max(size, 1)
+        self.pid = os.getpid()
+        self._idle = Queue.Queue()
+        self._num_created = 0
+        self._lock = threading.Lock()
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except Queue.Empty:
+            pass
+        with self._lock:
+            if self._num_created < self.size:
+                self._num_created += 1
+                return BsdFileCoprocess()
+        return self._idle.get()
+
+    def describe(self, filepath):
+        coprocess = self._acquire()
+        try:
+            try:
+                return coprocess.describe(filepath)
+            except EnvironmentError:
+                # it crashed, so restart it and have one more go
+                coprocess.stop()
+                return coprocess.describe(filepath)
+        except BaseException:
+            # interrupted (e.g. by a sniff timeout), so its output may be
+            # out of step with the filepaths it is given
+            coprocess.stop()
+            raise
+        finally:
+            self._idle.put(coprocess)
+
+    def stop(self):
+        while True:
+            try:
+                self._idle.get_nowait().stop()
+            except Queue.Empty:
+                break
+
+_bsd_file_pool = None
+
+
+def get_bsd_file_pool():
+    '''Returns this process\'s pool of "file" processes, sized by config
+    option qa.bsd_file_pool_size (default 1, as a celery worker process only
+    sniffs one file at a time).'''
+    global _bsd_file_pool
+    if _bsd_file_pool is None or _bsd_file_pool.pid != os.getpid():
+        # (after a fork, the pipes to the parent's processes are not ours)
+        from pylons import config
+        size = int(config.get('qa.bsd_file_pool_size', 1))
+        _bsd_file_pool = BsdFilePool(size)
+        atexit.register(_bsd_file_pool.stop)
+    return _bsd_file_pool
+
+
+def bsd_file_describe(filepath, log):
+    '''Returns the output of BSD "file" for the given filepath, in the form
+    "<filepath>: <description>".'''
+    filepath_utf8 = filepath.encode('utf8') if isinstance(filepath, unicode) \
+        else filepath
+    if '\n' not in filepath_utf8:
+        try:
+            description = get_bsd_file_pool().describe(filepath_utf8)
+        except EnvironmentError, e:
+            log.warning('"file" process failed, so running it directly: %s',
+                        e)
+        else:
+            return '%s: %s' % (filepath_utf8, description)
+    return check_output(['file', filepath_utf8])
+
+
+def run_bsd_file_on_context(ctx, log):
+    '''Runs BSD file (see run_bsd_file) on the file being sniffed, unless
+    it is not the file's own data that is being sniffed.'''
+    if not ctx.is_file_data:
+        return None
+    return run_bsd_file(ctx.filepath, log)
+
+
 def run_bsd_file(filepath, log):
     '''Run the BSD command-line tool "file" to determine file type. Returns
     a format dict or None if it fails.'''
-    result = check_output(['file', filepath])
+    result = bsd_file_describe(filepath, log)
     match = re.search('Name of Creating Application: ([^,]*),', result)
     if match:
         app_name = match.groups()[0]
@@ -486,16 +1760,37 @@ def is_ttl(buf, log):
 
     # Alternatively look for several triples
     num_required_triples = 5
-    ignore, num_replacements = turtle_regex().subn('', buf, num_required_triples)
-    if num_replacements >= num_required_triples:
-        log.info('Turtle RDF detected - %s triples' % num_replacements)
+    num_triples = count_ttl_triples(buf, num_required_triples)
+    if num_triples >= num_required_triples:
+        log.info('Turtle RDF detected - %s triples' % num_triples)
         return True
 
-    log.debug('Not Turtle RDF - triples not detected (%i)' % num_replacements)
+    log.debug('Not Turtle RDF - triples not detected (%i)' % num_triples)
+
+
+# Regexes for the terms in a triple. Each is matched at a given position and
+# has no ambiguous repetition, so takes time proportional to the length of
+# the term, whatever the text.
+TTL_IRI_RE = re.compile(r'<[^\s>]+>')
+TTL_BLANK_NODE_RE = re.compile(r'_:[^\s;,]+')
+TTL_SHORT_STRING_RES = {
+    '"': re.compile(r'"(?:[^"\\\n]|\\.)+"'),
+    "'": re.compile(r"'(?:[^'\\\n]|\\.)+'"),
+    }
+TTL_LANGUAGE_TAG_RE = re.compile(r'@[a-zA-Z]+(?:-[a-zA-Z0-9]+)*')
+TTL_PREFIXED_NAME_RE = re.compile(r'[\w\-.]*:[\w\-.]*')
+TTL_NUMBER_RE = re.compile(
+    r'[+-]?(?:[0-9]+(?:\.[0-9]+)?|\.[0-9]+)(?:[eE][+-]?[0-9]+)?')
+TTL_BOOLEAN_RE = re.compile(r'true|false')
+TTL_WHITESPACE_RE = re.compile(r'\s*')
+TTL_LINE_SPACE_RE = re.compile(r'[ \t\r]*')
+TTL_NEXT_STATEMENT_RE = re.compile(r'[\n;]')
+TTL_TERM_DELIMITERS = ' \t\r\n;,.'
 
-turtle_regex_ = None
-def turtle_regex():
-    '''Return a compiled regex that matches a turtle triple.
+
+def match_ttl_term(buf, pos):
+    '''Returns the position after the Turtle RDF term starting at buf[pos],
+    or None if there isn't one there.
 
     Each RDF term may be in these forms:
          <url>
@@ -513,13 +1808,216 @@ def turtle_regex():
          prefix:term  :blank_prefix
      does not support nested blank nodes, collection, sameas ('a' token)
     '''
-    global turtle_regex_
-    if not turtle_regex_:
-        rdf_term = '(<[^ >]+>|_:\S+|".+?"(@\w+)?(\^\^\S+)?|\'.+?\'(@\w+)?(\^\^\S+)?|""".+?"""(@\w+)?(\^\^\S+)?|\'\'\'.+?\'\'\'(@\w+)?(\^\^\S+)?|[+-]?([0-9]+|[0-9]*\.[0-9]+)(E[+-]?[0-9]+)?|false|true)'
-
-        # simple case is: triple_re = '^T T T \.$'.replace('T', rdf_term)
-        # but extend to deal with multiple predicate-objects:
-        #triple = '^T T T\s*(;\s*T T\s*)*\.\s*$'.replace('T', rdf_term).replace(' ', '\s+')
-        triple = '(^T|;)\s*T T\s*(;|\.\s*$)'.replace('T', rdf_term).replace(' ', '\s+')
-        turtle_regex_ = re.compile(triple, re.MULTILINE)
-    return turtle_regex_
+    char = buf[pos:pos + 1]
+    if char == '<':
+        match = TTL_IRI_RE.match(buf, pos)
+        return match.end() if match else None
+    if char == '_':
+        match = TTL_BLANK_NODE_RE.match(buf, pos)
+        # a full stop at the end is the end of the triple, not the label
+        return match.end() - (buf[match.end() - 1] == '.') if match else None
+    if char in ('"', "'"):
+        long_quote = char * 3
+        if buf.startswith(long_quote, pos):
+            end = buf.find(long_quote, pos + 3)
+            if end == -1:
+                # it runs to the end of the (possibly truncated) buffer
+                return len(buf)
+            end += 3
+        else:
+            match = TTL_SHORT_STRING_RES[char].match(buf, pos)
+            if not match:
+                return None
+            end = match.end()
+        # optional language or datatype
+        if buf.startswith('@', end):
+            match = TTL_LANGUAGE_TAG_RE.match(buf, end)
+            return match.end() if match else None
+        if buf.startswith('^^', end):
+            if buf.startswith('<', end + 2):
+                match = TTL_IRI_RE.match(buf, end + 2)
+                return match.end() if match else None
+            match = TTL_PREFIXED_NAME_RE.match(buf, end + 2)
+            if not match:
+                return None
+            return match.end() - (buf[match.end() - 1] == '.')
+        return end
+    if char in ('t', 'f'):
+        match = TTL_BOOLEAN_RE.match(buf, pos)
+    elif char:
+        match = TTL_NUMBER_RE.match(buf, pos)
+    else:
+        return None
+    if not match or buf[match.end():match.end() + 1] not in \
+            ('',) + tuple(TTL_TERM_DELIMITERS):
+        return None
+    return match.end()
+
+
+def count_ttl_triples(buf, max_triples=None):
+    '''Returns the number of Turtle RDF triples found in the text buffer,
+    stopping once max_triples are found.
+
+    A triple is "subject predicate object" at the start of a line, or
+    "predicate object" following a semi-colon, ended by a semi-colon or a full
+    stop at the end of a line. Anything else is skipped up to the next line or
+    semi-colon.
+
+    This is a single pass over the buffer - it never goes back to try a
+    different interpretation, so bad input can't make it take long.
+    '''
+    num_triples = 0
+    pos = 0
+    # whether the next triple has a subject (i.e. not following a semi-colon)
+    needs_subject = True
+    while pos < len(buf):
+        if max_triples is not None and num_triples >= max_triples:
+            break
+        pos = TTL_LINE_SPACE_RE.match(buf, pos).end()
+        pos, triple_end = _match_ttl_triple(buf, pos, needs_subject)
+        if triple_end == ';':
+            num_triples += 1
+            needs_subject = False
+            pos = TTL_WHITESPACE_RE.match(buf, pos).end()
+        elif triple_end == '.':
+            num_triples += 1
+            needs_subject = True
+        else:
+            # carry on from where it failed, so nothing is read twice
+            match = TTL_NEXT_STATEMENT_RE.search(buf, pos)
+            if not match:
+                break
+            pos = match.end()
+            needs_subject = match.group() != ';'
+            if not needs_subject:
+                pos = TTL_WHITESPACE_RE.match(buf, pos).end()
+    return num_triples
+
+
+def _match_ttl_triple(buf, pos, needs_subject):
+    '''Matches the terms of a triple and how it ends, starting at buf[pos].
+
+    Returns (pos, triple_end) where triple_end is ';' or '.' (and pos is after
+    it), or None if it isn't a triple (and pos is where that became clear).
+    '''
+    for i in range(3 if needs_subject else 2):
+        if i:
+            # terms are separated by whitespace
+            next_pos = TTL_WHITESPACE_RE.match(buf, pos).end()
+            if next_pos == pos:
+                return pos, None
+            pos = next_pos
+        term_end = match_ttl_term(buf, pos)
+        if term_end is None:
+            return pos, None
+        pos = term_end
+    pos = TTL_WHITESPACE_RE.match(buf, pos).end()
+    if buf.startswith(';', pos):
+        return pos + 1, ';'
+    if buf.startswith('.', pos):
+        # the full stop must be at the end of a line
+        pos = TTL_LINE_SPACE_RE.match(buf, pos + 1).end()
+        if pos == len(buf) or buf[pos] == '\n':
+            return pos + 1, '.'
+    return pos, None
+
+
+# The detectors, in the registry (see ckanext.qa.sniff_registry). Each gives
+# a format dict or None.
+
+@register_detector(mimetypes=['application/xml'], cost=COST_HEAD_START)
+def detect_xml_variant(ctx, log):
+    return get_xml_variant_including_xml_declaration(ctx.head(5000), log)
+
+
+# Office documents can come up as a zip, so look for them first
+@register_detector(mimetypes=['application/zip'], cost=COST_DIRECTORY,
+                   priority=1)
+def detect_zipped_office_format(ctx, log):
+    return get_zipped_office_format(ctx, log)
+
+
+@register_detector(mimetypes=['application/zip'], cost=COST_DIRECTORY)
+def detect_zipped_format(ctx, log):
+    return get_zipped_format(ctx, log)
+
+
+# In the past Magic gives the msword mime-type for Word and other MS Office
+# files too, so look in the directory to be sure which it is, or failing that
+# use BSD File. (Given just the start of a remote file, it may only know it is
+# a compound document.) Excel files sometimes come up as octet-stream, or are
+# not picked up by magic at all.
+OFFICE_MIMETYPES = ['application/msword', 'application/vnd.ms-office',
+                    'application/x-ole-storage', 'application/CDFV2',
+                    'application/octet-stream', NO_MIMETYPE]
+
+
+@register_detector(mimetypes=OFFICE_MIMETYPES, cost=COST_DIRECTORY)
+def detect_office_format(ctx, log):
+    return get_office_format(ctx, log)
+
+
+# BSD file picks up some files that Magic misses e.g. Shapefile, some MS Word
+# files
+@register_detector(mimetypes=OFFICE_MIMETYPES, cost=COST_PROCESS)
+def detect_with_bsd_file(ctx, log):
+    return run_bsd_file_on_context(ctx, log)
+
+
+@register_detector(mimetypes=['application/octet-stream'],
+                   cost=COST_HEAD_START)
+def detect_html(ctx, log):
+    return is_html(ctx.head(500), log)
+
+
+@register_detector(mimetypes=COMPRESSED_MIMETYPES.keys(), cost=COST_PARSE)
+def detect_compressed_format(ctx, log):
+    return get_compressed_format(ctx, ctx.mimetype(), log)
+
+
+# Magic does not distinguish JSON Lines from JSON. Text that CKAN doesn't
+# have a more specific format for might be JSON, CSV, PSV etc too. For text,
+# the priorities keep the order: JSON, delimited, XML and then Turtle.
+@register_detector(mimetypes=['application/json', 'application/x-ndjson'],
+                   cost=COST_HEAD)
+@register_detector(mimetypes=['text/*'], formats=('TXT', None),
+                   cost=COST_HEAD, priority=2, name='detect_json_in_text')
+def detect_json(ctx, log):
+    return get_json_variant(ctx.text(10000), log)
+
+
+# Magic can mistake IATI for HTML
+@register_detector(mimetypes=['text/html'], cost=COST_HEAD_START)
+def detect_iati(ctx, log):
+    return is_iati(ctx.head(100), log)
+
+
+@register_detector(mimetypes=['text/*'], formats=('TXT', None),
+                   cost=COST_HEAD, priority=1)
+def detect_delimited_format(ctx, log):
+    return get_delimited_format(ctx.text(10000), log)
+
+
+# XML files without the "<?xml ... ?>" tag come up as text
+@register_detector(mimetypes=['text/*'], formats=('TXT',),
+                   cost=COST_HEAD_START)
+def detect_xml_without_declaration(ctx, log):
+    buf = ctx.text(10000)
+    if is_xml_but_without_declaration(buf, log):
+        return get_xml_variant_without_xml_declaration(buf, log)
+
+
+# Only when the text is none of the others, as a few lines of other things
+# can look like Turtle
+@register_detector(mimetypes=['text/*'], formats=('TXT',), cost=COST_HEAD,
+                   priority=-1)
+def detect_ttl(ctx, log):
+    if is_ttl(ctx.text(10000), log):
+        return {'format': 'TTL'}
+
+
+@register_detector(mimetypes=['text/html'], formats=('HTML',),
+                   cost=COST_HEAD)
+def detect_rdfa(ctx, log):
+    if has_rdfa(ctx, log):
+        return {'format': 'RDFa'}
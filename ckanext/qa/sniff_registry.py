@@ -0,0 +1,150 @@
+'''
+The registry of detectors that sniff_format uses to work out a file's format.
+
+Each detector says which files it applies to (by the mimetype libmagic gives
+and the format that mimetype translates to), how expensive it is, and its
+priority. For each mimetype, the detectors that apply are worked out once and
+kept in a dispatch table, in the order to run them: highest priority first,
+then cheapest first. The first detector to return a format wins.
+
+Other extensions can add detectors with an entry point in the
+"ckanext.qa.detectors" group, pointing at a Detector (or a list of them),
+e.g. in their setup.py::
+
+    entry_points={
+        'ckanext.qa.detectors': [
+            'geojson = ckanext.myext.sniff:geojson_detector',
+        ],
+    },
+'''
+import fnmatch
+import threading
+
+import pkg_resources
+
+ENTRY_POINT_GROUP = 'ckanext.qa.detectors'
+
+# Means the detector applies when libmagic gives no mimetype
+NO_MIMETYPE = None
+
+# Rough costs, for ordering the detectors
+COST_HEAD_START = 0  # looks at the first few hundred bytes
+COST_HEAD = 1  # scans the head of the file
+COST_DIRECTORY = 2  # reads a directory, from elsewhere in the file
+COST_PARSE = 3  # parses the head with a library
+COST_PROCESS = 5  # runs another process
+
+
+class Detector(object):
+    '''A detector: func(ctx, log) returns a format dict or None.
+
+    mimetypes - the libmagic mimetypes it applies to. Patterns like 'text/*'
+                can be used, and NO_MIMETYPE for when there is none. None
+                means it applies to all mimetypes.
+    formats - it only applies if the mimetype translates to one of these
+              formats (None meaning it doesn't translate to one), e.g.
+              ('TXT', None). None means it applies whatever the format.
+    cost - see the COST_* constants
+    priority - detectors with a higher priority run before cheaper ones
+    '''
+    def __init__(self, func, mimetypes=None, formats=None,
+                 cost=COST_HEAD, priority=0, name=None):
+        self.func = func
+        self.mimetypes = mimetypes
+        self.formats = formats
+        self.cost = cost
+        self.priority = priority
+        self.name = name or func.__name__
+
+    def __repr__(self):
+        return '<Detector %s cost=%s priority=%s>' % (self.name, self.cost,
+                                                      self.priority)
+
+    def applies_to_mimetype(self, mime_type):
+        if self.mimetypes is None:
+            return True
+        for pattern in self.mimetypes:
+            if pattern is NO_MIMETYPE or mime_type is None:
+                if pattern is mime_type:
+                    return True
+            elif fnmatch.fnmatchcase(mime_type, pattern):
+                return True
+        return False
+
+    def applies_to_format(self, mimetype_format):
+        return self.formats is None or mimetype_format in self.formats
+
+
+class DetectorRegistry(object):
+    def __init__(self):
+        self._detectors = []
+        self._dispatch_table = {}
+        self._entry_points_loaded = False
+        self._lock = threading.Lock()
+
+    def register(self, detector):
+        '''Adds a Detector (or a list of them).'''
+        detectors = detector if isinstance(detector, (list, tuple)) \
+            else [detector]
+        with self._lock:
+            for detector in detectors:
+                if detector.name in [d.name for d in self._detectors]:
+                    raise ValueError('Detector %r is already registered'
+                                     % detector.name)
+                self._detectors.append(detector)
+            self._dispatch_table = {}
+
+    def load_entry_points(self):
+        if self._entry_points_loaded:
+            return
+        self._entry_points_loaded = True
+        for entry_point in pkg_resources.iter_entry_points(ENTRY_POINT_GROUP):
+            self.register(entry_point.load())
+
+    def detectors_for_mimetype(self, mime_type):
+        '''Returns the detectors that apply to the mimetype, in the order to
+        run them.'''
+        try:
+            return self._dispatch_table[mime_type]
+        except KeyError:
+            pass
+        self.load_entry_points()
+        with self._lock:
+            detectors = sorted(
+                (d for d in self._detectors
+                 if d.applies_to_mimetype(mime_type)),
+                key=lambda d: (-d.priority, d.cost))
+            self._dispatch_table[mime_type] = detectors
+        return detectors
+
+    def detect(self, ctx, mime_type, mimetype_format, log):
+        '''Runs the detectors that apply, until one returns a format, and
+        returns that, or None.
+
+        Each detector runs within the sniff's budget, and only once for a
+        SniffContext, however many times it is asked for.'''
+        results = ctx.cache.setdefault('detector_results', {})
+        for detector in self.detectors_for_mimetype(mime_type):
+            if not detector.applies_to_format(mimetype_format):
+                continue
+            if detector.name not in results:
+                results[detector.name] = ctx.run(detector.func, ctx, log)
+            if results[detector.name]:
+                return results[detector.name]
+
+
+registry = DetectorRegistry()
+
+
+def register_detector(func=None, **kwargs):
+    '''Registers a detector function (see Detector for the keyword args). Can
+    be used as a decorator::
+
+        @register_detector(mimetypes=['text/*'], cost=COST_HEAD)
+        def detect_something(ctx, log):
+            ...
+    '''
+    if func is None:
+        return lambda func: register_detector(func, **kwargs)
+    registry.register(Detector(func, **kwargs))
+    return func
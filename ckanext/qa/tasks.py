@@ -5,7 +5,7 @@ Berners-Lee\'s five stars of openness
 import datetime
 import json
 import os
-import traceback
+import threading
 import urlparse
 import routes
 
@@ -14,13 +14,21 @@ _ = lambda value: value
 from ckan.lib import celery_app
 from ckan.lib import i18n
 from ckan.plugins import toolkit
-import ckan.lib.helpers as ckan_helpers
-from ckanext.qa.sniff_format import sniff_file_format
+from ckanext.qa.sniff_format import sniff_file_format, DETECTOR_VERSION
+from ckanext.qa import sniff_format
+from ckanext.qa.remote_sniff import sniff_url_format
 from ckanext.qa import lib
+from ckanext.qa import scoring
+from ckanext.qa.scoring import (
+    score_sniffed_format, extension_variants, format_get)
 from ckanext.archiver.model import Archival, Status
 class QAError(Exception):
     pass
 
+# Counts of how often a sniff result was found in the SniffCache, for this
+# process
+sniff_cache_stats = {'hits': 0, 'misses': 0}
+
 # Description of each score, used elsewhere
 OPENNESS_SCORE_DESCRIPTION = {
     0: 'Not obtainable or license is not open',
@@ -32,14 +40,32 @@ OPENNESS_SCORE_DESCRIPTION = {
 }
 
 
+# The config loaded by this process, and the (ini path, mtime) it was loaded
+# from, so that it is only loaded again if the file changes
+_loaded_config = {'key': None, 'conf': None}
+# The key of the config that routes and translations are set-up for in this
+# thread
+_thread_config = threading.local()
+
+
 def load_config(ckan_ini_filepath):
-    import paste.deploy
+    '''Loads the CKAN environment for a task. It is only loaded once for a
+    worker process, unless the config file is changed.'''
     config_abs_path = os.path.abspath(ckan_ini_filepath)
-    conf = paste.deploy.appconfig('config:' + config_abs_path)
-    import ckan
-    ckan.config.environment.load_environment(conf.global_conf,
-                                             conf.local_conf)
-
+    key = (config_abs_path, os.path.getmtime(config_abs_path))
+    if _loaded_config['key'] != key:
+        import paste.deploy
+        conf = paste.deploy.appconfig('config:' + config_abs_path)
+        import ckan
+        ckan.config.environment.load_environment(conf.global_conf,
+                                                 conf.local_conf)
+        _loaded_config.update(key=key, conf=conf)
+    if getattr(_thread_config, 'key', None) != key:
+        load_thread_config(_loaded_config['conf'])
+        _thread_config.key = key
+
+
+def load_thread_config(conf):
     ## give routes enough information to run url_for
     parsed = urlparse.urlparse(conf.get('ckan.site_url', 'http://0.0.0.0'))
     request_config = routes.request_config()
@@ -75,42 +101,74 @@ def load_translations(lang):
     registry.register(translator, fakepylons.translator)
 
 @celery_app.celery.task(name="qa.update_package")
-def update_package(ckan_ini_filepath, package_id):
+def update_package(ckan_ini_filepath, package_id, force=False,
+                   defer_index=False):
     """
     Given a package, calculates an openness score for each of its resources.
     It is more efficient to call this than 'update' for each resource.
 
+    Resources are skipped if the things their score is based on have not
+    changed since they were last scored, unless force is True.
+
+    If defer_index is True, the package is queued to be search indexed in a
+    batch with others, rather than straight away.
+
     Returns None
     """
     log = update_package.get_logger()
     load_config(ckan_ini_filepath)
 
     try:
-        update_package_(package_id, log)
+        update_package_(package_id, log, force=force, defer_index=defer_index)
     except Exception, e:
         log.error('Exception occurred during QA update_package: %s: %s',
                   e.__class__.__name__,  unicode(e))
         raise
 
-def update_package_(package_id, log):
+def update_package_(package_id, log, force=False, defer_index=False):
     from ckan import model
 
     package = model.Package.get(package_id)
     if not package:
         raise QAError('Package ID not found: %s' % package_id)
 
+    resources = package.resources
     log.info('Openness scoring package %s (%i resources)', package.name,
-             len(package.resources))
-    
-    for resource in package.resources:
-        qa_result = resource_score(resource, log)
+             len(resources))
+
+    # Score all the resources in memory, from the Archival and QA rows loaded
+    # up-front, and then save the results in one go
+    rows = PackageRows.load([resource.id for resource in resources])
+    qa_results = []
+    num_unchanged = 0
+    for resource in resources:
+        if not force and is_qa_up_to_date(resource, package, rows):
+            num_unchanged += 1
+            continue
+        qa_result = resource_score(resource, log, rows=rows)
         log.info('Openness scoring: \n%r\n%r\n%r\n\n', qa_result, resource,
                  resource.url)
-        save_qa_result(resource, qa_result, log)
-        log.info('CKAN updated with openness score')
-    # Refresh the index for this dataset, so that it contains the latest
-    # qa info
-    _update_search_index(package.id, log)
+        qa_results.append((resource, qa_result))
+    if num_unchanged:
+        log.info('Skipped %i resources whose inputs have not changed since '
+                 'they were scored', num_unchanged)
+    if qa_results:
+        save_qa_results(qa_results, log, package_id=package.id)
+        log.info('CKAN updated with openness scores')
+        # Refresh the index for this dataset, so that it contains the latest
+        # qa info
+        if defer_index:
+            _queue_search_index(package.id, log)
+        else:
+            _update_search_index(package.id, log)
+    if sniff_cache_stats['hits'] or sniff_cache_stats['misses']:
+        log.info('Sniff cache (this process so far): %(hits)s hits, '
+                 '%(misses)s misses', sniff_cache_stats)
+    if sniff_format.budget_overruns:
+        log.info('Sniff budget overruns (this process so far): %s',
+                 ', '.join('%s=%s' % item for item in
+                           sorted(sniff_format.budget_overruns.items())))
+    sniff_format.log_detector_timings(log)
 
 
 @celery_app.celery.task(name="qa.update")
@@ -161,153 +219,114 @@ def update_resource_(resource_id, log):
     return json.dumps(qa_result)
 
 
-def get_qa_format(resource_id):
+class PackageRows(object):
+    '''The Archival and QA rows for a package's resources, loaded with one
+    query each, so that the resources can be scored without a query each.'''
+    def __init__(self, archivals, qas):
+        self.archivals = archivals  # resource_id: Archival
+        self.qas = qas  # resource_id: QA
+
+    @classmethod
+    def load(cls, resource_ids):
+        from ckan import model
+        from ckanext.qa.model import QA
+        if not resource_ids:
+            return cls({}, {})
+        archivals = model.Session.query(Archival) \
+            .filter(Archival.resource_id.in_(resource_ids)) \
+            .all()
+        qas = model.Session.query(QA) \
+            .filter(QA.resource_id.in_(resource_ids)) \
+            .all()
+        return cls(dict((a.resource_id, a) for a in archivals),
+                   dict((q.resource_id, q) for q in qas))
+
+
+def resource_inputs_hash(resource, archival, package, rows=None):
+    '''Returns a hash of the things that the resource's score is based on
+    (see scoring.inputs_hash).'''
+    return scoring.inputs_hash(resource_as_dict(resource, package, rows),
+                               archival_as_dict(archival),
+                               is_remote_sniff_enabled())
+
+
+def is_qa_up_to_date(resource, package, rows):
+    '''Returns whether the resource's QA was based on the same inputs (and
+    table of scores) as it has now, so does not need doing again.'''
+    qa = rows.qas.get(resource.id)
+    if not qa or not qa.inputs_hash or \
+            qa.scores_hash != lib.resource_format_scores_hash():
+        return False
+    return qa.inputs_hash == resource_inputs_hash(
+        resource, rows.archivals.get(resource.id), package, rows)
+
+
+def get_qa_format(resource_id, rows=None):
     '''Returns the format of the resource, as recorded in the QA table.'''
     from ckanext.qa.model import QA
-    q = QA.get_for_resource(resource_id)
+    if rows is not None:
+        q = rows.qas.get(resource_id)
+    else:
+        q = QA.get_for_resource(resource_id)
     if not q:
         return ''
     return q.format
 
 
-def format_get(key):
-    '''Returns a resource format, as defined in ckan.
-
-    :param key: format extension / mimetype / title e.g. 'CSV',
-                'application/msword', 'Word document'
-    :param key: string
-    :returns: format string
-    '''
-    format_tuple = ckan_helpers.resource_formats().get(key.lower())
-    if not format_tuple:
-        return
-    return format_tuple[1]  # short name
-
-
-def resource_score(resource, log):
+def resource_score(resource, log, rows=None):
     """
     Score resource on Sir Tim Berners-Lee\'s five stars of openness.
 
+    rows - a PackageRows with the resource's Archival and QA already loaded,
+           or None to query for them
+
     Returns a dict with keys:
 
         'openness_score': score (int)
         'openness_score_reason': the reason for the score (string)
         'format': format of the data (string)
         'archival_timestamp': time of the archival that this result is based on (iso string)
+        'inputs_hash': hash of the things that this result is based on (string)
 
     Raises QAError for reasonable errors
     """
-    score = 0
-    score_reason = ''
-    format_ = None
-
-    try:
-        score_reasons = []  # a list of strings detailing how we scored it
+    if rows is not None:
+        archival = rows.archivals.get(resource.id)
+    else:
         archival = Archival.get_for_resource(resource_id=resource.id)
-        if not resource:
-            raise QAError('Could not find resource "%s"' % resource.id)
-
-        score, format_ = score_if_link_broken(archival, resource, score_reasons, log)
-        if score == None:
-            # we don't want to take the publisher's word for it, in case the link
-            # is only to a landing page, so highest priority is the sniffed type
-            #score, format_ = score_by_sniffing_data(archival, resource,
-            #                                        score_reasons, log)
-            if score == None:
-                # Fall-backs are user-given data
-                score, format_ = score_by_url_extension(resource, score_reasons, log)
-                if score == None:
-                    score, format_ = score_by_format_field(resource, score_reasons, log)
-                    if score == None:
-                        log.warning('Could not score resource: "%s" with url: "%s"',
-                                    resource.id, resource.url)
-                        score_reasons.append(_('Could not understand the file format, therefore score is 1.'))
-                        score = 1
-                        if format_ == None:
-                            # use any previously stored format value for this resource
-                            format_ = get_qa_format(resource.id)
-        score_reason = ' '.join(score_reasons)
-        format_ = format_ or None
-    except Exception, e:
-        log.error('Unexpected error while calculating openness score %s: %s\nException: %s', e.__class__.__name__,  unicode(e), traceback.format_exc())
-        score_reason = _("Unknown error: %s") % str(e)
-        raise
-
-    # Even if we can get the link, we should still treat the resource
-    # as having a score of 0 if the license isn't open.
-    #
-    # It is important we do this check after the link check, otherwise
-    # the link checker won't get the chance to see if the resource
-    # is broken.
     if toolkit.check_ckan_version(max_version='2.2.99'):
         package = resource.resource_group.package
     else:
         package = resource.package
-    #if score > 0 and not package.isopen():
-    if score > 0 and not package.license_id:
-        score_reason = _('License not open')
-        score = 0
-
-    log.info('Score: %s Reason: %s', score, score_reason)
-
-    archival_updated = archival.updated.isoformat() \
-        if archival and archival.updated else None
-    result = {
-        'openness_score': score,
-        'openness_score_reason': score_reason,
-        'format': format_,
-        'archival_timestamp': archival_updated
-    }
-    return result
-
-
-def broken_link_error_message(archival):
-    '''Given an archival for a broken link, it returns a helpful
-    error message (string) describing the attempts.'''
-    def format_date(date):
-        if date:
-            return date.strftime('%d/%m/%Y')
-        else:
-            return ''
-    messages = [_('File could not be downloaded.'),
-                _('Reason') + ':', unicode(archival.status) + '.',
-                _('Error details: %s.') % archival.reason,
-                _('Attempted on %s.') % format_date(archival.updated)]
-    last_success = format_date(archival.last_success)
-    if archival.failure_count == 1:
-        if last_success:
-            messages.append(_('This URL last worked on: %s.') % last_success)
-        else:
-            messages.append(_('This was the first attempt.'))
-    else:
-        messages.append(_('Tried %s times since %s.') % \
-                        (archival.failure_count,
-                         format_date(archival.first_failure)))
-        if last_success:
-            messages.append(_('This URL last worked on: %s.') % last_success)
-        else:
-            messages.append(_('This URL has not worked in the history of this tool.'))
-    return ' '.join(messages)
 
+    # Sniff the file the archiver kept, or if it didn't keep it, the remote
+    # file, if that is enabled
+    sniff = lambda score_reasons: score_by_sniffing_data(
+        archival, resource, score_reasons, log)
+    return scoring.score_resource(
+        resource_as_dict(resource, package, rows),
+        archival_as_dict(archival), log, sniff=sniff,
+        sniffing=is_remote_sniff_enabled())
 
-def score_if_link_broken(archival, resource, score_reasons, log):
-    '''
-    Looks to see if the archiver said it was broken, and if so, writes to
-    the score_reasons and returns a score.
 
-    Return values:
-      * Returns a tuple: (score, format_)
-      * score is an integer or None if it cannot be determined
-      * format_ is a string or None
-      * is_broken is a boolean
-    '''
-    if archival and archival.is_broken:
-        # Score 0 since we are sure the link is currently broken
-        score_reasons.append(broken_link_error_message(archival))
-        format_ = get_qa_format(resource.id)
-        log.info('Archiver says link is broken. Previous format: %r' % format_)
-        return (0, format_)
-    return (None, None)
+def resource_as_dict(resource, package, rows=None):
+    '''Returns the resource as a dict, for scoring.'''
+    return {
+        'id': resource.id,
+        'url': resource.url,
+        'format': resource.format,
+        'license_id': package.license_id if package else None,
+        'qa_format': get_qa_format(resource.id, rows),
+        }
+
+
+def archival_as_dict(archival):
+    '''Returns the archival as a dict, for scoring.'''
+    if not archival:
+        return None
+    return dict((key, getattr(archival, key))
+                for key in scoring.ARCHIVAL_FIELDS)
+
 
 def score_by_sniffing_data(archival, resource, score_reasons, log):
     '''
@@ -320,6 +339,12 @@ def score_by_sniffing_data(archival, resource, score_reasons, log):
       * If it cannot work out the format then format_string is None
       * If it cannot score it, then score is None
     '''
+    if (not archival or not archival.cache_filepath or
+            not os.path.exists(archival.cache_filepath)) and \
+            is_remote_sniff_enabled() and resource.url:
+        # Fetch just the parts of the file needed to sniff it
+        return score_sniffed_format(sniff_url_format(resource.url, log),
+                                    score_reasons)
     if not archival or not archival.cache_filepath:
         score_reasons.append(_('This file had not been downloaded at the time of scoring it.'))
         return (None, None)
@@ -331,15 +356,8 @@ def score_by_sniffing_data(archival, resource, score_reasons, log):
         return (None, None)
     else:
         if filepath:
-            sniffed_format = sniff_file_format(filepath, log)
-            score = lib.resource_format_scores().get(sniffed_format['format']) \
-                if sniffed_format else None
-            if sniffed_format:
-                score_reasons.append(_('Content of file appeared to be format "%s" which receives openness score: %s.') % (sniffed_format['format'], score))
-                return score, sniffed_format['format']
-            else:
-                score_reasons.append(_('The format of the file was not recognized from its contents.'))
-                return (None, None)
+            sniffed_format = sniff_file_format_cached(filepath, archival, log)
+            return score_sniffed_format(sniffed_format, score_reasons)
         else:
             # No cache_url
             if archival.status_id == Status.by_text('Chose not to download'):
@@ -356,79 +374,127 @@ def score_by_sniffing_data(archival, resource, score_reasons, log):
                 return (None, None)
 
 
-def score_by_url_extension(resource, score_reasons, log):
-    '''
-    Looks at the URL for a resource to determine its format and score.
-
-    It adds strings to score_reasons list about how it came to the conclusion.
+def is_remote_sniff_enabled():
+    '''Returns whether resources that the archiver has not kept a copy of
+    should be sniffed remotely (config option qa.remote_sniff).'''
+    from pylons import config
+    return toolkit.asbool(config.get('qa.remote_sniff', False))
 
-    Return values:
-      * It returns a tuple: (score, format_string)
-      * If it cannot work out the format then format is None
-      * If it cannot score it, then score is None
-    '''
-    extension_variants_ = extension_variants(resource.url.strip())
-    if not extension_variants_:
-        score_reasons.append(_('Could not determine a file extension in the URL.'))
-        return (None, None)
-    for extension in extension_variants_:
-        format_ = format_get(extension)
-        if format_:
-            score = lib.resource_format_scores().get(format_)
-            if score:
-                score_reasons.append(_('URL extension "%s" relates to format "%s" and receives score: %s.') % (extension, format_, score))
-                return score, format_
-            else:
-                score = 1
-                score_reasons.append(_('URL extension "%s" relates to format "%s" but a score for that format is not configured, so giving it default score %s.') % (extension, format_, score))
-                return score, format_
-        score_reasons.append(_('URL extension "%s" is an unknown format.') % extension)
-    return (None, None)
 
-def extension_variants(url):
-    '''
-    Returns a list of extensions, in order of which would more
-    significant.
+def sniff_file_format_cached(filepath, archival, log):
+    '''Returns the sniff_file_format result for the archived file. If the
+    sniff cache is enabled (qa.sniff_cache = true) then the result is looked
+    up by the archiver\'s hash of the file contents, so that identical files
+    are only sniffed once.'''
+    from pylons import config
+    from ckanext.qa.model import SniffCache
+    content_hash = getattr(archival, 'hash', None)
+    if not content_hash or \
+            not toolkit.asbool(config.get('qa.sniff_cache', False)):
+        return sniff_file_format(filepath, log)
 
-    >>> extension_variants('http://dept.gov.uk/coins.data.1996.csv.zip')
-    ['csv.zip', 'zip']
-    >>> extension_variants('http://dept.gov.uk/data.csv?callback=1')
-    ['csv']
-    '''
-    url = url.split('?')[0] # get rid of params
-    url = url.split('/')[-1] # get rid of path - leaves filename
-    split_url = url.split('.')
-    results = []
-    for number_of_sections in [2, 1]:
-        if len(split_url) > number_of_sections:
-            results.append('.'.join(split_url[-number_of_sections:]))
-    return results
+    from ckan import model
+    cached = SniffCache.get(content_hash, DETECTOR_VERSION)
+    if cached:
+        sniff_cache_stats['hits'] += 1
+        cached.record_hit()
+        log.info('Sniff cache hit for hash %s: %r', content_hash,
+                 cached.format)
+        return cached.as_format_dict()
+    sniff_cache_stats['misses'] += 1
+    sniffed_format = sniff_file_format(filepath, log)
+    if sniffed_format and sniffed_format.get('sniff_truncated'):
+        # a sniff with more time might do better, so don't keep it
+        return sniffed_format
+    # Another worker may be sniffing an identical file at the same time, so
+    # save it in a savepoint, so that if the other saves it first, only that
+    # is rolled back, not the rest of the QA
+    from sqlalchemy.exc import IntegrityError
+    model.Session.begin_nested()
+    try:
+        model.Session.add(SniffCache.create(content_hash, DETECTOR_VERSION,
+                                            sniffed_format))
+        model.Session.commit()
+    except IntegrityError:
+        model.Session.rollback()
+        log.info('Sniff cache entry already saved for hash %s', content_hash)
+    return sniffed_format
 
 
-def score_by_format_field(resource, score_reasons, log):
+def rescore_formats(old_scores, new_scores, log):
     '''
-    Looks at the format field of a resource to determine its format and score.
-
-    It adds strings to score_reasons list about how it came to the conclusion.
-
-    Return values:
-      * It returns a tuple: (score, format_string)
-      * If it cannot work out the format then format_string is None
-      * If it cannot score it, then score is None
+    Updates the QA of resources whose format's score has changed between
+    two score tables (dicts of format: score), with an UPDATE for each
+    change of score, rather than scoring the resources again. The score
+    reasons are rewritten with the new score. Resources scored 0 (because
+    the link is broken or the licence is not open) are left alone. The
+    scores_hash of the QA done with the old table is then updated, for the
+    resources rescored and those whose format's score is unchanged, so that
+    they are not done again.
+
+    Returns (package_ids, formats_to_requalify): the ids of the packages
+    updated, and the formats added to or removed from the table or scored 0
+    in either, whose resources need scoring again fully (as they get a
+    default score when not scored in the table).
     '''
-    format_field = resource.format or ''
-    if not format_field:
-        score_reasons.append(_('Format field is blank.'))
-        return (None, None)
-    format_tuple = ckan_helpers.resource_formats().get(format_field.lower()) or \
-        ckan_helpers.resource_formats().get(lib.munge_format_to_be_canonical(format_field))
-    if not format_tuple:
-        score_reasons.append(_('Format field "%s" does not correspond to a known format.') % format_field)
-        return (None, None)
-    score = lib.resource_format_scores().get(format_tuple[1])
-    score_reasons.append(_('Format field "%s" receives score: %s.') %
-                         (format_field, score))
-    return (score, format_tuple[1])
+    from sqlalchemy import func, case, or_
+    from ckan import model
+    from ckanext.qa.model import QA
+
+    changes = {}  # (old_score, new_score): [format, ...]
+    formats_to_requalify = []
+    for format_ in sorted(set(old_scores) | set(new_scores)):
+        old_score = old_scores.get(format_)
+        new_score = new_scores.get(format_)
+        if old_score == new_score:
+            continue
+        if not old_score or not new_score:
+            formats_to_requalify.append(format_)
+            continue
+        changes.setdefault((old_score, new_score), []).append(format_)
+
+    old_scores_hash = lib.resource_format_scores_hash(old_scores)
+    new_scores_hash = lib.resource_format_scores_hash(new_scores)
+    scores_hash = case([(QA.scores_hash == old_scores_hash, new_scores_hash)],
+                       else_=QA.scores_hash)
+    package_ids = set()
+    reason = QA.openness_score_reason
+    for (old_score, new_score), formats in sorted(changes.items()):
+        num_updated = 0
+        for ending in scoring.SCORE_ENDINGS:
+            old_ending, new_ending = ending % old_score, ending % new_score
+            q = model.Session.query(QA) \
+                .filter(QA.format.in_(formats)) \
+                .filter(QA.openness_score == old_score) \
+                .filter(QA.openness_score > 0) \
+                .filter(reason.like('%' + old_ending))
+            package_ids.update(
+                row[0] for row in q.with_entities(QA.package_id).distinct())
+            # rewrite only the ending, as the score may appear earlier too
+            new_reason = func.substr(
+                reason, 1, func.length(reason) - len(old_ending)) \
+                .concat(new_ending)
+            num_updated += q.update({QA.openness_score: new_score,
+                                     QA.openness_score_reason: new_reason,
+                                     QA.scores_hash: scores_hash,
+                                     QA.updated: datetime.datetime.now()},
+                                    synchronize_session=False)
+        log.info('Rescored %i resources of format %s from %s to %s',
+                 num_updated, '/'.join(formats), old_score, new_score)
+
+    # The rest of the resources of the changed formats would now be scored
+    # differently, so keep the old hash, for them to be done again
+    changed_formats = set(formats_to_requalify)
+    for formats in changes.values():
+        changed_formats.update(formats)
+    q = model.Session.query(QA).filter(QA.scores_hash == old_scores_hash)
+    if changed_formats:
+        q = q.filter(or_(QA.format == None, ~QA.format.in_(changed_formats)))
+    num_rehashed = q.update({QA.scores_hash: new_scores_hash},
+                            synchronize_session=False)
+    log.info('Updated the scores hash of %i resources whose format\'s score '
+             'is unchanged', num_rehashed)
+    return package_ids, formats_to_requalify
 
 
 def _update_search_index(package_id, log):
@@ -445,28 +511,130 @@ def _update_search_index(package_id, log):
     log.info('Search indexed %s', package['name'])
 
 
+def _queue_search_index(package_id, log):
+    '''
+    Queues the package to be search indexed in a batch with others, by
+    "paster qa search-index watch".
+    '''
+    from ckan import model
+    from ckanext.qa.model import SearchIndexQueue
+    SearchIndexQueue.add(package_id)
+    model.Session.commit()
+    log.info('Queued for search indexing')
+
+
+def get_search_index_batch_size():
+    from pylons import config
+    return int(config.get('qa.search_index.batch_size', 500))
+
+
+# A batch claimed for indexing longer ago than this is claimed again, as
+# whatever claimed it must have died
+SEARCH_INDEX_CLAIM_TIMEOUT = datetime.timedelta(hours=1)
+
+
+def is_search_index_flush_due(batch_size, interval):
+    '''Returns whether the datasets queued for search indexing should be
+    indexed now: when there are a batch_size of them, or one has been queued
+    for interval seconds.'''
+    from ckanext.qa.model import SearchIndexQueue
+    stats = SearchIndexQueue.stats()
+    if stats['datasets'] >= batch_size:
+        return True
+    return bool(stats['oldest']) and datetime.datetime.now() - \
+        stats['oldest'] >= datetime.timedelta(seconds=interval)
+
+
+def flush_search_index_queue(log, batch_size=None, max_batches=None):
+    '''
+    Search indexes the packages queued for it, in batches, with one commit
+    of the search index for each batch. Each batch is claimed first, so if
+    this runs in more than one place at once, they index different packages.
+    Returns the number of packages indexed.
+    '''
+    import uuid
+    from ckan import model
+    from ckan.lib.search.index import PackageSearchIndex
+    from ckanext.qa.model import SearchIndexQueue
+    batch_size = batch_size or get_search_index_batch_size()
+    package_index = PackageSearchIndex()
+    context_ = {'model': model, 'ignore_auth': True, 'session': model.Session,
+                'use_cache': False, 'validate': False}
+    num_indexed = 0
+    num_batches = 0
+    while max_batches is None or num_batches < max_batches:
+        claimant = unicode(uuid.uuid4())
+        package_ids = SearchIndexQueue.claim_batch(
+            batch_size, claimant,
+            datetime.datetime.now() - SEARCH_INDEX_CLAIM_TIMEOUT)
+        if not package_ids:
+            break
+        for package_id in package_ids:
+            try:
+                package = toolkit.get_action('package_show')(
+                    context_, {'id': package_id})
+            except toolkit.ObjectNotFound:
+                log.warning('Dataset queued for indexing no longer exists: '
+                            '%s', package_id)
+                continue
+            package_index.index_package(package, defer_commit=True)
+            num_indexed += 1
+        package_index.commit()
+        SearchIndexQueue.remove(claimant)
+        model.Session.commit()
+        num_batches += 1
+        log.info('Search indexed a batch of %i datasets', len(package_ids))
+    return num_indexed
+
+
 def save_qa_result(resource, qa_result, log):
     """
     Saves the results of the QA check to the qa table.
     """
+    from ckanext.qa.model import QA
+
+    save_qa_results([(resource, qa_result)], log)
+    return QA.get_for_resource(resource.id)  # for tests
+
+
+def save_qa_results(qa_results, log, package_id=None):
+    """
+    Saves the results of the QA checks of many resources to the qa table,
+    inserting or updating the row for each resource, with one commit.
+
+    qa_results - a list of (resource, qa_result)
+    package_id - the package of all the resources, if known
+    """
     import ckan.model as model
     from ckanext.qa.model import QA
 
     now = datetime.datetime.now()
 
-    qa = QA.get_for_resource(resource.id)
-    if not qa:
-        qa = QA.create(resource.id)
-        model.Session.add(qa)
-    else:
-        log.info(u'QA from before: %r', qa)
-
-    for key in ('openness_score', 'openness_score_reason', 'format'):
-        setattr(qa, key, qa_result[key])
-    qa.archival_timestamp = qa_result['archival_timestamp']
-    qa.updated = now
+    values = []
+    for resource, qa_result in qa_results:
+        qa_values = dict((key, qa_result[key]) for key in
+                         ('openness_score', 'openness_score_reason',
+                          'format'))
+        qa_values['resource_id'] = resource.id
+        qa_values['package_id'] = package_id or _get_package_id(resource)
+        qa_values['archival_timestamp'] = \
+            scoring.parse_timestamp(qa_result['archival_timestamp'])
+        qa_values['inputs_hash'] = qa_result.get('inputs_hash')
+        qa_values['scores_hash'] = qa_result.get('scores_hash')
+        qa_values['updated'] = now
+        values.append(qa_values)
+    QA.upsert(values)
 
     model.Session.commit()
 
-    log.info('QA results updated ok')
-    return qa  # for tests
+    log.info('QA results updated ok (%i resources)', len(values))
+
+
+def _get_package_id(resource):
+    if toolkit.check_ckan_version(max_version='2.2.99'):
+        package = resource.resource_group.package
+    else:
+        package = resource.package
+    if not package:
+        raise QAError('Resource not connected to a package: %s' % resource.id)
+    return package.id
@@ -8,6 +8,8 @@ from time import sleep
 from wsgiref.simple_server import make_server
 import urllib2
 import socket
+import os
+import re
 
 class MockHTTPServer(object):
     """
@@ -145,3 +147,40 @@ class MockTimeoutTestServer(MockHTTPServer):
         start_response('200 OK', [('Content-Type', 'text/plain')])
         return ['xyz']
 
+class MockRangeFileServer(MockHTTPServer):
+    """
+    Serves the files in a directory, eg 'http://localhost/data.csv', doing
+    HTTP Range requests (unless ``ranges`` is False). Counts the bytes sent in
+    ``bytes_sent``.
+    """
+    def __init__(self, directory, ranges=True):
+        super(MockRangeFileServer, self).__init__()
+        self.directory = directory
+        self.ranges = ranges
+        self.bytes_sent = 0
+
+    def __call__(self, environ, start_response):
+        path = os.path.join(self.directory, environ['PATH_INFO'].lstrip('/'))
+        if not os.path.isfile(path):
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return ['Not found']
+        with open(path, 'rb') as f:
+            content = f.read()
+        match = re.match(r'bytes=(\d+)-(\d*)$', environ.get('HTTP_RANGE', ''))
+        if self.ranges and match:
+            start = int(match.group(1))
+            end = min(int(match.group(2) or len(content) - 1),
+                      len(content) - 1)
+            if start >= len(content):
+                start_response('416 Requested Range Not Satisfiable',
+                               [('Content-Range', 'bytes */%d' % len(content))])
+                return ['']
+            body = content[start:end + 1]
+            start_response('206 Partial Content', [
+                ('Content-Range', 'bytes %d-%d/%d' % (start, end, len(content))),
+                ('Content-Length', str(len(body)))])
+        else:
+            body = content
+            start_response('200 OK', [('Content-Length', str(len(body)))])
+        self.bytes_sent += len(body)
+        return [body]
@@ -0,0 +1,75 @@
+import json
+import os
+import tempfile
+
+import mock
+from nose.tools import assert_equal
+
+from ckanext.qa import lib
+from ckanext.qa.lib import FormatIndex
+
+RESOURCE_FORMATS = {
+    'csv': ['text/csv', 'CSV', 'Comma Separated Values File'],
+    'text/csv': ['text/csv', 'CSV', 'Comma Separated Values File'],
+    'comma separated values file': ['text/csv', 'CSV',
+                                    'Comma Separated Values File'],
+    'xls': ['application/vnd.ms-excel', 'XLS', 'Excel'],
+    'html': ['text/html', 'HTML', 'Web Page'],
+    }
+
+
+class TestFormatIndex:
+    def setup(self):
+        self.index = FormatIndex(RESOURCE_FORMATS, {'CSV': 3, 'XLS': 2})
+
+    def test_get(self):
+        assert_equal(self.index.get('csv'), ('CSV', 3))
+        assert_equal(self.index.get('Text/CSV'), ('CSV', 3))
+        assert_equal(self.index.get('Comma Separated Values File'),
+                     ('CSV', 3))
+        assert_equal(self.index.get('xls'), ('XLS', 2))
+        assert_equal(self.index.get('html'), ('HTML', None))
+        assert_equal(self.index.get('zar'), None)
+
+    def test_munge(self):
+        assert_equal(self.index.get('.CSV '), None)
+        assert_equal(self.index.get('.CSV ', munge=True), ('CSV', 3))
+
+    def test_memoised(self):
+        with mock.patch.object(lib, 'munge_format_to_be_canonical',
+                               return_value='zar') as munge:
+            self.index.get('ZAR!', munge=True)
+            self.index.get('ZAR!', munge=True)
+        assert_equal(munge.call_count, 1)
+
+
+class TestFormatIndexReload:
+    def setup(self):
+        lib._FORMAT_INDEX = None
+        fd, self.filepath = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+
+    def teardown(self):
+        lib._FORMAT_INDEX = None
+        os.remove(self.filepath)
+
+    def write_scores(self, scores, mtime):
+        with open(self.filepath, 'w') as f:
+            f.write(json.dumps(scores))
+        os.utime(self.filepath, (mtime, mtime))
+
+    @mock.patch('ckan.lib.helpers.resource_formats',
+                return_value=RESOURCE_FORMATS)
+    def test_reloaded_when_changed(self, resource_formats):
+        self.write_scores([['CSV', 3]], 1000000000)
+        with mock.patch.object(lib, 'resource_format_scores_filepath',
+                               return_value=self.filepath):
+            assert_equal(lib.format_index().get('csv'), ('CSV', 3))
+            index = lib.format_index()
+
+            self.write_scores([['CSV', 4]], 1000000001)
+            # only checked for changes once a second
+            assert lib.format_index() is index
+            index.checked = 0
+            assert_equal(lib.format_index().get('csv'), ('CSV', 4))
+            assert_equal(lib.resource_format_scores(), {'CSV': 4})
@@ -0,0 +1,51 @@
+import os
+import logging
+
+from nose.tools import assert_equal
+
+from ckanext.qa.remote_sniff import sniff_url_format
+from mock_remote_server import MockRangeFileServer
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger('ckan.sniff')
+
+fixture_data_dir = os.path.join(os.path.dirname(__file__), 'data')
+
+
+class TestSniffUrlFormat:
+    def sniff(self, filename, **kwargs):
+        server = MockRangeFileServer(fixture_data_dir, **kwargs)
+        with server.serve() as url:
+            format_ = sniff_url_format('%s/%s' % (url, filename), log)
+        return format_, server.bytes_sent
+
+    def test_csv(self):
+        format_, bytes_sent = self.sniff('elec00.csv')
+        assert_equal(format_, {'format': 'CSV'})
+        assert_equal(bytes_sent, 64 * 1024)
+
+    def test_small_file(self):
+        format_, bytes_sent = self.sniff('written_complains.csv.zip')
+        assert_equal(format_, {'format': 'CSV', 'container': 'ZIP'})
+
+    def test_zip_reads_central_directory_from_the_tail(self):
+        filename = 'telephone-network-data.xls.zip'
+        format_, bytes_sent = self.sniff(filename)
+        assert_equal(format_, {'format': 'XLS', 'container': 'ZIP'})
+        size = os.path.getsize(os.path.join(fixture_data_dir, filename))
+        assert bytes_sent < size / 4, bytes_sent
+
+    def test_office_directory(self):
+        filename = 'directors-org-chart-march-2012.ppt'
+        format_, bytes_sent = self.sniff(filename)
+        assert_equal(format_, {'format': 'PPT'})
+        size = os.path.getsize(os.path.join(fixture_data_dir, filename))
+        assert bytes_sent < size / 2, bytes_sent
+
+    def test_server_without_range_support(self):
+        format_, bytes_sent = self.sniff('elec00.csv', ranges=False)
+        assert_equal(format_, {'format': 'CSV'})
+
+    def test_not_found(self):
+        format_, bytes_sent = self.sniff('not-there.csv')
+        assert_equal(format_, None)
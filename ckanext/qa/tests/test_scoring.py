@@ -0,0 +1,104 @@
+import datetime
+import logging
+
+from nose.tools import assert_equal
+
+from ckanext.qa import lib
+from ckanext.qa.scoring import (score_resource, archival_from_json,
+                                parse_timestamp)
+
+log = logging.getLogger(__name__)
+
+TODAY = datetime.datetime(year=2008, month=10, day=10)
+
+
+def resource(**kwargs):
+    resource_ = {'id': 'res-1', 'url': 'http://site.com/data.csv',
+                 'format': '', 'license_id': 'uk-ogl', 'qa_format': None}
+    resource_.update(kwargs)
+    return resource_
+
+
+def archival(**kwargs):
+    archival_ = {'updated': TODAY, 'last_success': None,
+                 'first_failure': None, 'is_broken': False,
+                 'status': 'Archived successfully', 'reason': '',
+                 'failure_count': 0, 'cache_filepath': None}
+    archival_.update(kwargs)
+    return archival_
+
+
+class TestScoreResource:
+    def test_by_extension(self):
+        result = score_resource(resource(), archival(), log)
+        assert_equal(result['openness_score'], 3)
+        assert_equal(result['format'], 'CSV')
+        assert_equal(result['archival_timestamp'], TODAY.isoformat())
+        assert result['inputs_hash']
+
+    def test_by_format_field(self):
+        result = score_resource(resource(url='http://site.com/data',
+                                         format='XLS'), None, log)
+        assert_equal(result['openness_score'], 2)
+        assert_equal(result['format'], 'XLS')
+        assert_equal(result['archival_timestamp'], None)
+
+    def test_sniffed(self):
+        sniff = lambda score_reasons: (2, 'XLS')
+        result = score_resource(resource(), archival(), log, sniff=sniff)
+        assert_equal(result['format'], 'XLS')
+
+    def test_broken(self):
+        result = score_resource(
+            resource(qa_format='CSV'),
+            archival(is_broken=True, status='Download error',
+                     reason='Server returned 404 error',
+                     last_success=datetime.datetime(2008, 10, 1),
+                     failure_count=1),
+            log)
+        assert_equal(result['openness_score'], 0)
+        assert_equal(result['format'], 'CSV')
+        assert_equal(result['openness_score_reason'], 'File could not be downloaded. Reason: Download error. Error details: Server returned 404 error. Attempted on 10/10/2008. This URL last worked on: 01/10/2008.')
+
+    def test_not_open(self):
+        result = score_resource(resource(license_id=None), archival(), log)
+        assert_equal(result['openness_score'], 0)
+        assert_equal(result['openness_score_reason'], 'License not open')
+
+    def test_inputs_hash(self):
+        hash_ = lambda *args: score_resource(*args)['inputs_hash']
+        assert_equal(hash_(resource(), archival(), log),
+                     hash_(resource(), archival(), log))
+        assert hash_(resource(), archival(), log) != \
+            hash_(resource(), archival(updated=datetime.datetime.now()), log)
+        assert hash_(resource(), archival(), log) != \
+            hash_(resource(format='CSV'), archival(), log)
+        assert_equal(score_resource(resource(), archival(), log)['scores_hash'],
+                     lib.resource_format_scores_hash())
+
+    def test_inputs_hash_uses_sniffing_setting(self):
+        # whether this resource could be sniffed doesn't matter, only the
+        # setting
+        sniff = lambda score_reasons: (None, None)
+        hash_ = lambda **kwargs: score_resource(
+            resource(), archival(), log, **kwargs)['inputs_hash']
+        assert_equal(hash_(sniffing=True), hash_(sniff=sniff, sniffing=True))
+        assert_equal(hash_(), hash_(sniff=sniff))
+        assert hash_() != hash_(sniffing=True)
+
+
+def test_archival_from_json():
+    archival_ = archival_from_json({'updated': '2008-10-10T00:00:00',
+                                    'last_success': None,
+                                    'is_broken': False})
+    assert_equal(archival_['updated'], TODAY)
+    assert_equal(archival_['last_success'], None)
+    assert_equal(archival_['first_failure'], None)
+    assert_equal(archival_from_json(None), None)
+
+
+def test_parse_timestamp():
+    assert_equal(parse_timestamp('2008-10-10T01:02:03.500000'),
+                 datetime.datetime(2008, 10, 10, 1, 2, 3, 500000))
+    assert_equal(parse_timestamp(TODAY), TODAY)
+    assert_equal(parse_timestamp(None), None)
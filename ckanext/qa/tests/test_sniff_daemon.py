@@ -0,0 +1,86 @@
+import os
+import logging
+import shutil
+import signal
+import tempfile
+import threading
+import time
+
+import mock
+from nose.tools import assert_equal, assert_raises
+from pylons import config
+
+from ckanext.qa.sniff_format import sniff_file_format
+from ckanext.qa.sniff_daemon import (SniffServer, SniffDaemonError, serve,
+                                     sniff_via_daemon)
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger('ckan.sniff')
+
+fixture_data_dir = os.path.join(os.path.dirname(__file__), 'data')
+csv_filepath = os.path.join(fixture_data_dir, 'elec00.csv')
+xls_filepath = os.path.join(fixture_data_dir, 'ukti-admin-spend-nov-2011.xls')
+
+
+class TestSniffDaemon:
+    def setup(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.tmp_dir, 'sniffd.sock')
+        self.server = SniffServer(self.socket_path)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def teardown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_batch(self):
+        assert_equal(sniff_via_daemon([csv_filepath, xls_filepath],
+                                      self.socket_path),
+                     [{'format': 'CSV'}, {'format': 'XLS'}])
+
+    def test_sniff_file_format_uses_daemon(self):
+        with mock.patch.dict(config, {'qa.sniffd_socket': self.socket_path}):
+            with mock.patch('ckanext.qa.sniff_daemon.sniff_via_daemon',
+                            wraps=sniff_via_daemon) as sniff_via_daemon_:
+                assert_equal(sniff_file_format(csv_filepath, log),
+                             {'format': 'CSV'})
+        assert_equal(sniff_via_daemon_.call_count, 1)
+
+    def test_error_for_a_file(self):
+        assert_raises(SniffDaemonError, sniff_via_daemon,
+                      [os.path.join(self.tmp_dir, 'missing.csv')],
+                      self.socket_path)
+
+    def test_already_running(self):
+        assert_raises(SniffDaemonError, SniffServer, self.socket_path)
+
+
+def test_sniff_file_format_falls_back_without_daemon():
+    with mock.patch.dict(config, {'qa.sniffd_socket': '/nonexistent/sock'}):
+        assert_equal(sniff_file_format(csv_filepath, log), {'format': 'CSV'})
+
+
+def test_serve():
+    tmp_dir = tempfile.mkdtemp()
+    socket_path = os.path.join(tmp_dir, 'sniffd.sock')
+    pid = os.fork()
+    if pid == 0:
+        try:
+            serve(socket_path, 2)
+        finally:
+            os._exit(0)
+    try:
+        for i in range(100):
+            if os.path.exists(socket_path):
+                break
+            time.sleep(0.05)
+        assert_equal(sniff_via_daemon([csv_filepath], socket_path, 10),
+                     [{'format': 'CSV'}])
+    finally:
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+    assert not os.path.exists(socket_path)
+    shutil.rmtree(tmp_dir)
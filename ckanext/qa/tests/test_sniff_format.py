@@ -1,9 +1,25 @@
 import os
 import logging
+import StringIO
+import bz2
+import zipfile
+import tempfile
+import time
 
+import mock
 from nose.tools import assert_equal
+from pylons import config
 
-from ckanext.qa.sniff_format import sniff_file_format, is_json, is_ttl, turtle_regex
+from ckanext.qa.sniff_format import (sniff_file_format, is_json, is_ttl,
+                                     count_ttl_triples, SniffContext,
+                                     get_json_variant, get_office_format,
+                                     has_rdfa, SniffBudget,
+                                     SNIFF_HEAD_SIZE, count_delimiters,
+                                     get_delimited_format, get_zip_members,
+                                     get_zipped_format, get_zipped_office_format,
+                                     decompress_head, is_excel,
+                                     DetectorTimings)
+import ckanext.qa.sniff_format
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger('ckan.sniff')
@@ -28,7 +44,8 @@ class TestSniffFormat:
         expected_format = format_extension
         sniffed_format = sniff_file_format(filepath, log)
         assert sniffed_format, expected_format
-        expected_format_without_zip = expected_format.replace('.zip', '')
+        expected_format_without_zip = expected_format.replace('.zip', '') \
+            .replace('.gz', '').replace('.bz2', '')
         assert_equal(sniffed_format['format'].lower(), expected_format_without_zip)
 
         expected_container = None
@@ -36,6 +53,10 @@ class TestSniffFormat:
             expected_container = 'ZIP'
         elif expected_format.endswith('.gzip'):
             expected_container = 'ZIP'  # lumped together with zip for simplicity now
+        elif expected_format.endswith('.gz'):
+            expected_container = 'GZ'
+        elif expected_format.endswith('.bz2'):
+            expected_container = 'BZ2'
         assert_equal(sniffed_format.get('container'), expected_container)
 
     #def test_all(self):
@@ -81,6 +102,8 @@ class TestSniffFormat:
         self.check_format('doc')
     def test_json(self):
         self.check_format('json')
+    def test_ndjson(self):
+        self.check_format('ndjson')
     def test_ods(self):
         self.check_format('ods')
     def test_odt(self):
@@ -133,6 +156,10 @@ class TestSniffFormat:
         self.check_format('csv.zip', 'written_complains.csv.zip')
     def test_csv_zip1(self):
         self.check_format('csv.zip', 'cycle-area-list.csv.zip')
+    def test_csv_gz(self):
+        self.check_format('csv.gz', 'elec00.csv.gz')
+    def test_csv_bz2(self):
+        self.check_format('csv.bz2', 'spendover25kdownloadSep.csv.bz2')
     def test_txt_zip(self):
         self.check_format('txt.zip')
     def test_xml_zip(self):
@@ -141,6 +168,10 @@ class TestSniffFormat:
     #    self.check_format('torrent')
     def test_psv(self):
         self.check_format('psv')
+    def test_psv_with_html(self):
+        self.check_format('psv', 'html_in_first_cell.psv')
+    def test_csv_with_tag(self):
+        self.check_format('csv', 'tag_in_first_cell.csv')
     def test_wms_1_3(self):
         self.check_format('wms', 'afbi_get_capabilities.wms')
     def test_wms_1_1_1(self):
@@ -193,37 +224,89 @@ def test_is_json():
     assert not is_json('{"cat": [1, 2}]', log)
     assert is_json('[{"cat": [1]}, 2]', log)
 
-    # false positives of the algorithm:
-    #assert not is_json('[{"cat": [1]}2, 2]', log)
+    assert is_json('{\n  "cat": [1, 2],\n  "dog": 5\n}\n', log)
+    assert is_json('{"cat": "escaped \\" quote"}', log)
+    assert not is_json('[{"cat": [1]}2, 2]', log)
+    assert not is_json('{"cat": 1} rubbish', log)
+    assert not is_json('a,b,c\n1,2,3', log)
+    # JSON Lines
+    assert is_json('{"cat": 1}\n{"cat": 2}\n', log)
+    assert is_json('[1, 2]\n[3, 4]\n', log)
 
-def test_turtle_regex():
+def test_get_json_variant():
+    assert_equal(get_json_variant('{"cat": 1}\n{"cat": 2}\n', log),
+                 {'format': 'NDJSON'})
+    assert_equal(get_json_variant('[1, 2]\n[3, 4]\n[5, 6]\n[7', log),
+                 {'format': 'NDJSON'})
+    assert_equal(get_json_variant('{"cat": 1}\n', log), {'format': 'JSON'})
+    # JSON Lines values must be objects or arrays
+    assert_equal(get_json_variant('1\n2\n3\n', log), None)
+    # and cannot span lines
+    assert_equal(get_json_variant('{\n"cat": 1}\n{"cat": 2}\n', log), None)
+
+def test_count_delimiters():
+    # (commas, pipes, tabs, semicolons) in each row
+    assert_equal(count_delimiters('a,b;c\n\n"d,\ne",f\n\tg|h\n'),
+                 [(1, 0, 0, 1), (1, 0, 0, 0), (0, 1, 0, 0)])
+    # an incomplete last line is ignored, in a longer buffer
+    assert_equal(count_delimiters('a,b\nc,d\ne,f\ng'),
+                 [(1, 0, 0, 0)] * 3)
+
+def test_get_delimited_format():
+    assert_equal(get_delimited_format('a,b,c\n1,2,3\n', log),
+                 {'format': 'CSV'})
+    assert_equal(get_delimited_format('a|b|c\n1|2|3\n', log),
+                 {'format': 'PSV'})
+    assert_equal(get_delimited_format('a\tb\tc\n1\t2,5\t3\n', log),
+                 {'format': 'TSV'})
+    assert_equal(get_delimited_format('a;b;c\n"1;5";2,5;3\n', log),
+                 {'format': 'SSV'})
+    # the most consistent number of cells per row wins
+    assert_equal(get_delimited_format('a;b\n1,2,3;4\n5;6\n7;8,9\n', log),
+                 {'format': 'SSV'})
+    assert_equal(get_delimited_format('Hello, world.\nNo commas\n', log),
+                 None)
+    assert_equal(get_delimited_format('"a,b,c"\n"1,2,3"\n', log), None)
+
+def test_count_ttl_triples():
     template = '<subject> <predicate> %s .'
-    assert turtle_regex().search(template % '<url>')
-    assert turtle_regex().search(template % '"a literal"')
-    assert turtle_regex().search(template % '"translation"@ru')
-    assert turtle_regex().search(template % '"literal type"^^<http://www.w3.org/2001/XMLSchema#string>')
-    assert turtle_regex().search(template % '"literal typed with prefix"^^xsd:string')
-    assert turtle_regex().search(template % "'single quotes'")
-    assert turtle_regex().search(template % '"""triple quotes but not multiline"""')
-    assert turtle_regex().search(template % "'''triple quotes but not multiline'''")
-    assert turtle_regex().search(template % '12')
-    assert turtle_regex().search(template % '1.12')
-    assert turtle_regex().search(template % '.12')
-    assert turtle_regex().search(template % '12E12')
-    assert turtle_regex().search(template % '-4.2E-9')
-    assert turtle_regex().search(template % 'false')
-    assert turtle_regex().search(template % '_:blank_node')
-    assert turtle_regex().search('<s> <p> <o> ;\n <p> <o> .')
-    assert turtle_regex().search('<s> <p> <o>;<p> <o>.')
+    assert_equal(1, count_ttl_triples(template % '<url>'))
+    assert_equal(1, count_ttl_triples(template % '"a literal"'))
+    assert_equal(1, count_ttl_triples(template % '"translation"@ru'))
+    assert_equal(1, count_ttl_triples(template % '"literal type"^^<http://www.w3.org/2001/XMLSchema#string>'))
+    assert_equal(1, count_ttl_triples(template % '"literal typed with prefix"^^xsd:string'))
+    assert_equal(1, count_ttl_triples(template % "'single quotes'"))
+    assert_equal(1, count_ttl_triples(template % '"""triple quotes but not multiline"""'))
+    assert_equal(1, count_ttl_triples(template % "'''triple quotes but not multiline'''"))
+    assert_equal(1, count_ttl_triples(template % '12'))
+    assert_equal(1, count_ttl_triples(template % '1.12'))
+    assert_equal(1, count_ttl_triples(template % '.12'))
+    assert_equal(1, count_ttl_triples(template % '12E12'))
+    assert_equal(1, count_ttl_triples(template % '-4.2E-9'))
+    assert_equal(1, count_ttl_triples(template % 'false'))
+    assert_equal(1, count_ttl_triples(template % '_:blank_node'))
+    assert_equal(2, count_ttl_triples('<s> <p> <o> ;\n <p> <o> .'))
+    assert_equal(2, count_ttl_triples('<s> <p> <o>;<p> <o>.'))
     # Include triples which are part of a nest:
-    assert turtle_regex().search('<s> <p> <o> ;')
-    assert turtle_regex().search('<s> <p> <o>;')
-    assert turtle_regex().search(' ;<p> <o>.')
-    assert turtle_regex().search(';\n<p> <o>.')
-    assert turtle_regex().search(';\n<p> <o>;')
-    assert not turtle_regex().search('<s> <p> <o>. rubbish')
-    assert not turtle_regex().search(template % 'word')
-    assert not turtle_regex().search(template % 'prefix:node')
+    assert_equal(1, count_ttl_triples('<s> <p> <o> ;'))
+    assert_equal(1, count_ttl_triples('<s> <p> <o>;'))
+    assert_equal(1, count_ttl_triples(' ;<p> <o>.'))
+    assert_equal(1, count_ttl_triples(';\n<p> <o>.'))
+    assert_equal(1, count_ttl_triples(';\n<p> <o>;'))
+    assert_equal(0, count_ttl_triples('<s> <p> <o>. rubbish'))
+    assert_equal(0, count_ttl_triples(template % 'word'))
+    assert_equal(0, count_ttl_triples(template % 'prefix:node'))
+    # skips lines that aren't triples
+    assert_equal(2, count_ttl_triples('<s> <p> <o> .\nrubbish\n<s> <p> <o> .'))
+    assert_equal(2, count_ttl_triples('<s> <p> <o> .\n' * 5, 2))
+
+
+def test_count_ttl_triples__pathological():
+    # would take the old regex many seconds
+    buf = '"a" ' * 2500
+    start = time.time()
+    assert_equal(0, count_ttl_triples(buf))
+    assert time.time() - start < 0.5
 
 
 def test_is_ttl__num_triples():
@@ -231,3 +314,267 @@ def test_is_ttl__num_triples():
     assert not is_ttl('\n'.join([triple]*2), log)
     assert is_ttl('\n'.join([triple]*5), log)
 
+
+
+def test_get_office_format():
+    fixture_data_dir = os.path.join(os.path.dirname(__file__), 'data')
+    for filename, expected_format in (
+            ('ukti-admin-spend-nov-2011.xls', 'XLS'),
+            ('August-2010.xls', 'XLS'),
+            ('bis-quarterly-publications-dg-expenses-jul-sep-2010.doc', 'DOC'),
+            ('directors-org-chart-march-2012.ppt', 'PPT'),
+            ('decc_local_authority_data_xlsx.xlsx', 'XLSX'),
+            ('20101130_narrative_and_payscales.odt', 'ODT'),
+            ('20101104_defence_estates.odp', 'ODP'),
+            ('cycle-area-list.csv.zip', None),
+            ('elec00.csv', None)):
+        filepath = os.path.join(fixture_data_dir, filename)
+        with SniffContext(filepath) as ctx:
+            format_ = get_office_format(ctx, log)
+        assert_equal((filename, format_ and format_['format']),
+                     (filename, expected_format))
+
+
+class TempFileTest(object):
+    '''Base for tests that sniff a temporary file, which starts off holding
+    `contents` and is rewritten with write().'''
+    contents = ''
+
+    def setup(self):
+        fd, self.filepath = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            f.write(self.contents)
+
+    def teardown(self):
+        os.remove(self.filepath)
+
+    def write(self, data):
+        with open(self.filepath, 'wb') as f:
+            f.write(data)
+
+
+class TestZip(TempFileTest):
+    def make_zip(self, files):
+        '''Returns a zip, as a string, of the (filename, data) files.'''
+        buf = StringIO.StringIO()
+        zip_ = zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED)
+        for filename, data in files:
+            zip_.writestr(filename, data)
+        zip_.close()
+        return buf.getvalue()
+
+    def get_zipped_format(self, files, sniff_members=0):
+        self.write(self.make_zip(files))
+        with mock.patch.dict(config, {'qa.zip_sniff_members': sniff_members}):
+            with SniffContext(self.filepath) as ctx:
+                return get_zipped_format(ctx, log)
+
+    def test_max_members(self):
+        self.write(self.make_zip([('%s.csv' % i, '') for i in range(100)]))
+        with SniffContext(self.filepath) as ctx:
+            members = get_zip_members(ctx, log, max_members=10)
+        assert_equal([member.filename for member in members],
+                     ['%s.csv' % i for i in range(10)])
+
+    def test_extensions(self):
+        assert_equal(self.get_zipped_format([('a.csv', ''), ('b.CSV', ''),
+                                             ('c.pdf', ''), ('d', '')]),
+                     {'format': 'CSV', 'container': 'ZIP'})
+
+    def test_unknown_extension(self):
+        csv = 'a,b,c\n1,2,3\n' * 100
+        assert_equal(self.get_zipped_format([('data', csv), ('a.pdf', '')]),
+                     {'format': 'PDF', 'container': 'ZIP'})
+        assert_equal(self.get_zipped_format([('data', csv), ('a.pdf', '')],
+                                            sniff_members=3),
+                     {'format': 'CSV', 'container': 'ZIP'})
+
+    def test_odf_mimetype_after_extra_field(self):
+        buf = StringIO.StringIO()
+        zip_ = zipfile.ZipFile(buf, 'w')
+        info = zipfile.ZipInfo('mimetype')
+        info.extra = '\xfe\xca\x00\x00'
+        zip_.writestr(info, 'application/vnd.oasis.opendocument.spreadsheet')
+        zip_.writestr('content.xml', '<office:document-content/>')
+        zip_.close()
+        self.write(buf.getvalue())
+        with SniffContext(self.filepath) as ctx:
+            assert_equal(get_zipped_office_format(ctx, log), {'format': 'ODS'})
+
+    def test_nested_zip(self):
+        inner_zip = self.make_zip([('data.json', '{"a": 1}')])
+        files = [('inner.zip', inner_zip), ('readme', 'Read me')]
+        assert_equal(self.get_zipped_format(files),
+                     {'format': 'ZIP', 'container': 'ZIP'})
+        assert_equal(self.get_zipped_format(files, sniff_members=3),
+                     {'format': 'JSON', 'container': 'ZIP'})
+
+
+class TestHasRdfa(TempFileTest):
+    def has_rdfa(self, html, max_bytes=1024 * 1024):
+        self.write(html)
+        with SniffContext(self.filepath) as ctx:
+            return has_rdfa(ctx, log, max_bytes)
+
+    def test_rdfa(self):
+        assert self.has_rdfa('<div about="/a"><span property="b">B</span>')
+        assert self.has_rdfa('<div\nabout="/a"\nproperty="b">B</div>')
+
+    def test_not_in_a_tag(self):
+        assert not self.has_rdfa('<p>about="/a" property="b"</p>')
+
+    def test_beyond_100kb(self):
+        padding = '<p>Lorem ipsum</p>\n' * 10000
+        html = padding + '<div about="/a"><span property="b">B</span>'
+        assert self.has_rdfa(html)
+        assert not self.has_rdfa(html, max_bytes=100000)
+
+    def test_tag_split_between_chunks(self):
+        padding = ' ' * (64 * 1024 - 10)
+        assert self.has_rdfa(padding + '<div about="/a" property="b">')
+
+
+def slow_detector(ctx, log):
+    time.sleep(2)
+    return {'format': 'ZIP-CONTENTS'}
+
+
+class TestSniffBudget(TempFileTest):
+    contents = 'x' * (SNIFF_HEAD_SIZE + 1000)
+
+    def test_detector_timeout(self):
+        budget = SniffBudget(detector_seconds=0.1)
+        with SniffContext(self.filepath, budget=budget) as ctx:
+            start = time.time()
+            assert_equal(ctx.run(slow_detector, ctx, log), None)
+            assert time.time() - start < 1
+        assert budget.truncated
+        assert ckanext.qa.sniff_format.budget_overruns['slow_detector']
+
+    def test_no_time_left(self):
+        budget = SniffBudget(seconds=0.1)
+        budget.start_time -= 1
+        with SniffContext(self.filepath, budget=budget) as ctx:
+            assert_equal(ctx.run(lambda: 'not run'), None)
+        assert budget.truncated
+
+    def test_detector_bytes(self):
+        def read_it_all(ctx):
+            return len(ctx.fileobj().read())
+        budget = SniffBudget(detector_max_bytes=1024 * 1024)
+        with SniffContext(self.filepath, budget=budget) as ctx:
+            assert_equal(ctx.run(read_it_all, ctx), None)
+            assert_equal(ctx.run(ctx.read_at, 0, 100), 'x' * 100)
+        assert budget.truncated
+
+    def test_within_budget(self):
+        budget = SniffBudget(seconds=10, detector_seconds=10,
+                             max_bytes=10 * 1024 * 1024,
+                             detector_max_bytes=10 * 1024 * 1024)
+        with SniffContext(self.filepath, budget=budget) as ctx:
+            assert_equal(ctx.run(lambda ctx: len(ctx.fileobj().read()), ctx),
+                         ctx.size)
+        assert not budget.truncated
+
+    def test_sniff_falls_back_to_cheaper_detectors(self):
+        filepath = os.path.join(os.path.dirname(__file__), 'data',
+                                'cycle-area-list.csv.zip')
+        with mock.patch.dict(config, {'qa.sniff_detector_timeout': '0.1'}):
+            with mock.patch('ckanext.qa.sniff_format.get_zipped_format',
+                            slow_detector):
+                format_ = sniff_file_format(filepath, log)
+        assert_equal(format_, {'format': 'ZIP', 'sniff_truncated': True})
+
+    def test_excel_counts_only_what_xlrd_reads(self):
+        xls = os.path.join(os.path.dirname(__file__), 'data',
+                           'August-2010.xls')
+        self.write(open(xls, 'rb').read() + '\0' * (2 * SNIFF_HEAD_SIZE))
+        budget = SniffBudget()
+        with SniffContext(self.filepath, budget=budget) as ctx:
+            assert is_excel(ctx, log)
+        assert budget.bytes_read < SNIFF_HEAD_SIZE, budget.bytes_read
+
+    def test_magic_of_whole_file_is_not_counted(self):
+        self.write('\x8f\x00\x13\xfe' * SNIFF_HEAD_SIZE)
+        with mock.patch.dict(config, {'qa.sniff_max_bytes': SNIFF_HEAD_SIZE}):
+            format_ = sniff_file_format(self.filepath, log)
+        assert 'sniff_truncated' not in (format_ or {}), format_
+
+    def test_decompression_bomb(self):
+        compressor = bz2.BZ2Compressor()
+        megabyte = 'a' * 1024 * 1024
+        self.write(''.join([compressor.compress(megabyte)
+                            for i in range(150)] + [compressor.flush()]))
+        decompressed = []
+
+        class CountingDecompressor(bz2.BZ2Decompressor):
+            def decompress(self, data):
+                data = super(CountingDecompressor, self).decompress(data)
+                decompressed.append(len(data))
+                return data
+        budget = SniffBudget()
+        with mock.patch.object(bz2, 'BZ2Decompressor', CountingDecompressor):
+            with SniffContext(self.filepath, budget=budget) as ctx:
+                assert_equal(decompress_head(ctx, 'BZ2', 1000), 'a' * 1000)
+        # no more than a bz2 block or two was decompressed, and counted
+        assert sum(decompressed) < 100 * 1024 * 1024, sum(decompressed)
+        assert_equal(budget.bytes_read, sum(decompressed))
+
+
+class TestSniffTrace:
+    filepath = os.path.join(os.path.dirname(__file__), 'data',
+                            'elec00.csv.gz')
+
+    def test_trace(self):
+        trace = []
+        assert_equal(sniff_file_format(self.filepath, log, trace=trace),
+                     {'format': 'CSV', 'container': 'GZ'})
+        detectors = [(detector['detector'], detector['depth'])
+                     for detector in trace]
+        assert_equal(detectors[0], ('magic', 0))
+        assert_equal(detectors[-1], ('detect_compressed_format', 0))
+        # the decompressed data is sniffed by the compressed format detector
+        assert ('detect_delimited_format', 1) in detectors
+        assert all(detector['seconds'] >= 0 for detector in trace)
+
+    def test_hook(self):
+        hook = mock.Mock()
+        with mock.patch.object(ckanext.qa.sniff_format, 'sniff_trace_hooks',
+                               [hook]):
+            sniff_file_format(self.filepath, log)
+        filepath, trace = hook.call_args[0]
+        assert_equal(filepath, self.filepath)
+        assert_equal(trace[-1]['detector'], 'detect_compressed_format')
+
+    def test_detector_timings(self):
+        timings = DetectorTimings()
+        for ms in [0.5] * 98 + [30, 70000]:
+            timings.add(ms / 1000.0, 10)
+        assert_equal(timings.calls, 100)
+        assert_equal(timings.bytes_read, 1000)
+        assert_equal(timings.percentile_ms(50), 1)
+        assert_equal(timings.percentile_ms(99), 50)
+        assert_equal(timings.percentile_ms(100), 70000)
+
+
+class TestSniffContext(TempFileTest):
+    contents = 'a,b,c\r\n1,2,3\r4,5,6\n'
+
+    def test_head(self):
+        with SniffContext(self.filepath) as ctx:
+            assert_equal(ctx.head(5), 'a,b,c')
+            assert_equal(ctx.head(1000), 'a,b,c\r\n1,2,3\r4,5,6\n')
+            assert ctx.is_whole_file_in_memory
+
+    def test_text_normalizes_line_endings(self):
+        with SniffContext(self.filepath) as ctx:
+            assert_equal(ctx.text(1000), 'a,b,c\n1,2,3\n4,5,6\n')
+
+    def test_fileobj(self):
+        with SniffContext(self.filepath) as ctx:
+            assert_equal(ctx.fileobj().read(), ctx.head())
+
+    def test_read_at(self):
+        with SniffContext(self.filepath) as ctx:
+            assert_equal(ctx.read_at(7, 5), '1,2,3')
+            assert_equal(ctx.read_at(18, 100), '\n')
@@ -0,0 +1,104 @@
+import logging
+
+import mock
+from nose.tools import assert_equal, assert_raises
+
+from ckanext.qa.sniff_format import SniffContext, sniff_context_format
+from ckanext.qa.sniff_registry import (
+    Detector, DetectorRegistry, NO_MIMETYPE, COST_HEAD_START, COST_HEAD,
+    COST_PROCESS)
+from ckanext.qa import sniff_registry
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger('ckan.sniff')
+
+
+def detector(name, result=None, calls=None, **kwargs):
+    def func(ctx, log):
+        if calls is not None:
+            calls.append(name)
+        return result
+    return Detector(func, name=name, **kwargs)
+
+
+class TestDetectorRegistry:
+    def setup(self):
+        self.registry = DetectorRegistry()
+        self.registry._entry_points_loaded = True
+
+    def test_order(self):
+        self.registry.register([
+            detector('slow', cost=COST_PROCESS),
+            detector('fast', cost=COST_HEAD_START),
+            detector('first', cost=COST_PROCESS, priority=1),
+            ])
+        assert_equal([d.name for d in
+                      self.registry.detectors_for_mimetype('text/plain')],
+                     ['first', 'fast', 'slow'])
+
+    def test_mimetypes(self):
+        self.registry.register([
+            detector('text', mimetypes=['text/*']),
+            detector('zip', mimetypes=['application/zip']),
+            detector('none', mimetypes=[NO_MIMETYPE]),
+            detector('all'),
+            ])
+        names = lambda mime_type: [
+            d.name for d in self.registry.detectors_for_mimetype(mime_type)]
+        assert_equal(names('text/csv'), ['text', 'all'])
+        assert_equal(names('application/zip'), ['zip', 'all'])
+        assert_equal(names(None), ['none', 'all'])
+
+    def test_dispatch_table_is_compiled_once(self):
+        self.registry.register(detector('text', mimetypes=['text/*']))
+        with mock.patch.object(Detector, 'applies_to_mimetype',
+                               return_value=True) as applies:
+            self.registry.detectors_for_mimetype('text/plain')
+            self.registry.detectors_for_mimetype('text/plain')
+        assert_equal(applies.call_count, 1)
+
+    def test_register_twice(self):
+        self.registry.register(detector('a'))
+        assert_raises(ValueError, self.registry.register, detector('a'))
+
+    def test_detect(self):
+        calls = []
+        self.registry.register([
+            detector('no', calls=calls, cost=COST_HEAD_START),
+            detector('txt_only', {'format': 'TXT?'}, calls, formats=('TXT',)),
+            detector('yes', {'format': 'CSV'}, calls, cost=COST_HEAD),
+            detector('not_needed', {'format': 'PSV'}, calls,
+                     cost=COST_PROCESS),
+            ])
+        with SniffContext('test.csv', data='a,b\n1,2\n', log=log) as ctx:
+            assert_equal(self.registry.detect(ctx, 'text/csv', 'CSV', log),
+                         {'format': 'CSV'})
+            # asking again doesn't run the detectors again
+            assert_equal(self.registry.detect(ctx, 'text/csv', 'CSV', log),
+                         {'format': 'CSV'})
+        assert_equal(calls, ['no', 'yes'])
+
+
+def test_register_detector():
+    registry = DetectorRegistry()
+    registry._entry_points_loaded = True
+    registry.register(detector('geojson', {'format': 'GeoJSON'},
+                               mimetypes=['application/json'], priority=1))
+    with mock.patch.object(sniff_registry, 'registry', registry):
+        with SniffContext('test.json', data='{"type": "Feature"}',
+                          log=log) as ctx:
+            assert_equal(sniff_context_format(ctx, log),
+                         {'format': 'GeoJSON'})
+
+
+def test_load_entry_points():
+    entry_point = mock.Mock()
+    entry_point.load.return_value = [detector('a'), detector('b')]
+    registry = DetectorRegistry()
+    with mock.patch('pkg_resources.iter_entry_points',
+                    return_value=[entry_point]) as iter_entry_points:
+        assert_equal([d.name for d in
+                      registry.detectors_for_mimetype('text/plain')],
+                     ['a', 'b'])
+        registry.detectors_for_mimetype('text/csv')
+    iter_entry_points.assert_called_once_with('ckanext.qa.detectors')
@@ -3,7 +3,9 @@ import logging
 import urllib
 import datetime
 
+import mock
 from nose.tools import assert_equal
+from pylons import config
 from ckan import model
 from ckan.logic import get_action
 import ckan.lib.helpers as ckan_helpers
@@ -17,6 +19,9 @@ except ImportError:
     from ckan.tests import BaseCase
 
 import ckanext.qa.tasks
+import ckanext.qa.sniff_format
+import ckanext.qa.lib
+import ckanext.qa.scoring
 from ckanext.qa.tasks import resource_score, extension_variants
 import ckanext.archiver
 import ckanext.archiver.tasks
@@ -251,6 +256,30 @@ class TestResourceScore(BaseCase):
         assert_equal(result['openness_score_reason'], 'File could not be downloaded. Reason: Download error. Error details: Server returned 404 error. Attempted on 10/10/2008. This URL last worked on: 01/10/2008.')
 
 
+class TestLoadConfig(object):
+    def setup(self):
+        ckanext.qa.tasks._loaded_config.update(key=None, conf=None)
+        ckanext.qa.tasks._thread_config.key = None
+
+    @mock.patch('ckanext.qa.tasks.load_thread_config')
+    @mock.patch('ckan.config.environment.load_environment')
+    @mock.patch('paste.deploy.appconfig')
+    def test_loaded_once(self, appconfig, load_environment,
+                         load_thread_config):
+        ini_filepath = config['__file__']
+        ckanext.qa.tasks.load_config(ini_filepath)
+        ckanext.qa.tasks.load_config(ini_filepath)
+        assert_equal(appconfig.call_count, 1)
+        assert_equal(load_environment.call_count, 1)
+        assert_equal(load_thread_config.call_count, 1)
+
+        # the config file changes
+        with mock.patch('os.path.getmtime', return_value=0):
+            ckanext.qa.tasks.load_config(ini_filepath)
+        assert_equal(appconfig.call_count, 2)
+        assert_equal(load_thread_config.call_count, 2)
+
+
 class TestExtensionVariants:
     def test_0_normal(self):
         assert_equal(extension_variants('http://dept.gov.uk/coins-data-1996.csv'),
@@ -301,6 +330,132 @@ class TestSaveQaResult(object):
         assert_equal(qa.archival_timestamp, qa_result['archival_timestamp'])
         assert qa.updated, qa.updated
 
+    def test_many(self):
+        dataset = ckan_factories.Dataset(resources=[
+            {'url': 'http://example.com/%s.csv' % i} for i in range(3)])
+        resources = [model.Resource.get(res['id'])
+                     for res in dataset['resources']]
+        ckanext.qa.tasks.save_qa_result(
+            resources[0], self.get_qa_result(format='XLS'), log)
+
+        ckanext.qa.tasks.save_qa_results(
+            [(resource, self.get_qa_result(
+                archival_timestamp='2015-12-16T10:00:00'))
+             for resource in resources], log)
+
+        qas = qa_model.QA.get_for_package(dataset['id'])
+        assert_equal(sorted(qa.resource_id for qa in qas),
+                     sorted(resource.id for resource in resources))
+        for qa in qas:
+            assert_equal(qa.format, 'CSV')
+            assert_equal(qa.package_id, dataset['id'])
+            assert_equal(qa.archival_timestamp,
+                         datetime.datetime(2015, 12, 16, 10))
+
+
+class TestSniffCache(object):
+    @classmethod
+    def setup_class(cls):
+        reset_db()
+        archiver_model.init_tables(model.meta.engine)
+        qa_model.init_tables(model.meta.engine)
+        config['qa.sniff_cache'] = 'true'
+
+    @classmethod
+    def teardown_class(cls):
+        del config['qa.sniff_cache']
+
+    def test_sniffed_once_per_hash(self):
+        archival = mock.Mock(hash=u'hash-1')
+        set_sniffed_format('CSV')
+        format1 = ckanext.qa.tasks.sniff_file_format_cached(
+            __file__, archival, log)
+        # the sniffer would give a different answer now, but the cached one
+        # is used
+        set_sniffed_format('XLS')
+        format2 = ckanext.qa.tasks.sniff_file_format_cached(
+            __file__, archival, log)
+
+        assert_equal(format1, {'format': 'CSV'})
+        assert_equal(format2, {'format': 'CSV'})
+        cached = qa_model.SniffCache.get(
+            u'hash-1', ckanext.qa.sniff_format.DETECTOR_VERSION)
+        assert_equal(cached.hit_count, 1)
+
+    def test_resource_score(self):
+        dataset = ckan_factories.Dataset(license_id='uk-ogl', resources=[
+            {'url': 'http://site.com/data%s' % i, 'format': ''}
+            for i in range(2)])
+        resources = []
+        for res in dataset['resources']:
+            archival = Archival.create(res['id'])
+            archival.cache_filepath = __file__  # just needs to exist
+            archival.hash = u'hash-2'  # the files are identical
+            archival.updated = TODAY
+            model.Session.add(archival)
+            resources.append(model.Resource.get(res['id']))
+        model.Session.commit()
+        hits = ckanext.qa.tasks.sniff_cache_stats['hits']
+
+        set_sniffed_format('CSV')
+        result1 = resource_score(resources[0], log)
+        set_sniffed_format('XLS')
+        result2 = resource_score(resources[1], log)
+
+        assert_equal(result1['format'], 'CSV')
+        assert_equal(result2['format'], 'CSV')
+        assert_equal(ckanext.qa.tasks.sniff_cache_stats['hits'], hits + 1)
+
+    def test_saved_by_another_worker(self):
+        archival = mock.Mock(hash=u'hash-3')
+        set_sniffed_format('CSV')
+        with mock.patch.object(qa_model.SniffCache, 'get',
+                               return_value=None):
+            # both times it misses, as if two workers sniffed at once
+            ckanext.qa.tasks.sniff_file_format_cached(__file__, archival, log)
+            format_ = ckanext.qa.tasks.sniff_file_format_cached(
+                __file__, archival, log)
+        model.Session.commit()
+
+        assert_equal(format_, {'format': 'CSV'})
+        assert qa_model.SniffCache.get(
+            u'hash-3', ckanext.qa.sniff_format.DETECTOR_VERSION)
+
+    def test_no_hash(self):
+        archival = mock.Mock(hash=None)
+        set_sniffed_format('CSV')
+        format_ = ckanext.qa.tasks.sniff_file_format_cached(
+            __file__, archival, log)
+        assert_equal(format_, {'format': 'CSV'})
+
+    def test_prune(self):
+        entry = qa_model.SniffCache.create(u'hash-old', u'0', None)
+        entry.last_used = datetime.datetime(2000, 1, 1)
+        model.Session.add(entry)
+        model.Session.commit()
+
+        num_deleted = qa_model.SniffCache.prune(max_age_days=30)
+        model.Session.commit()
+
+        assert_equal(num_deleted, 1)
+        assert not qa_model.SniffCache.get(u'hash-old', u'0')
+
+    def test_prune_max_entries_used_at_the_same_time(self):
+        model.Session.query(qa_model.SniffCache).delete()
+        last_used = datetime.datetime(2020, 1, 1)
+        for i in range(5):
+            entry = qa_model.SniffCache.create(u'hash-same-%s' % i, u'0',
+                                               None)
+            entry.last_used = last_used
+            model.Session.add(entry)
+        model.Session.commit()
+
+        num_deleted = qa_model.SniffCache.prune(max_entries=3)
+        model.Session.commit()
+
+        assert_equal(num_deleted, 2)
+        assert_equal(qa_model.SniffCache.stats()['entries'], 3)
+
 
 class TestUpdatePackage(object):
     @classmethod
@@ -325,6 +480,243 @@ class TestUpdatePackage(object):
         assert_equal(qa.openness_score, 0)
         assert_equal(qa.openness_score_reason, 'License not open')
 
+    def test_many_resources(self):
+        resources = [{'url': 'http://example.com/file%s.csv' % i,
+                      'format': 'CSV'} for i in range(3)]
+        dataset = ckan_factories.Dataset(license_id='uk-ogl',
+                                         resources=resources)
+        res_ids = [res['id'] for res in dataset['resources']]
+        # one resource has been scored before and another is archived
+        qa = qa_model.QA.create(res_ids[0])
+        qa.openness_score = 1
+        model.Session.add(qa)
+        archival = Archival.create(res_ids[1])
+        archival.updated = TODAY
+        model.Session.add(archival)
+        model.Session.commit()
+
+        rows = ckanext.qa.tasks.PackageRows.load(res_ids)
+        assert_equal(rows.qas.keys(), [res_ids[0]])
+        assert_equal(rows.archivals.keys(), [res_ids[1]])
+
+        ckanext.qa.tasks.update_package_(dataset['id'], log)
+
+        for res_id in res_ids:
+            qa = qa_model.QA.get_for_resource(res_id)
+            assert_equal(qa.openness_score, 3)
+            assert_equal(qa.package_id, dataset['id'])
+        assert_equal(qa_model.QA.get_for_resource(res_ids[1])
+                     .archival_timestamp, TODAY)
+
+    def test_unchanged_resources_are_skipped(self):
+        resources = [{'url': 'http://example.com/file%s.csv' % i,
+                      'format': 'CSV'} for i in range(2)]
+        dataset = ckan_factories.Dataset(license_id='uk-ogl',
+                                         resources=resources)
+        ckanext.qa.tasks.update_package_(dataset['id'], log)
+        qa = qa_model.QA.get_for_resource(dataset['resources'][0]['id'])
+        assert qa.inputs_hash
+
+        resource_score = mock.Mock(wraps=ckanext.qa.tasks.resource_score)
+        with mock.patch('ckanext.qa.tasks.resource_score', resource_score):
+            ckanext.qa.tasks.update_package_(dataset['id'], log)
+            assert_equal(resource_score.call_count, 0)
+
+            # a change to a resource means it is scored again
+            resource = model.Resource.get(dataset['resources'][1]['id'])
+            resource.url = 'http://example.com/file1.xls'
+            model.Session.commit()
+            ckanext.qa.tasks.update_package_(dataset['id'], log)
+            assert_equal(resource_score.call_count, 1)
+            assert_equal(qa_model.QA.get_for_resource(resource.id).format,
+                         'XLS')
+
+            ckanext.qa.tasks.update_package_(dataset['id'], log, force=True)
+            assert_equal(resource_score.call_count, 3)
+
+
+class TestSearchIndexQueue(object):
+    @classmethod
+    def setup_class(cls):
+        reset_db()
+        archiver_model.init_tables(model.meta.engine)
+        qa_model.init_tables(model.meta.engine)
+
+    def test_deferred(self):
+        dataset = ckan_factories.Dataset(resources=[
+            {'url': 'http://example.com/file.csv', 'format': 'CSV'}])
+
+        with mock.patch('ckanext.qa.tasks._update_search_index') as update:
+            ckanext.qa.tasks.update_package_(dataset['id'], log,
+                                             defer_index=True)
+        assert not update.called
+        assert_equal(qa_model.SearchIndexQueue.next_batch(10),
+                     [dataset['id']])
+
+        ckanext.qa.tasks.flush_search_index_queue(log)
+        assert_equal(qa_model.SearchIndexQueue.next_batch(10), [])
+
+    @mock.patch('ckan.lib.search.index.PackageSearchIndex')
+    def test_flush_in_batches(self, package_index_class):
+        package_index = package_index_class.return_value
+        datasets = [ckan_factories.Dataset() for i in range(3)]
+        for dataset in datasets + datasets[:1]:
+            qa_model.SearchIndexQueue.add(dataset['id'])
+        model.Session.commit()
+        assert_equal(qa_model.SearchIndexQueue.stats()['datasets'], 3)
+
+        num_indexed = ckanext.qa.tasks.flush_search_index_queue(
+            log, batch_size=2)
+
+        assert_equal(num_indexed, 3)
+        assert_equal(package_index.index_package.call_count, 3)
+        assert_equal(package_index.commit.call_count, 2)
+        assert_equal(qa_model.SearchIndexQueue.stats()['datasets'], 0)
+
+    @mock.patch('ckan.lib.search.index.PackageSearchIndex')
+    def test_worker_only_queues(self, package_index_class):
+        dataset = ckan_factories.Dataset(resources=[
+            {'url': 'http://example.com/file.csv', 'format': 'CSV'}])
+
+        with mock.patch.dict(config, {'qa.search_index.batch_size': 1}):
+            ckanext.qa.tasks.update_package_(dataset['id'], log,
+                                             defer_index=True)
+            assert ckanext.qa.tasks.is_search_index_flush_due(1, 60)
+
+        assert not package_index_class.return_value.index_package.called
+        assert_equal(qa_model.SearchIndexQueue.next_batch(10),
+                     [dataset['id']])
+        assert not ckanext.qa.tasks.is_search_index_flush_due(2, 60)
+        assert ckanext.qa.tasks.is_search_index_flush_due(2, 0)
+        ckanext.qa.tasks.flush_search_index_queue(log)
+
+    def test_claim_batch(self):
+        datasets = [ckan_factories.Dataset() for i in range(3)]
+        for dataset in datasets:
+            qa_model.SearchIndexQueue.add(dataset['id'])
+        model.Session.commit()
+        stale_before = datetime.datetime.now() - datetime.timedelta(hours=1)
+
+        first = qa_model.SearchIndexQueue.claim_batch(2, u'first',
+                                                      stale_before)
+        second = qa_model.SearchIndexQueue.claim_batch(2, u'second',
+                                                       stale_before)
+
+        assert_equal(sorted(first + second),
+                     sorted(dataset['id'] for dataset in datasets))
+        assert_equal(len(first), 2)
+        # a dataset queued again while claimed stays queued
+        qa_model.SearchIndexQueue.add(datasets[0]['id'])
+        qa_model.SearchIndexQueue.remove(u'first')
+        qa_model.SearchIndexQueue.remove(u'second')
+        model.Session.commit()
+        assert_equal(qa_model.SearchIndexQueue.next_batch(10),
+                     [datasets[0]['id']])
+
+        # claims from before stale_before are taken over
+        qa_model.SearchIndexQueue.claim_batch(10, u'dead', stale_before)
+        assert_equal(qa_model.SearchIndexQueue.claim_batch(
+            10, u'new', datetime.datetime.now() + datetime.timedelta(1)),
+            [datasets[0]['id']])
+        qa_model.SearchIndexQueue.remove(u'new')
+        model.Session.commit()
+
+
+class TestRescoreFormats(object):
+    @classmethod
+    def setup_class(cls):
+        reset_db()
+        archiver_model.init_tables(model.meta.engine)
+        qa_model.init_tables(model.meta.engine)
+
+    def test_rescore(self):
+        dataset = ckan_factories.Dataset(license_id='uk-ogl', resources=[
+            {'url': 'http://example.com/file.csv', 'format': 'CSV'},
+            {'url': 'http://example.com/file.xls', 'format': 'XLS'}])
+        ckanext.qa.tasks.update_package_(dataset['id'], log)
+        csv_id, xls_id = [res['id'] for res in dataset['resources']]
+
+        package_ids, formats_to_requalify = \
+            ckanext.qa.tasks.rescore_formats(
+                {'CSV': 3, 'XLS': 2, 'ODS': 3},
+                {'CSV': 4, 'XLS': 2, 'GeoJSON': 3}, log)
+        model.Session.commit()
+
+        assert dataset['id'] in package_ids
+        assert_equal(formats_to_requalify, ['GeoJSON', 'ODS'])
+        qa = qa_model.QA.get_for_resource(csv_id)
+        assert_equal(qa.openness_score, 4)
+        assert_equal(qa.openness_score_reason, 'URL extension "csv" relates '
+                     'to format "CSV" and receives score: 4.')
+        assert_equal(qa_model.QA.get_for_resource(xls_id).openness_score, 2)
+
+    def test_same_as_fresh_score(self):
+        dataset = ckan_factories.Dataset(license_id='uk-ogl', resources=[
+            {'url': 'http://example.com/file.csv', 'format': 'CSV'},
+            {'url': 'http://example.com/data', 'format': 'XLS'}])
+        ckanext.qa.tasks.update_package_(dataset['id'], log)
+        old_scores = ckanext.qa.lib.resource_format_scores()
+        new_scores = dict(old_scores, CSV=old_scores['CSV'] + 1,
+                          XLS=old_scores['XLS'] + 1)
+
+        ckanext.qa.tasks.rescore_formats(old_scores, new_scores, log)
+        model.Session.commit()
+
+        index = ckanext.qa.lib.FormatIndex(ckan_helpers.resource_formats(),
+                                           new_scores)
+        for res in dataset['resources']:
+            resource = model.Resource.get(res['id'])
+            with mock.patch('ckanext.qa.lib.format_index',
+                            return_value=index):
+                fresh = resource_score(resource, log)
+            qa = qa_model.QA.get_for_resource(resource.id)
+            assert_equal(qa.openness_score, fresh['openness_score'])
+            assert_equal(qa.openness_score_reason,
+                         fresh['openness_score_reason'])
+            assert_equal(qa.inputs_hash, fresh['inputs_hash'])
+            assert_equal(qa.scores_hash, fresh['scores_hash'])
+
+    def test_score_was_zero(self):
+        dataset = ckan_factories.Dataset(license_id='uk-ogl', resources=[
+            {'url': 'http://example.com/file.csv', 'format': 'CSV'}])
+        old_scores = dict(ckanext.qa.lib.resource_format_scores(), CSV=0)
+        index = ckanext.qa.lib.FormatIndex(ckan_helpers.resource_formats(),
+                                           old_scores)
+        with mock.patch('ckanext.qa.lib.format_index', return_value=index):
+            ckanext.qa.tasks.update_package_(dataset['id'], log)
+        resource_id = dataset['resources'][0]['id']
+        scores_hash = qa_model.QA.get_for_resource(resource_id).scores_hash
+
+        package_ids, formats_to_requalify = \
+            ckanext.qa.tasks.rescore_formats(
+                old_scores, dict(old_scores, CSV=3), log)
+        model.Session.commit()
+
+        # it had the default score, so it needs scoring again
+        assert_equal(formats_to_requalify, ['CSV'])
+        qa = qa_model.QA.get_for_resource(resource_id)
+        assert_equal(qa.openness_score, 1)
+        assert_equal(qa.scores_hash, scores_hash)
+
+    def test_rehash(self):
+        dataset = ckan_factories.Dataset(license_id='uk-ogl', resources=[
+            {'url': 'http://example.com/file.csv', 'format': 'CSV'}])
+        ckanext.qa.tasks.update_package_(dataset['id'], log)
+        resource = model.Resource.get(dataset['resources'][0]['id'])
+
+        inputs_hash = qa_model.QA.get_for_resource(resource.id).inputs_hash
+        old_scores = ckanext.qa.lib.resource_format_scores()
+        new_scores = dict(old_scores, XLS=old_scores['XLS'] + 1)
+
+        ckanext.qa.tasks.rescore_formats(old_scores, new_scores, log)
+        model.Session.commit()
+
+        # its format's score is unchanged, so it is up to date
+        qa = qa_model.QA.get_for_resource(resource.id)
+        assert_equal(qa.scores_hash,
+                     ckanext.qa.lib.resource_format_scores_hash(new_scores))
+        assert_equal(qa.inputs_hash, inputs_hash)
+
 
 class TestUpdateResource(object):
     @classmethod
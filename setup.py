@@ -22,7 +22,6 @@ setup(
         'SQLAlchemy>=0.6.6',
         'requests',
         'xlrd>=0.8.0',
-        'messytables>=0.8',
         'python-magic>=0.4',
         'progressbar'
     ],